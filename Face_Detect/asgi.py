@@ -3,6 +3,18 @@ ASGI config for Face_Detect project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+The recognition views are async, so a single ASGI worker can keep many
+kiosk connections open while their frames are processed by the inference
+pool, e.g.::
+
+    uvicorn Face_Detect.asgi:application --workers 1
+
+WebSocket connections are routed to the frame-streaming endpoints in
+face_app.streaming; everything else goes to Django.
+
+With FACE_INFERENCE['WARMUP'] set, the face models are loaded (or the
+inference workers started) here, before the server accepts traffic.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 """
@@ -13,4 +25,17 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Face_Detect.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from face_app.streaming import websocket_application  # noqa: E402  (needs the app registry)
+from face_app.workers import get_inference_config, warm_up  # noqa: E402
+
+if get_inference_config()['WARMUP']:
+    warm_up()
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'websocket':
+        await websocket_application(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -135,6 +136,112 @@ LOGGING = {
     },
     'root': {
         'handlers': ['console'],
-        'level': 'DEBUG',
+        # Per-frame debug logging is costly on the hot path; opt in with DJANGO_LOG_LEVEL=DEBUG
+        'level': os.environ.get('DJANGO_LOG_LEVEL', 'INFO'),
     },
 }
+
+# Face gallery search
+# 'face_app.search.ExactSearch' scans every encoding. 'face_app.search.IVFSearch'
+# is approximate and scales to very large galleries; tune OPTIONS['nprobe'] for
+# recall vs latency. INDEX_PATH stores the trained IVF quantizer between restarts.
+# 'face_app.search.ShardedSearch' splits very large galleries into memory-mapped
+# shards searched in parallel by worker processes (OPTIONS: shards, directory,
+# router).
+FACE_SEARCH_BACKEND = {
+    'BACKEND': 'face_app.search.ExactSearch',
+    'OPTIONS': {},
+    'INDEX_PATH': None,
+}
+
+# Shared gallery
+# With ENABLED, the gallery is exported to versioned memory-mapped files under
+# DIRECTORY that every web worker on the host maps read-only, so gallery memory
+# does not grow with the number of workers. Profile changes are exported as a
+# new version after EXPORT_DELAY and picked up by the other workers within
+# POLL_INTERVAL seconds. Search is exact; FACE_SEARCH_BACKEND is ignored.
+FACE_SHARED_GALLERY = {
+    'ENABLED': False,
+    'DIRECTORY': BASE_DIR / 'gallery',
+    'POLL_INTERVAL': 1.0,
+    'EXPORT_DELAY': 2.0,
+}
+
+# Face inference worker pool
+# Detection and encoding run in separate processes with the dlib models
+# preloaded. Requests beyond MAX_PENDING queued jobs get a 503 with
+# Retry-After. Set WORKERS to 0 to run inference inline in the request thread.
+# Batch jobs (recognize_batch) wait BATCH_IMAGE_TIMEOUT more seconds per image.
+# The models are only loaded when first needed; WARMUP loads them (or starts
+# the workers) when the ASGI/WSGI application starts instead. Workers start
+# from a forkserver holding the models where available, sharing the weights.
+FACE_INFERENCE = {
+    'WORKERS': 2,
+    'MAX_PENDING': 8,
+    'TIMEOUT': 10.0,
+    'BATCH_IMAGE_TIMEOUT': 2.0,
+    'RETRY_AFTER': 1,
+    'WARMUP': True,
+}
+
+# Face tracking for live recognition
+# Each session / WebSocket connection gets a tracker: cheap detection runs on
+# every frame and the encoder only runs when a track is new, its identity
+# confidence has decayed, or every REENCODE_INTERVAL frames.
+FACE_TRACKING = {
+    'ENABLED': True,
+    'REENCODE_INTERVAL': 30,
+}
+
+# Frame gating
+# Cheap checks on a reduced grayscale decode of each frame (sharpness,
+# exposure, change since the client's previous frame, and a Haar face probe)
+# reject unusable frames before they reach the inference pool.
+FACE_GATING = {
+    'ENABLED': True,
+    'DECODE_SCALE': 4,
+    'RECOGNITION_STAGES': ['sharpness', 'exposure', 'motion', 'face_probe'],
+    'REGISTRATION_STAGES': ['sharpness', 'exposure'],
+}
+
+# In-progress registrations
+# Samples are held as float32 arrays under an enrollment token instead of in
+# the session. The local store lives in one process; with several web
+# workers use 'face_app.enrollment.CacheEnrollmentStore' with a shared cache
+# (OPTIONS: {'alias': 'default'}).
+FACE_ENROLLMENT_STORE = {
+    'BACKEND': 'face_app.enrollment.LocalEnrollmentStore',
+    'OPTIONS': {'ttl': 600},
+}
+
+# Face detection policy
+# The detection scale follows the frame size so an expected face reaches the
+# detector at about TARGET_FACE_PX wide. Under load (queue past
+# QUEUE_HIGH_WATER or job latency above LATENCY_SLO seconds) CNN falls back
+# to HOG, then to a smaller detector input. Responses report the mode used.
+FACE_DETECTION = {
+    'MODEL': 'cnn',
+    'TARGET_FACE_PX': 48,
+    'GROUP_FACE_FRACTION': 0.1,  # Expected face width / frame width in multi-face mode
+    'ENCODE_FACE_PX': 100,  # Jobs decode large frames at 1/2, 1/4 or 1/8 size while faces stay this wide
+    'QUEUE_HIGH_WATER': 0.5,
+    'LATENCY_SLO': 0.5,
+}
+
+# Client frame format
+# Browsers send frames as binary JPEG at this width and quality (announced in
+# the page and the WebSocket greeting) instead of base64 form fields.
+FACE_FRAME_FORMAT = {
+    'WIDTH': 320,
+    'QUALITY': 0.7,
+}
+
+# Recognition cache
+# Near-identical frames from the same client (by perceptual hash) reuse the
+# previous result for TTL seconds without inference, and encodings close to
+# a recently matched one reuse its gallery match. Cleared on profile changes.
+FACE_RECOGNITION_CACHE = {
+    'ENABLED': True,
+    'TTL': 30.0,
+    'MAX_HASH_DISTANCE': 12,
+}
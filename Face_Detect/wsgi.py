@@ -3,6 +3,11 @@ WSGI config for Face_Detect project.
 
 It exposes the WSGI callable as a module-level variable named ``application``.
 
+With FACE_INFERENCE['WARMUP'] set and inference running inline (WORKERS=0),
+the face models are loaded at import. Under ``gunicorn --preload`` that
+happens once in the master, and the forked workers share the model weights
+copy-on-write instead of each loading their own.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/wsgi/
 """
@@ -14,3 +19,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Face_Detect.settings')
 
 application = get_wsgi_application()
+
+from face_app.workers import get_inference_config, warm_up  # noqa: E402  (needs the app registry)
+
+if get_inference_config()['WARMUP']:
+    # Inference pools cannot cross the fork, so they still start in each worker
+    warm_up(start_pool=False)
@@ -0,0 +1,397 @@
+import base64
+import json
+import os
+import platform
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import cv2
+import numpy as np
+
+from .search import ExactSearch, IVFSearch, ShardedSearch
+
+
+def synthetic_gallery(n_profiles, samples_per_profile=5, dim=128, spread=0.03, seed=0):
+    """
+    Generates random unit-norm identity centres with `samples_per_profile`
+    noisy samples each. Returns (encodings, labels, centres).
+    """
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(n_profiles, dim)).astype(np.float32)
+    centres /= np.linalg.norm(centres, axis=1, keepdims=True)
+    encodings = np.repeat(centres, samples_per_profile, axis=0)
+    encodings += rng.normal(scale=spread, size=encodings.shape).astype(np.float32)
+    labels = np.repeat(np.arange(n_profiles, dtype=np.int64), samples_per_profile)
+    return encodings, labels, centres
+
+
+def synthetic_queries(centres, n_queries, spread=0.03, seed=1):
+    """
+    Draws fresh samples of randomly chosen identities. Returns (queries, labels).
+    """
+    rng = np.random.default_rng(seed)
+    labels = rng.integers(0, len(centres), n_queries)
+    queries = centres[labels] + rng.normal(scale=spread, size=(n_queries, centres.shape[1])).astype(np.float32)
+    return queries.astype(np.float32), labels
+
+
+def time_calls(func, args):
+    """
+    Calls `func` once per item in `args`. Returns (results, latencies in ms).
+    """
+    results, latencies = [], []
+    for arg in args:
+        start = time.perf_counter()
+        results.append(func(arg))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return results, np.array(latencies)
+
+
+def summarize_latencies(latencies):
+    return {
+        'mean_ms': float(np.mean(latencies)),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+    }
+
+
+def bench_search(n_profiles, samples_per_profile=5, n_queries=200, nprobes=(1, 4, 16), nlist=None, seed=0,
+                 shard_counts=()):
+    """
+    Compares exact search with IVF at several `nprobe` values, and with
+    ShardedSearch at several shard counts, on a synthetic gallery. Recall@1
+    is measured against the exact backend's answer.
+    """
+    encodings, labels, centres = synthetic_gallery(n_profiles, samples_per_profile, seed=seed)
+    queries, _ = synthetic_queries(centres, n_queries, seed=seed + 1)
+    rows = []
+
+    exact = ExactSearch()
+    start = time.perf_counter()
+    exact.build(encodings, labels)
+    build_s = time.perf_counter() - start
+    exact_results, latencies = time_calls(lambda q: exact.search(q, k=1), queries)
+    truth = [result[0][0] for result in exact_results]
+    rows.append({'backend': 'exact', 'profiles': n_profiles, 'encodings': len(labels), 'nprobe': None,
+                 'build_s': build_s, 'recall_at_1': 1.0, **summarize_latencies(latencies)})
+
+    ivf = IVFSearch(nlist=nlist)
+    start = time.perf_counter()
+    ivf.build(encodings, labels)
+    build_s = time.perf_counter() - start
+    for nprobe in nprobes:
+        ivf_results, latencies = time_calls(lambda q: ivf.search(q, k=1, nprobe=nprobe), queries)
+        hits = sum(1 for result, expected in zip(ivf_results, truth) if result and result[0][0] == expected)
+        rows.append({'backend': 'ivf', 'profiles': n_profiles, 'encodings': len(labels), 'nprobe': nprobe,
+                     'nlist': len(ivf.centroids) if ivf.is_trained else 1, 'build_s': build_s,
+                     'recall_at_1': hits / len(truth), **summarize_latencies(latencies)})
+
+    for shards in shard_counts:
+        with tempfile.TemporaryDirectory(prefix='face-shards-') as directory:
+            sharded = ShardedSearch(shards=shards, directory=directory)
+            start = time.perf_counter()
+            sharded.build(encodings, labels)
+            build_s = time.perf_counter() - start
+            try:
+                sharded.search(queries[0], k=1)
+                sharded_results, latencies = time_calls(lambda q: sharded.search(q, k=1), queries)
+            finally:
+                sharded.close()
+        hits = sum(1 for result, expected in zip(sharded_results, truth) if result and result[0][0] == expected)
+        rows.append({'backend': 'sharded', 'profiles': n_profiles, 'encodings': len(labels), 'nprobe': None,
+                     'shards': shards, 'build_s': build_s, 'recall_at_1': hits / len(truth),
+                     **summarize_latencies(latencies)})
+
+    return rows
+
+
+def legacy_register_pipeline(image, use_cnn=True, scale=0.25):
+    """
+    The register_face pipeline before FaceAnalysis: a landmark pass for the
+    pose check, another inside align_face, then a separate detection.
+    """
+    import face_recognition
+    from .utils import align_face, detect_and_encode_face
+
+    face_recognition.face_landmarks(image)
+    return detect_and_encode_face(align_face(image), use_cnn=use_cnn, scale=scale)
+
+
+def unified_register_pipeline(image, use_cnn=True, scale=0.25):
+    from .utils import FaceAnalysis
+
+    analysis = FaceAnalysis.detect(image, use_cnn=use_cnn, scale=scale)
+    if analysis is None:
+        return False, None
+    analysis.landmarks
+    return True, analysis.encoding
+
+
+def bench_pipeline(image, repeats=10, use_cnn=True):
+    """
+    Times the legacy and the single-pass register pipelines on one image,
+    both detecting at the scale the detection policy uses for it. Raises
+    ValueError if a pipeline finds no face: its timings would only measure
+    an early exit.
+    """
+    from .detection import default_detection_mode
+
+    model = 'cnn' if use_cnn else 'hog'
+    scale = default_detection_mode(model).scale_for(image.shape)
+    rows = []
+    for name, pipeline in (('legacy', legacy_register_pipeline), ('unified', unified_register_pipeline)):
+        # One untimed call so model loading is not counted
+        if not pipeline(image, use_cnn, scale)[0]:
+            raise ValueError(f'The {name} pipeline found no face at scale {scale}; use a photo with a larger face.')
+        _, latencies = time_calls(lambda _: pipeline(image, use_cnn, scale), range(repeats))
+        rows.append({'pipeline': name, 'model': model, 'scale': scale, **summarize_latencies(latencies)})
+    rows[1]['speedup'] = rows[0]['mean_ms'] / rows[1]['mean_ms']
+    return rows
+
+
+def resize_to_width(image, width):
+    scale = width / image.shape[1]
+    return cv2.resize(image, (width, round(image.shape[0] * scale)), interpolation=cv2.INTER_AREA)
+
+
+def stage_row(stage, params, latencies, **extra):
+    return {'stage': stage, 'params': params, **summarize_latencies(latencies), **extra}
+
+
+def bench_decode(image, repeats=20, quality=80):
+    """
+    base64 payload -> cv2.imdecode, as done for every posted frame.
+    """
+    from .utils import decode_base64_image
+
+    ok, jpeg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    image_data = 'data:image/jpeg;base64,' + base64.b64encode(jpeg.tobytes()).decode('ascii')
+    _, latencies = time_calls(lambda _: decode_base64_image(image_data), range(repeats))
+    return [stage_row('decode', {'width': image.shape[1], 'quality': quality}, latencies, bytes=len(jpeg))]
+
+
+def bench_frame_decode(image, repeats=20, widths=(400, 320), qualities=(80, 70), reductions=(1, 2, 4)):
+    """
+    Binary frame -> cv2.imdecode at each client frame size and quality, and
+    at each decode reduction the inference jobs may use.
+    """
+    from .utils import decode_image
+
+    rows = []
+    for width in widths:
+        resized = resize_to_width(image, width)
+        for quality in qualities:
+            frame = cv2.imencode('.jpg', resized, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+            for reduction in reductions:
+                _, latencies = time_calls(lambda _: decode_image(frame, reduction), range(repeats))
+                rows.append(stage_row('frame_decode', {'width': width, 'quality': quality, 'reduction': reduction},
+                                      latencies, bytes=len(frame)))
+    return rows
+
+
+def bench_blur(image, repeats=20):
+    from .utils import is_blurry
+
+    _, latencies = time_calls(lambda _: is_blurry(image), range(repeats))
+    return [stage_row('is_blurry', {'width': image.shape[1]}, latencies)]
+
+
+def bench_align(image, repeats=5):
+    from .utils import align_face
+
+    align_face(image)
+    _, latencies = time_calls(lambda _: align_face(image), range(repeats))
+    return [stage_row('align_face', {'width': image.shape[1]}, latencies)]
+
+
+def bench_detect_and_encode(image, widths=(320, 640, 1280), models=('hog', 'cnn'), repeats=5):
+    """
+    detect_and_encode_face with each detector at several input resolutions.
+    """
+    from .utils import detect_and_encode_face
+
+    rows = []
+    for width in widths:
+        resized = resize_to_width(image, width)
+        for model in models:
+            use_cnn = model == 'cnn'
+            detect_and_encode_face(resized, use_cnn=use_cnn)
+            results, latencies = time_calls(lambda _: detect_and_encode_face(resized, use_cnn=use_cnn), range(repeats))
+            rows.append(stage_row('detect_and_encode', {'width': width, 'model': model}, latencies,
+                                  face_found=bool(results[0][0])))
+    return rows
+
+
+def bench_matching(gallery_sizes=(1000, 10000, 100000, 1000000), n_queries=200, seed=0):
+    """
+    Gallery search as run by test_face, with the configured search backend,
+    against synthetic galleries of one random encoding per profile.
+    """
+    from .gallery import create_search_backend
+
+    rows = []
+    for size in gallery_sizes:
+        encodings, labels, centres = synthetic_gallery(size, samples_per_profile=1, seed=seed)
+        queries, _ = synthetic_queries(centres, n_queries, seed=seed + 1)
+        backend = create_search_backend()
+        start = time.perf_counter()
+        backend.build(encodings, labels)
+        build_s = time.perf_counter() - start
+        _, latencies = time_calls(lambda q: backend.search(q, k=1), queries)
+        rows.append(stage_row('matching', {'gallery': size, 'backend': type(backend).__name__}, latencies,
+                              build_s=build_s))
+    return rows
+
+
+def bench_end_to_end(image, repeats=5):
+    """
+    POSTs a base64 frame to test_face through the Django test client, so
+    the view, the inference pool and the real gallery are all included.
+    The same frame is posted every time, so the frame gate and the
+    recognition cache are switched off to measure the full pipeline.
+    """
+    from django.conf import settings
+    from django.test import Client, override_settings
+
+    from .recognition_cache import get_recognition_cache
+
+    ok, jpeg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 80])
+    image_data = 'data:image/jpeg;base64,' + base64.b64encode(jpeg.tobytes()).decode('ascii')
+    client = Client(HTTP_HOST='localhost')
+
+    def post(_):
+        return client.post('/test_face/', {'image': image_data}).json()
+
+    cache = get_recognition_cache()
+    cache_enabled, cache.enabled = cache.enabled, False
+    try:
+        with override_settings(FACE_GATING={**getattr(settings, 'FACE_GATING', {}), 'ENABLED': False}):
+            post(None)
+            results, latencies = time_calls(post, range(repeats))
+    finally:
+        cache.enabled = cache_enabled
+    successes = sum(1 for result in results if result.get('success'))
+    return [stage_row('test_face', {'width': image.shape[1]}, latencies, success_rate=successes / repeats)]
+
+
+def run_suite(image, repeats=5, widths=(320, 640, 1280), models=('hog', 'cnn'),
+              gallery_sizes=(1000, 10000, 100000, 1000000), end_to_end=True):
+    """
+    Runs every stage benchmark. Returns a JSON-serialisable report.
+    """
+    results = []
+    results += bench_decode(image, repeats * 4)
+    results += bench_frame_decode(image, repeats * 4)
+    results += bench_blur(image, repeats * 4)
+    results += bench_align(image, repeats)
+    results += bench_detect_and_encode(image, widths, models, repeats)
+    results += bench_matching(gallery_sizes)
+    if end_to_end:
+        results += bench_end_to_end(image, repeats)
+
+    return {
+        'created': datetime.now(timezone.utc).isoformat(),
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+        },
+        'results': results,
+    }
+
+
+def result_key(row):
+    return row['stage'], json.dumps(row['params'], sort_keys=True)
+
+
+def compare_reports(report, baseline, tolerance=0.2, metric='p50_ms'):
+    """
+    Compares each result with the baseline row for the same stage and
+    params. A row regresses when `metric` grew by more than `tolerance`
+    (a fraction of the baseline value).
+    """
+    baseline_rows = {result_key(row): row for row in baseline['results']}
+    comparisons = []
+    for row in report['results']:
+        before = baseline_rows.get(result_key(row))
+        if before is None:
+            continue
+        change = row[metric] / before[metric] - 1 if before[metric] else 0.0
+        comparisons.append({'stage': row['stage'], 'params': row['params'], 'metric': metric,
+                            'baseline': before[metric], 'current': row[metric], 'change': change,
+                            'regression': change > tolerance})
+    return comparisons
+
+
+STARTUP_SCRIPT = '''
+import json, os, sys, time
+start = time.perf_counter()
+import django
+django.setup()
+from django.conf import settings
+from django.urls import get_resolver
+get_resolver().url_patterns  # Imports every view, as the first request or system check would
+options = json.loads(sys.argv[1])
+result = {'import_s': time.perf_counter() - start}
+if options['inference'] is not None:
+    settings.FACE_INFERENCE = {**getattr(settings, 'FACE_INFERENCE', {}), **options['inference']}
+    from face_app.workers import get_inference_pool, warm_up
+    warm_up()
+    pool = get_inference_pool()
+    if pool.workers:
+        from face_app.benchmarks import memory_usage
+        result['workers'] = [memory_usage(pid) for pid in pool.start()]
+        pool.shutdown()
+from face_app.benchmarks import memory_usage
+result['ready_s'] = time.perf_counter() - start
+result['process'] = memory_usage(os.getpid())
+print(json.dumps(result))
+'''
+
+STARTUP_SCENARIOS = {
+    'lazy_import': None,
+    'inline_models': {'WORKERS': 0},
+    'spawn_pool': {'START_METHOD': 'spawn'},
+    'forkserver_pool': {'START_METHOD': 'forkserver', 'PRELOAD_MODELS': True},
+}
+
+
+def memory_usage(pid):
+    """
+    Resident and proportional set size of a process in MB. PSS splits
+    shared pages between the processes sharing them, so it shows what
+    copy-on-write sharing saves.
+    """
+    usage = {}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                key, value = line.split(':', 1)
+                if key in ('Rss', 'Pss'):
+                    usage[f'{key.lower()}_mb'] = int(value.split()[0]) / 1024
+    except OSError:
+        import resource
+        usage['rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return usage
+
+
+def bench_startup(scenarios=STARTUP_SCENARIOS, workers=2):
+    """
+    Starts a fresh interpreter per scenario and reports the time until the
+    app is ready to serve plus the memory of the web process and of each
+    inference worker.
+    """
+    import subprocess
+    import sys
+
+    rows = []
+    for name, inference in scenarios.items():
+        if inference is not None:
+            inference = {'WORKERS': workers, **inference}
+        output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, json.dumps({'inference': inference})],
+                                capture_output=True, text=True, check=True, env=os.environ.copy())
+        rows.append({'scenario': name, **json.loads(output.stdout.strip().splitlines()[-1])})
+    return rows
@@ -0,0 +1,138 @@
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+
+from .metrics import DETECTION_MODES
+
+DEFAULT_DETECTION_CONFIG = {
+    'MODEL': 'cnn',  # Detector used while the server keeps up
+    'FACE_FRACTION': 0.25,  # Expected face width as a fraction of the frame width
+    'GROUP_FACE_FRACTION': 0.1,  # The same for multi-face frames, where people stand further back
+    'TARGET_FACE_PX': 48,  # Face width the detector should see after downscaling (dlib upsamples it once more)
+    'MIN_SCALE': 0.125,
+    'MAX_SCALE': 1.0,
+    'QUEUE_HIGH_WATER': 0.5,  # Fall back to HOG once this fraction of the inference queue is in use
+    'LATENCY_SLO': 0.5,  # Seconds; fall back to HOG when the smoothed job latency exceeds it
+    'LATENCY_SMOOTHING': 0.2,  # Weight of the newest sample in the latency average
+    'LATENCY_WINDOW': 10.0,  # Seconds before a model's latency average is stale and the model is retried
+    'DEGRADED_TARGET_FACE_PX': 32,  # Smaller detector input when even HOG misses the SLO
+    'ENCODE_FACE_PX': 100,  # Face width to keep when a job decodes a reduced frame it will also encode
+}
+
+
+def get_detection_config():
+    return {**DEFAULT_DETECTION_CONFIG, **getattr(settings, 'FACE_DETECTION', {})}
+
+
+class DetectionMode(namedtuple('DetectionMode',
+                               'model target_face_px face_fraction min_scale max_scale encode_face_px reason')):
+    """
+    How a job should run face detection. Chosen in the web process, which
+    knows the load, and resolved to a scale in the job, which knows the
+    image size.
+    """
+
+    @property
+    def use_cnn(self):
+        return self.model == 'cnn'
+
+    def scale_for(self, shape):
+        """
+        Downscale factor that brings an expected face in an image of `shape`
+        to roughly `target_face_px` wide, in steps of 1/8.
+        """
+        expected_face_px = shape[1] * self.face_fraction
+        scale = round(self.target_face_px / expected_face_px * 8) / 8
+        return min(max(scale, self.min_scale), self.max_scale)
+
+    def decode_reduction(self, shape, encode=True):
+        """
+        Largest JPEG decode reduction (1, 2, 4 or 8) for an image of `shape`
+        that stays above the detector input size and, if the job also takes
+        landmarks or encodings, keeps an expected face `encode_face_px` wide.
+        """
+        limit = 1 / self.scale_for(shape)
+        if encode:
+            limit = min(limit, shape[1] * self.face_fraction / self.encode_face_px)
+        return next(reduction for reduction in (8, 4, 2, 1) if reduction <= limit or reduction == 1)
+
+    def describe(self, shape):
+        return {'model': self.model, 'scale': self.scale_for(shape), 'reason': self.reason}
+
+
+def default_detection_mode(model=None, group=False):
+    """
+    The mode used when nothing is under load: the configured detector at
+    the configured target face size. `group` expects the smaller faces of
+    a multi-face frame.
+    """
+    config = get_detection_config()
+    face_fraction = config['GROUP_FACE_FRACTION'] if group else config['FACE_FRACTION']
+    return DetectionMode(model or config['MODEL'], config['TARGET_FACE_PX'], face_fraction,
+                         config['MIN_SCALE'], config['MAX_SCALE'], config['ENCODE_FACE_PX'], 'normal')
+
+
+class DetectionPolicy:
+    """
+    Picks the detector for each job from the inference queue depth and a
+    smoothed job latency per model: CNN normally, HOG when the queue is
+    deep or CNN misses the latency SLO, and a smaller detector input when
+    HOG misses it too.
+    """
+
+    def __init__(self, config=None):
+        self.config = config or get_detection_config()
+        self._latency = {}  # model -> (smoothed seconds, last update)
+        self._lock = threading.Lock()
+
+    def choose(self, pool, model=None, group=False):
+        config = self.config
+        model = model or config['MODEL']
+        target_face_px = config['TARGET_FACE_PX']
+        reason = 'normal'
+
+        if model == 'cnn':
+            if pool.workers and pool.pending >= config['QUEUE_HIGH_WATER'] * pool.max_pending:
+                model, reason = 'hog', 'queue'
+            elif self.latency('cnn') > config['LATENCY_SLO']:
+                model, reason = 'hog', 'latency'
+        if model == 'hog' and self.latency('hog') > config['LATENCY_SLO']:
+            target_face_px, reason = config['DEGRADED_TARGET_FACE_PX'], 'latency'
+
+        DETECTION_MODES.inc(model, reason)
+        return default_detection_mode(model, group)._replace(target_face_px=target_face_px, reason=reason)
+
+    def latency(self, model):
+        """
+        Smoothed job latency of `model`, or 0 if it has not run recently.
+        Going stale is what lets a model that was switched off be retried.
+        """
+        smoothed, updated = self._latency.get(model, (0.0, 0.0))
+        if time.monotonic() - updated > self.config['LATENCY_WINDOW']:
+            return 0.0
+        return smoothed
+
+    def record_latency(self, model, seconds):
+        alpha = self.config['LATENCY_SMOOTHING']
+        with self._lock:
+            previous = self.latency(model)
+            smoothed = (1 - alpha) * previous + alpha * seconds if previous else seconds
+            self._latency[model] = (smoothed, time.monotonic())
+
+
+_policy = None
+_policy_lock = threading.Lock()
+
+
+def get_detection_policy():
+    """
+    Returns the process-wide detection policy, configured by settings.FACE_DETECTION.
+    """
+    global _policy
+    if _policy is None:
+        with _policy_lock:
+            if _policy is None:
+                _policy = DetectionPolicy()
+    return _policy
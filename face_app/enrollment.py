@@ -0,0 +1,174 @@
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+from .models import ENCODING_DTYPE, ENCODING_SIZE, pack_encodings, unpack_encodings
+
+DEFAULT_ENROLLMENT_STORE = {
+    'BACKEND': 'face_app.enrollment.LocalEnrollmentStore',
+    'OPTIONS': {},
+}
+
+
+def get_enrollment_config():
+    return {**DEFAULT_ENROLLMENT_STORE, **getattr(settings, 'FACE_ENROLLMENT_STORE', {})}
+
+
+class EnrollmentStore:
+    """
+    Holds the encodings of registrations in progress, keyed by an
+    unguessable enrollment token, until save_face_profile consumes them.
+    """
+
+    def create(self):
+        """
+        Starts an empty enrollment and returns its token.
+        """
+        token = secrets.token_urlsafe(24)
+        self.reset(token, create=True)
+        return token
+
+    def reset(self, token, create=False):
+        """
+        Discards the samples of enrollment `token`. Returns False if the
+        token is unknown or expired (unless `create` is set).
+        """
+        raise NotImplementedError
+
+    def add(self, token, encoding):
+        """
+        Appends one encoding and returns the enrollment's sample count, or
+        None if the token is unknown or expired.
+        """
+        raise NotImplementedError
+
+    def pop(self, token):
+        """
+        Removes the enrollment and returns its (n, 128) float32 encodings,
+        or None if the token is unknown or expired.
+        """
+        raise NotImplementedError
+
+
+class LocalEnrollmentStore(EnrollmentStore):
+    """
+    In-process store: an LRU of float32 sample arrays with TTL expiry.
+    Enrollments only survive within one web process, so deployments with
+    several workers should use CacheEnrollmentStore.
+    """
+
+    def __init__(self, ttl=600, max_enrollments=1000, max_samples=16):
+        self.ttl = ttl
+        self.max_enrollments = max_enrollments
+        self.max_samples = max_samples
+        self._enrollments = OrderedDict()  # token -> [expires_at, samples, count]
+        self._lock = threading.Lock()
+
+    def reset(self, token, create=False):
+        with self._lock:
+            self._evict_expired()
+            if not create and token not in self._enrollments:
+                return False
+            self._enrollments.pop(token, None)
+            samples = np.empty((self.max_samples, ENCODING_SIZE), dtype=ENCODING_DTYPE)
+            self._enrollments[token] = [time.monotonic() + self.ttl, samples, 0]
+            while len(self._enrollments) > self.max_enrollments:
+                self._enrollments.popitem(last=False)
+            return True
+
+    def add(self, token, encoding):
+        with self._lock:
+            self._evict_expired()
+            enrollment = self._enrollments.get(token)
+            if enrollment is None or enrollment[2] >= self.max_samples:
+                return None
+            _, samples, count = enrollment
+            samples[count] = encoding
+            enrollment[0] = time.monotonic() + self.ttl
+            enrollment[2] = count + 1
+            self._enrollments.move_to_end(token)
+            return count + 1
+
+    def pop(self, token):
+        with self._lock:
+            self._evict_expired()
+            enrollment = self._enrollments.pop(token, None)
+        if enrollment is None:
+            return None
+        return enrollment[1][:enrollment[2]].copy()
+
+    def _evict_expired(self):
+        # Entries are kept in last-used order, and every use extends the TTL
+        now = time.monotonic()
+        while self._enrollments:
+            token, enrollment = next(iter(self._enrollments.items()))
+            if enrollment[0] > now:
+                break
+            del self._enrollments[token]
+
+
+class CacheEnrollmentStore(EnrollmentStore):
+    """
+    Stores packed float32 samples in a Django cache, so every web process
+    sees the same enrollments.
+    """
+
+    def __init__(self, alias='default', ttl=600, max_samples=16, key_prefix='face_enrollment'):
+        self.alias = alias
+        self.ttl = ttl
+        self.max_samples = max_samples
+        self.key_prefix = key_prefix
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def reset(self, token, create=False):
+        key = self._key(token)
+        if not create and self.cache.get(key) is None:
+            return False
+        self.cache.set(key, b'', self.ttl)
+        return True
+
+    def add(self, token, encoding):
+        key = self._key(token)
+        data = self.cache.get(key)
+        if data is None or len(data) // (ENCODING_SIZE * ENCODING_DTYPE.itemsize) >= self.max_samples:
+            return None
+        data += pack_encodings(encoding)
+        self.cache.set(key, data, self.ttl)
+        return len(data) // (ENCODING_SIZE * ENCODING_DTYPE.itemsize)
+
+    def pop(self, token):
+        key = self._key(token)
+        data = self.cache.get(key)
+        if data is None:
+            return None
+        self.cache.delete(key)
+        return unpack_encodings(data).copy()
+
+    def _key(self, token):
+        return f'{self.key_prefix}:{token}'
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_enrollment_store():
+    """
+    Returns the process-wide enrollment store, configured by settings.FACE_ENROLLMENT_STORE.
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                config = get_enrollment_config()
+                _store = import_string(config['BACKEND'])(**config['OPTIONS'])
+    return _store
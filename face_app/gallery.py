@@ -0,0 +1,574 @@
+import atexit
+import fcntl
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+import weakref
+from collections import namedtuple
+from collections.abc import Mapping
+from contextlib import contextmanager
+
+import numpy as np
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .gating import get_frame_gate
+from .metrics import timed
+from .models import ENCODING_SIZE, FaceProfile
+from .recognition_cache import get_recognition_cache
+from .search import ShardIndex, save_meta
+from .tracking import get_tracker_registry
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SEARCH_BACKEND = {
+    'BACKEND': 'face_app.search.ExactSearch',
+    'OPTIONS': {},
+    'INDEX_PATH': None,
+}
+
+
+def get_search_config():
+    return {**DEFAULT_SEARCH_BACKEND, **getattr(settings, 'FACE_SEARCH_BACKEND', {})}
+
+
+DEFAULT_SHARED_GALLERY = {
+    'ENABLED': False,
+    'DIRECTORY': None,  # Required when enabled; every worker on the host must use the same one
+    'POLL_INTERVAL': 1.0,  # Seconds between checks for a newer version
+    'EXPORT_DELAY': 2.0,  # Profile changes within this window are exported as one version
+    'KEEP_VERSIONS': 2,  # Versions kept on disk, for workers still switching from an older one
+    'COPY_CHUNK_ROWS': 65536,  # Rows copied at a time when writing a new version
+}
+
+
+def get_shared_gallery_config():
+    return {**DEFAULT_SHARED_GALLERY, **getattr(settings, 'FACE_SHARED_GALLERY', {})}
+
+
+def create_search_backend(config=None):
+    """
+    Instantiates the search backend configured in settings.FACE_SEARCH_BACKEND.
+    """
+    config = config or get_search_config()
+    return import_string(config['BACKEND'])(**config['OPTIONS'])
+
+
+# A search backend and the names of its labels, published together so a
+# search never pairs one version's rows with another's names
+GallerySnapshot = namedtuple('GallerySnapshot', 'backend names')
+
+
+class GalleryIndex:
+    """
+    Process-wide in-memory index of every enrolled face encoding.
+
+    Encodings are held by a pluggable search backend (see face_app.search),
+    labelled with their FaceProfile id. Writers are serialised by a lock;
+    searches run without it, on the snapshot current when they start.
+    """
+
+    def __init__(self, config=None):
+        self._lock = threading.RLock()
+        self._built = False
+        self._config = config
+        self.snapshot = GallerySnapshot(None, {})
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def backend(self):
+        return self.snapshot.backend
+
+    @property
+    def names(self):
+        return self.snapshot.names
+
+    @property
+    def is_built(self):
+        return self._built
+
+    def build(self):
+        """
+        Loads every FaceProfile from the database into a fresh backend.
+        """
+        encodings, labels, names = self.load_profiles()
+
+        config = self._config or get_search_config()
+        backend = create_search_backend(config)
+        index_path = config['INDEX_PATH']
+        loaded = backend.load(index_path) if index_path else False
+        backend.build(encodings, labels)
+        if index_path and not loaded:
+            backend.save(index_path)
+
+        with self._lock:
+            self.snapshot = GallerySnapshot(backend, names)
+            self._built = True
+
+        logger.info(f"Gallery index built: {len(names)} profiles, {len(labels)} encodings, "
+                    f"{type(backend).__name__} backend")
+
+    @classmethod
+    def load_profiles(cls):
+        """
+        Reads every FaceProfile with encodings from the database. Returns
+        the (n, 128) float32 encodings, their profile id labels and a
+        {profile_id: name} dict.
+        """
+        blocks, ids, names = [], [], {}
+        profiles = FaceProfile.objects.only('pk', 'name', 'encoding_data', 'face_encodings')
+        with timed('db_fetch'):
+            for profile in profiles.iterator(chunk_size=2000):
+                encodings = cls._as_matrix(profile.get_encodings())
+                if not len(encodings):
+                    continue
+                blocks.append(encodings)
+                ids.append(np.full(len(encodings), profile.pk, dtype=np.int64))
+                names[profile.pk] = profile.name
+
+        encodings = np.concatenate(blocks) if blocks else np.empty((0, ENCODING_SIZE), dtype=np.float32)
+        labels = np.concatenate(ids) if ids else np.empty(0, dtype=np.int64)
+        return encodings, labels, names
+
+    def ensure_built(self):
+        if not self._built:
+            with self._lock:
+                if not self._built:
+                    self.build()
+
+    def add_profile(self, profile):
+        """
+        Inserts or replaces the encodings of a single profile.
+        """
+        encodings = self._as_matrix(profile.get_encodings())
+        with self._lock:
+            self.backend.add(encodings, profile.pk)
+            if len(encodings):
+                self.names[profile.pk] = profile.name
+            else:
+                self.names.pop(profile.pk, None)
+
+    def remove_profile(self, profile_id):
+        with self._lock:
+            self.backend.remove(profile_id)
+            self.names.pop(profile_id, None)
+
+    def search(self, face_encoding, k=1):
+        """
+        Returns up to `k` (profile_id, name, distance) tuples for the closest
+        profiles, best first. Each profile is scored by its nearest sample.
+        """
+        self.ensure_built()
+        backend, names = self.snapshot
+        with timed('match'):
+            matches = backend.search(np.asarray(face_encoding, dtype=np.float32), k=k)
+        return [(profile_id, names[profile_id], distance) for profile_id, distance in matches
+                if profile_id in names]
+
+    def search_batch(self, face_encodings, k=1):
+        """
+        Matches several encodings in one backend call. Returns one list of
+        (profile_id, name, distance) tuples per encoding.
+        """
+        self.ensure_built()
+        if not len(face_encodings):
+            return []
+        backend, names = self.snapshot
+        with timed('match'):
+            batches = backend.search_batch(self._as_matrix(face_encodings), k=k)
+        return [[(profile_id, names[profile_id], distance) for profile_id, distance in matches
+                 if profile_id in names] for matches in batches]
+
+    def distances_to(self, face_encodings, profile_ids):
+        """
+        Scores each encoding against the encodings of one given profile
+        only. Returns a (profile_id, name, distance) tuple per encoding, or
+        None where that profile is no longer in the gallery.
+        """
+        self.ensure_built()
+        if not len(face_encodings):
+            return []
+        backend, names = self.snapshot
+        with timed('match'):
+            distances = backend.label_distances(self._as_matrix(face_encodings), list(profile_ids))
+        return [(profile_id, names[profile_id], distance) if distance is not None and profile_id in names else None
+                for profile_id, distance in zip(profile_ids, distances)]
+
+    @staticmethod
+    def _as_matrix(encodings):
+        encodings = np.asarray(encodings, dtype=np.float32)
+        if encodings.size == 0:
+            return np.empty((0, ENCODING_SIZE), dtype=np.float32)
+        return encodings.reshape(-1, ENCODING_SIZE)
+
+
+def encode_names(names):
+    """
+    Packs a {profile_id: name} dict into sorted ids, offsets and one
+    utf-8 byte blob, the on-disk form read by MappedNames.
+    """
+    ids = np.array(sorted(names), dtype=np.int64)
+    encoded = [names[profile_id].encode() for profile_id in ids.tolist()]
+    offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+    np.cumsum([len(name) for name in encoded], out=offsets[1:])
+    return ids, offsets, np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+
+def merge_names(ids, offsets, blob, changes):
+    """
+    Applies {profile_id: name or None} `changes` to packed names (see
+    `encode_names`) without decoding the unchanged ones. None removes a
+    profile.
+    """
+    keep = ~np.isin(ids, np.fromiter(changes, dtype=np.int64, count=len(changes)))
+    lengths = np.diff(offsets)
+    added = {profile_id: name for profile_id, name in changes.items() if name is not None}
+    added_ids, added_offsets, added_blob = encode_names(added)
+
+    all_ids = np.concatenate([ids[keep], added_ids])
+    all_lengths = np.concatenate([lengths[keep], np.diff(added_offsets)])
+    all_blob = np.concatenate([blob[np.repeat(keep, lengths)], added_blob])
+    starts = np.concatenate([[0], np.cumsum(all_lengths)[:-1]]).astype(np.int64)
+
+    # Reorder the variable-length names by id in one gather
+    order = np.argsort(all_ids, kind='stable')
+    new_lengths = all_lengths[order]
+    new_offsets = np.zeros(len(order) + 1, dtype=np.int64)
+    np.cumsum(new_lengths, out=new_offsets[1:])
+    sources = np.repeat(starts[order] - new_offsets[:-1], new_lengths) + np.arange(new_offsets[-1])
+    return all_ids[order], new_offsets, all_blob[sources]
+
+
+class MappedNames(Mapping):
+    """
+    Read-only {profile_id: name} view over the packed names of a shared
+    gallery version, plus the changes made in this process that are not
+    exported yet.
+    """
+
+    def __init__(self, path):
+        self.ids = np.load(f'{path}.ids.npy', mmap_mode='r')
+        self.offsets = np.load(f'{path}.name_offsets.npy', mmap_mode='r')
+        self.blob = np.load(f'{path}.names.npy', mmap_mode='r')
+        self.overlay = {}  # profile_id -> name, or None once removed
+
+    def _find(self, profile_id):
+        index = int(np.searchsorted(self.ids, profile_id))
+        return index if index < len(self.ids) and self.ids[index] == profile_id else None
+
+    def __getitem__(self, profile_id):
+        if profile_id in self.overlay:
+            name = self.overlay[profile_id]
+        else:
+            index = self._find(profile_id)
+            name = None if index is None else bytes(self.blob[self.offsets[index]:self.offsets[index + 1]]).decode()
+        if name is None:
+            raise KeyError(profile_id)
+        return name
+
+    def __iter__(self):
+        for profile_id in self.ids.tolist():
+            if self.overlay.get(profile_id, '') is not None:
+                yield profile_id
+        for profile_id, name in self.overlay.items():
+            if name is not None and self._find(profile_id) is None:
+                yield profile_id
+
+    def __len__(self):
+        size = len(self.ids)
+        for profile_id, name in self.overlay.items():
+            stored = self._find(profile_id) is not None
+            size += (name is not None and not stored) - (name is None and stored)
+        return size
+
+
+VERSION_PATTERN = re.compile(r'^v\d{6}$')
+
+
+class SharedGalleryIndex(GalleryIndex):
+    """
+    Gallery index shared by every worker process on a host.
+
+    The gallery is exported to versioned .npy files under DIRECTORY
+    (v000001/gallery.encodings.npy, .labels.npy, .norms.npy and the packed
+    names), and each worker memory-maps the version named in the CURRENT
+    file read-only. The page cache holds one copy however many workers
+    there are.
+
+    Profile changes are applied to this worker's view at once and exported
+    as a new version after EXPORT_DELAY, batching bursts of enrollments.
+    Changes still pending when the process exits are exported then, so a
+    management command or shell session does not lose them. A version is
+    written to a temporary directory, renamed into place and published by
+    replacing CURRENT, so readers only ever see complete versions. Workers
+    check CURRENT at most every POLL_INTERVAL seconds and switch to a newer
+    version by swapping in its snapshot in one assignment.
+
+    Search is always exact (ShardIndex); FACE_SEARCH_BACKEND is not used.
+    """
+
+    def __init__(self, config=None):
+        super().__init__()
+        self.shared_config = config or get_shared_gallery_config()
+        self.directory = self.shared_config['DIRECTORY']
+        if not self.directory:
+            raise ValueError('FACE_SHARED_GALLERY requires a DIRECTORY')
+        self.version = None
+        self._checked_at = 0.0
+        self._pending = {}  # profile_id -> (encodings, name or None) not exported yet
+        self._export_timer = None
+        atexit.register(_flush_at_exit, weakref.ref(self))
+
+    @property
+    def is_built(self):
+        # Another worker may have built the shared gallery, so changes made
+        # here must always be exported
+        return True
+
+    def build(self):
+        """
+        Attaches to the current version, exporting one from the database
+        if there is none yet.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with self._write_lock():
+            version = self.current_version() or self._export_profiles()
+        self._attach(version)
+
+    def rebuild(self):
+        """
+        Exports a fresh version from the database, e.g. after a bulk import
+        that sent no signals. Every worker switches to it within POLL_INTERVAL.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock:
+            with self._write_lock():
+                version = self._export_profiles()
+            self._pending.clear()
+            self._attach(version)
+
+    def ensure_built(self):
+        super().ensure_built()
+        now = time.monotonic()
+        if now - self._checked_at < self.shared_config['POLL_INTERVAL']:
+            return
+        self._checked_at = now
+        version = self.current_version()
+        if version and version != self.version:
+            with self._lock:
+                if version != self.version:
+                    self._attach(version)
+                    # Matches cached in this worker may predate the other worker's change
+                    get_tracker_registry().invalidate()
+                    get_recognition_cache().invalidate()
+                    get_frame_gate().invalidate()
+
+    def add_profile(self, profile):
+        encodings = self._as_matrix(profile.get_encodings())
+        self._record(profile.pk, encodings, profile.name if len(encodings) else None)
+
+    def remove_profile(self, profile_id):
+        self._record(profile_id, self._as_matrix([]), None)
+
+    def _record(self, profile_id, encodings, name):
+        self.ensure_built()
+        with self._lock:
+            self._pending[profile_id] = (encodings, name)
+            self._apply(self.snapshot, profile_id, encodings, name)
+            if self._export_timer is None:
+                self._export_timer = threading.Timer(self.shared_config['EXPORT_DELAY'], self.export)
+                self._export_timer.daemon = True
+                self._export_timer.start()
+
+    @staticmethod
+    def _apply(snapshot, profile_id, encodings, name):
+        # Searches skip rows without a name, so a new name goes in before its rows and a removed one after
+        if len(encodings):
+            snapshot.names.overlay[profile_id] = name
+            snapshot.backend.add(encodings, profile_id)
+        else:
+            snapshot.backend.remove(profile_id)
+            snapshot.names.overlay[profile_id] = name
+
+    def _attach(self, version):
+        path = self._gallery_path(version)
+        snapshot = GallerySnapshot(ShardIndex(path, ENCODING_SIZE), MappedNames(path))
+        # Changes not exported yet are carried over to the new version
+        for profile_id, (encodings, name) in self._pending.items():
+            self._apply(snapshot, profile_id, encodings, name)
+        self.snapshot = snapshot
+        self.version = version
+        self._built = True
+        logger.info(f"Shared gallery attached: {version}, {len(snapshot.backend)} encodings")
+
+    def flush(self):
+        """
+        Exports pending changes now rather than after EXPORT_DELAY.
+        """
+        with self._lock:
+            timer, self._export_timer = self._export_timer, None
+        if timer is not None:
+            timer.cancel()
+        self.export()
+
+    def export(self):
+        """
+        Writes the pending profile changes as a new version on top of the
+        current one.
+        """
+        with self._lock:
+            self._export_timer = None
+            pending = dict(self._pending)
+        if not pending:
+            return
+        try:
+            with self._write_lock():
+                version = self._export_changes(self.current_version(), pending)
+        except Exception:
+            logger.exception('Shared gallery export failed; changes stay local to this worker')
+            return
+        with self._lock:
+            for profile_id, change in pending.items():
+                if self._pending.get(profile_id) is change:
+                    del self._pending[profile_id]
+            self._attach(version)
+
+    def current_version(self):
+        try:
+            with open(os.path.join(self.directory, 'CURRENT')) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _gallery_path(self, version):
+        return os.path.join(self.directory, version, 'gallery')
+
+    @contextmanager
+    def _write_lock(self):
+        # Serialises exports across processes; readers never take it
+        with open(os.path.join(self.directory, '.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _export_profiles(self):
+        encodings, labels, names = self.load_profiles()
+        max_per_label = int(np.unique(labels, return_counts=True)[1].max(initial=1))
+
+        def write(path):
+            np.save(f'{path}.encodings.npy', encodings)
+            np.save(f'{path}.labels.npy', labels)
+            np.save(f'{path}.norms.npy', np.einsum('ij,ij->i', encodings, encodings))
+            self._write_names(path, *encode_names(names))
+            save_meta(f'{path}.meta.json', {'max_per_label': max_per_label})
+
+        return self._publish(write)
+
+    def _export_changes(self, base_version, pending):
+        base = self._gallery_path(base_version)
+        base_encodings = np.load(f'{base}.encodings.npy', mmap_mode='r')
+        base_labels = np.load(f'{base}.labels.npy', mmap_mode='r')
+        base_norms = np.load(f'{base}.norms.npy', mmap_mode='r')
+        with open(f'{base}.meta.json') as f:
+            max_per_label = json.load(f)['max_per_label']
+
+        keep = ~np.isin(base_labels, np.fromiter(pending, dtype=np.int64, count=len(pending)))
+        added = [(profile_id, encodings) for profile_id, (encodings, _) in pending.items() if len(encodings)]
+        total = int(keep.sum()) + sum(len(encodings) for _, encodings in added)
+        # An upper bound is enough: it only sizes the candidate pool of a search
+        max_per_label = max([max_per_label] + [len(encodings) for _, encodings in added])
+
+        def write(path):
+            out_encodings = np.lib.format.open_memmap(f'{path}.encodings.npy', mode='w+', dtype=np.float32,
+                                                      shape=(total, ENCODING_SIZE))
+            out_labels = np.lib.format.open_memmap(f'{path}.labels.npy', mode='w+', dtype=np.int64, shape=(total,))
+            out_norms = np.lib.format.open_memmap(f'{path}.norms.npy', mode='w+', dtype=np.float32, shape=(total,))
+            row, chunk = 0, self.shared_config['COPY_CHUNK_ROWS']
+            for start in range(0, len(base_labels), chunk):
+                rows = keep[start:start + chunk]
+                count = int(rows.sum())
+                out_encodings[row:row + count] = base_encodings[start:start + chunk][rows]
+                out_labels[row:row + count] = base_labels[start:start + chunk][rows]
+                out_norms[row:row + count] = base_norms[start:start + chunk][rows]
+                row += count
+            for profile_id, encodings in added:
+                out_encodings[row:row + len(encodings)] = encodings
+                out_labels[row:row + len(encodings)] = profile_id
+                out_norms[row:row + len(encodings)] = np.einsum('ij,ij->i', encodings, encodings)
+                row += len(encodings)
+            for array in (out_encodings, out_labels, out_norms):
+                array.flush()
+
+            ids = np.load(f'{base}.ids.npy', mmap_mode='r')
+            offsets = np.load(f'{base}.name_offsets.npy', mmap_mode='r')
+            blob = np.load(f'{base}.names.npy', mmap_mode='r')
+            changes = {profile_id: name for profile_id, (_, name) in pending.items()}
+            self._write_names(path, *merge_names(ids, offsets, blob, changes))
+            save_meta(f'{path}.meta.json', {'max_per_label': max_per_label})
+
+        return self._publish(write)
+
+    @staticmethod
+    def _write_names(path, ids, offsets, blob):
+        np.save(f'{path}.ids.npy', ids)
+        np.save(f'{path}.name_offsets.npy', offsets)
+        np.save(f'{path}.names.npy', blob)
+
+    def _publish(self, write):
+        """
+        Writes the next version with `write(path)` into a temporary
+        directory, renames it into place and points CURRENT at it. Must be
+        called under the write lock.
+        """
+        versions = sorted(name for name in os.listdir(self.directory) if VERSION_PATTERN.match(name))
+        version = f'v{int(versions[-1][1:]) + 1 if versions else 1:06d}'
+        tmp_dir = os.path.join(self.directory, f'.{version}.tmp')
+        shutil.rmtree(tmp_dir, ignore_errors=True)  # Left over by an interrupted export
+        os.makedirs(tmp_dir)
+        with timed('gallery_export'):
+            write(os.path.join(tmp_dir, 'gallery'))
+        os.rename(tmp_dir, os.path.join(self.directory, version))
+
+        current_path = os.path.join(self.directory, 'CURRENT')
+        with open(f'{current_path}.tmp', 'w') as f:
+            f.write(version)
+        os.replace(f'{current_path}.tmp', current_path)
+
+        # Workers still mapping a removed version keep their mapping until they switch
+        for old in (versions + [version])[:-self.shared_config['KEEP_VERSIONS']]:
+            shutil.rmtree(os.path.join(self.directory, old), ignore_errors=True)
+        logger.info(f"Shared gallery exported: {version}")
+        return version
+
+
+def _flush_at_exit(gallery_ref):
+    # The export timer is a daemon thread, so a short-lived process would exit without exporting
+    gallery = gallery_ref()
+    if gallery is not None:
+        gallery.flush()
+
+
+_gallery = None
+_gallery_lock = threading.Lock()
+
+
+def get_gallery():
+    """
+    Returns the process-wide gallery index: a SharedGalleryIndex when
+    settings.FACE_SHARED_GALLERY is enabled, otherwise a GalleryIndex
+    private to this process.
+    """
+    global _gallery
+    if _gallery is None:
+        with _gallery_lock:
+            if _gallery is None:
+                _gallery = SharedGalleryIndex() if get_shared_gallery_config()['ENABLED'] else GalleryIndex()
+    return _gallery
@@ -0,0 +1,221 @@
+import threading
+import time
+from collections import Counter, OrderedDict
+
+import cv2
+import numpy as np
+from django.conf import settings
+
+from .metrics import register_collector
+from .utils import image_size, is_blurry
+
+DEFAULT_GATING_CONFIG = {
+    'ENABLED': True,
+    'DECODE_SCALE': 4,  # Frames are decoded straight to 1/2, 1/4 or 1/8 size grayscale
+    'MIN_SHARPNESS': 50.0,  # Laplacian variance of the downsampled frame
+    'MIN_BRIGHTNESS': 40.0,
+    'MAX_BRIGHTNESS': 220.0,
+    'MIN_FRAME_CHANGE': 1.5,  # Mean absolute pixel difference from the client's previous frame
+    'MAX_RESULT_AGE': 5.0,  # Seconds an unchanged frame may reuse the client's previous result
+    'PROBE_MIN_FACE': 24,  # Smallest face, in decoded pixels, the Haar probe can find (its window size)
+    'PROBE_FACE_RATIO': 0.5,  # Smallest face the probe must find, relative to the detector's expected face width
+    'RECOGNITION_STAGES': ['sharpness', 'exposure', 'motion', 'face_probe'],
+    'REGISTRATION_STAGES': ['sharpness', 'exposure'],
+    'MAX_CLIENTS': 1000,
+}
+
+REDUCED_GRAYSCALE_FLAGS = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+
+def get_gating_config():
+    return {**DEFAULT_GATING_CONFIG, **getattr(settings, 'FACE_GATING', {})}
+
+
+class FrameGate:
+    """
+    A cascade of cheap checks run on a small grayscale decode of each frame
+    before it is allowed anywhere near the inference pool.
+
+    Stages run in the order given and the first failing one rejects the
+    frame. Counters record how many frames each stage rejected, i.e. how
+    many detector/encoder invocations the gate saved.
+
+    The face probe gets its own, larger decode when needed: the reduction
+    is picked from the frame width so that the smallest face it must find
+    is still at least the cascade's window after decoding. If even the full
+    size frame is too small for that, the probe is skipped.
+    """
+
+    def __init__(self, config=None):
+        self.config = config or get_gating_config()
+        self._previous = OrderedDict()  # client key -> (thumbnail, last result, result expiry)
+        self._lock = threading.Lock()
+        self._counts = Counter()
+        self._probe = None
+
+    def check(self, image_bytes, stages, client_key=None, face_fraction=None):
+        """
+        Returns None if the frame passed every stage, otherwise the name of
+        the rejecting stage ('invalid_image' if it could not be decoded).
+        `face_fraction` is the detector's expected face width as a fraction
+        of the frame width; without it the probe runs on the full frame.
+        """
+        self._count('frames')
+        reduction = self.config['DECODE_SCALE']
+        probe_reduction = reduction
+        if 'face_probe' in stages:
+            size = image_size(image_bytes)
+            probe_reduction = self.probe_reduction(size[1], face_fraction) if size and face_fraction else 1
+
+        decoded_reduction = min(reduction, probe_reduction or reduction)
+        decoded = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), REDUCED_GRAYSCALE_FLAGS[decoded_reduction])
+        if decoded is None:
+            return self._reject('invalid_image')
+        gray = decoded
+        if decoded_reduction < reduction:
+            # The other stages keep seeing the DECODE_SCALE frame their thresholds are tuned for
+            factor = decoded_reduction / reduction
+            gray = cv2.resize(decoded, None, fx=factor, fy=factor, interpolation=cv2.INTER_AREA)
+
+        for stage in stages:
+            if stage == 'face_probe':
+                if probe_reduction is not None and not self._check_face_probe(decoded, client_key):
+                    return self._reject(stage)
+            elif not getattr(self, f'_check_{stage}')(gray, client_key):
+                return self._reject(stage)
+
+        self._count('passed')
+        return None
+
+    def probe_reduction(self, width, face_fraction):
+        """
+        The largest decode reduction, up to DECODE_SCALE, at which the face
+        probe still sees the smallest face it must find in a frame `width`
+        pixels wide, or None if that face is too small even at full size.
+        """
+        smallest_face = width * face_fraction * self.config['PROBE_FACE_RATIO']
+        if smallest_face < self.config['PROBE_MIN_FACE']:
+            return None
+        return next(reduction for reduction in (8, 4, 2, 1)
+                    if reduction <= self.config['DECODE_SCALE']
+                    and smallest_face / reduction >= self.config['PROBE_MIN_FACE'] or reduction == 1)
+
+    def previous_result(self, client_key):
+        """
+        The client's last result, or None once it is older than MAX_RESULT_AGE.
+        """
+        with self._lock:
+            previous = self._previous.get(client_key)
+        if previous is None or previous[2] < time.monotonic():
+            return None
+        return previous[1]
+
+    def remember_result(self, client_key, result):
+        if client_key is None:
+            return
+        with self._lock:
+            if client_key in self._previous:
+                expires_at = time.monotonic() + self.config['MAX_RESULT_AGE']
+                self._previous[client_key] = (self._previous[client_key][0], result, expires_at)
+
+    def discard(self, client_key):
+        with self._lock:
+            self._previous.pop(client_key, None)
+
+    def invalidate(self):
+        """
+        Forgets every client's previous frame and result, e.g. because a
+        FaceProfile changed and a replayed identity may be wrong.
+        """
+        with self._lock:
+            self._previous.clear()
+
+    def stats(self):
+        """
+        Returns frames seen, frames passed and rejections per stage.
+        """
+        with self._lock:
+            counts = dict(self._counts)
+        frames = counts.pop('frames', 0)
+        passed = counts.pop('passed', 0)
+        return {'frames': frames, 'passed': passed, 'rejected': counts}
+
+    def _check_sharpness(self, gray, client_key):
+        return not is_blurry(gray, threshold=self.config['MIN_SHARPNESS'])
+
+    def _check_exposure(self, gray, client_key):
+        brightness = float(gray.mean())
+        return self.config['MIN_BRIGHTNESS'] <= brightness <= self.config['MAX_BRIGHTNESS']
+
+    def _check_motion(self, gray, client_key):
+        if client_key is None:
+            return True
+
+        thumbnail = cv2.resize(gray, (32, 24), interpolation=cv2.INTER_AREA).astype(np.int16)
+        with self._lock:
+            previous = self._previous.pop(client_key, None)
+            # Only frames that get a result replace the previous one, so slow drift still accumulates
+            if previous is not None and previous[1] is not None and previous[2] >= time.monotonic():
+                change = float(np.abs(thumbnail - previous[0]).mean())
+                if change < self.config['MIN_FRAME_CHANGE']:
+                    self._previous[client_key] = previous
+                    return False
+            self._previous[client_key] = (thumbnail, None, 0.0)
+            while len(self._previous) > self.config['MAX_CLIENTS']:
+                self._previous.popitem(last=False)
+        return True
+
+    def _check_face_probe(self, gray, client_key):
+        if self._probe is None:
+            self._probe = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+        min_face = self.config['PROBE_MIN_FACE']
+        faces = self._probe.detectMultiScale(gray, scaleFactor=1.2, minNeighbors=3, minSize=(min_face, min_face))
+        return len(faces) > 0
+
+    def _count(self, key):
+        with self._lock:
+            self._counts[key] += 1
+
+    def _reject(self, stage):
+        self._count(stage)
+        return stage
+
+
+_gate = None
+_gate_lock = threading.Lock()
+
+
+def get_frame_gate():
+    """
+    Returns the process-wide frame gate, configured by settings.FACE_GATING.
+    """
+    global _gate
+    if _gate is None:
+        with _gate_lock:
+            if _gate is None:
+                _gate = FrameGate()
+    return _gate
+
+
+def render_gate_metrics():
+    stats = get_frame_gate().stats()
+    lines = [
+        '# HELP face_gate_frames_total Frames checked by the pre-filter cascade.',
+        '# TYPE face_gate_frames_total counter',
+        f"face_gate_frames_total {stats['frames']}",
+        '# HELP face_gate_passed_total Frames that passed every gating stage.',
+        '# TYPE face_gate_passed_total counter',
+        f"face_gate_passed_total {stats['passed']}",
+        '# HELP face_gate_rejected_total Frames rejected per gating stage.',
+        '# TYPE face_gate_rejected_total counter',
+    ]
+    lines += [f'face_gate_rejected_total{{stage="{stage}"}} {count}' for stage, count in sorted(stats['rejected'].items())]
+    return lines
+
+
+register_collector(render_gate_metrics)
@@ -0,0 +1,218 @@
+"""
+Inference jobs run by the worker pool (see face_app.workers).
+
+Each job takes encoded image bytes, so only compact payloads cross the
+process boundary, and returns a dict whose 'status' is 'ok' or names the
+stage that rejected the frame, plus the 'timings' of the pipeline stages
+it ran (see face_app.metrics).
+"""
+from functools import wraps
+
+from face_app.detection import default_detection_mode
+from face_app.metrics import collect_timings
+from face_app.pose import pose_matches
+from face_app.utils import FaceAnalysis, decode_image, detect_faces_batch, encode_faces, image_size, is_blurry
+
+
+def reports_timings(job):
+    """
+    Adds the stage timings collected while the job ran to its result dict.
+    """
+    @wraps(job)
+    def wrapper(*args, **kwargs):
+        with collect_timings() as timings:
+            result = job(*args, **kwargs)
+        result['timings'] = timings
+        return result
+    return wrapper
+
+
+def decode_frame(image_bytes, mode, encode=True):
+    """
+    Decodes a frame straight to the smallest size `mode` allows (see
+    DetectionMode.decode_reduction). Returns the image, the reduction and
+    the full-size shape; the image is None if the bytes cannot be decoded.
+    """
+    shape = image_size(image_bytes)
+    reduction = mode.decode_reduction(shape, encode) if shape else 1
+    image = decode_image(image_bytes, reduction)
+    return image, reduction, shape or (image.shape if image is not None else None)
+
+
+def full_size_boxes(boxes, reduction, shape):
+    """
+    Maps (top, right, bottom, left) boxes from a reduced decode back to the
+    full-size frame of `shape`.
+    """
+    h, w = shape[:2]
+    return [(top * reduction, min(right * reduction, w - 1), min(bottom * reduction, h - 1), left * reduction)
+            for top, right, bottom, left in boxes]
+
+
+@reports_timings
+def encode_face_job(image_bytes, mode=None):
+    """
+    Decode -> blur check -> detect -> landmarks -> align -> encode.
+    `mode` (a DetectionMode) picks the detector and its input scale.
+    """
+    mode = mode or default_detection_mode()
+    image, reduction, shape = decode_frame(image_bytes, mode)
+    if image is None:
+        return {'status': 'invalid_image'}
+    if is_blurry(image):
+        return {'status': 'blurry'}
+
+    analysis = FaceAnalysis.detect(image, use_cnn=mode.use_cnn, scale=mode.scale_for(shape) * reduction)
+    detection = mode.describe(shape)
+    if analysis is None:
+        return {'status': 'no_face', 'detection': detection}
+    return {'status': 'ok', 'encoding': analysis.encoding, 'detection': detection}
+
+
+@reports_timings
+def register_face_job(image_bytes, pose, mode=None):
+    """
+    Like `encode_face_job`, but first checks that the head is in `pose`
+    (see face_app.pose) before spending time on the encoding.
+    """
+    mode = mode or default_detection_mode()
+    image, reduction, shape = decode_frame(image_bytes, mode)
+    if image is None:
+        return {'status': 'invalid_image'}
+    if is_blurry(image):
+        return {'status': 'blurry'}
+
+    analysis = FaceAnalysis.detect(image, use_cnn=mode.use_cnn, scale=mode.scale_for(shape) * reduction)
+    detection = mode.describe(shape)
+    if analysis is None:
+        return {'status': 'no_face', 'detection': detection}
+    if not pose_matches(analysis.landmarks, pose, image.shape[1]):
+        return {'status': 'bad_pose', 'detection': detection}
+    return {'status': 'ok', 'encoding': analysis.encoding, 'detection': detection}
+
+
+@reports_timings
+def encode_all_faces_job(image_bytes, mode=None):
+    """
+    Decode -> blur check -> detect -> encode every face in the frame, with
+    a single encoder call for all of them.
+    """
+    mode = mode or default_detection_mode()
+    image, reduction, shape = decode_frame(image_bytes, mode)
+    if image is None:
+        return {'status': 'invalid_image'}
+    if is_blurry(image):
+        return {'status': 'blurry'}
+
+    boxes = detect_faces_batch([image], use_cnn=mode.use_cnn, scale=mode.scale_for(shape) * reduction)[0]
+    detection = mode.describe(shape)
+    if not boxes:
+        return {'status': 'no_face', 'detection': detection}
+    return {'status': 'ok', 'boxes': full_size_boxes(boxes, reduction, shape), 'encodings': encode_faces(image, boxes),
+            'detection': detection}
+
+
+@reports_timings
+def encode_faces_batch_job(payloads, mode=None):
+    """
+    Batched `encode_face_job`. Returns one result dict per payload under
+    'results'. Surviving frames are grouped by size, and each group is
+    detected in a single dlib batch at the scale chosen for that size, so
+    every result that got as far as detection describes its own.
+    """
+    results = [None] * len(payloads)
+    candidates, images = [], []
+    for index, image_bytes in enumerate(payloads):
+        image = decode_image(image_bytes)
+        if image is None:
+            results[index] = {'status': 'invalid_image'}
+        elif is_blurry(image):
+            results[index] = {'status': 'blurry'}
+        else:
+            candidates.append(index)
+            images.append(image)
+
+    if not images:
+        return {'status': 'ok', 'results': results}
+
+    mode = mode or default_detection_mode()
+    groups = {}
+    for index, image in zip(candidates, images):
+        groups.setdefault(image.shape, []).append((index, image))
+    for shape, group in groups.items():
+        group_images = [image for _, image in group]
+        batch_locations = detect_faces_batch(group_images, use_cnn=mode.use_cnn, scale=mode.scale_for(shape))
+        detection = mode.describe(shape)
+        for (index, image), locations in zip(group, batch_locations):
+            if locations:
+                results[index] = {'status': 'ok', 'encoding': FaceAnalysis(image, locations[0]).encoding,
+                                  'detection': detection}
+            else:
+                results[index] = {'status': 'no_face', 'detection': detection}
+    return {'status': 'ok', 'results': results}
+
+
+@reports_timings
+def detect_faces_job(image_bytes, mode=None):
+    """
+    Decode -> blur check -> cheap detection only. Returns the full-resolution
+    boxes of every face, for frame-to-frame tracking. HOG unless `mode` says
+    otherwise.
+    """
+    mode = mode or default_detection_mode('hog')
+    # Only boxes are needed, so the frame is decoded at about the detector's input size
+    image, reduction, shape = decode_frame(image_bytes, mode, encode=False)
+    if image is None:
+        return {'status': 'invalid_image'}
+    if is_blurry(image):
+        return {'status': 'blurry'}
+
+    boxes = detect_faces_batch([image], use_cnn=mode.use_cnn, scale=mode.scale_for(shape) * reduction)[0]
+    return {'status': 'ok', 'boxes': full_size_boxes(boxes, reduction, shape), 'detection': mode.describe(shape)}
+
+
+@reports_timings
+def encode_location_job(image_bytes, location):
+    """
+    Landmarks -> align -> encode for a face whose box is already known.
+    """
+    image = decode_image(image_bytes)
+    if image is None:
+        return {'status': 'invalid_image'}
+    return {'status': 'ok', 'encoding': FaceAnalysis(image, tuple(location)).encoding}
+
+
+@reports_timings
+def encode_locations_job(image_bytes, locations):
+    """
+    Encodes several faces whose boxes are already known in one encoder call.
+    """
+    image = decode_image(image_bytes)
+    if image is None:
+        return {'status': 'invalid_image'}
+    return {'status': 'ok', 'encodings': encode_faces(image, locations)}
+
+
+@reports_timings
+def enroll_image_job(path, use_cnn=True, scale=0.25):
+    """
+    Read -> blur check -> detect -> align -> encode for one enrollment
+    photo on disk. Photos with more than one face are rejected rather than
+    guessing which face belongs to the employee.
+    """
+    try:
+        with open(path, 'rb') as f:
+            image = decode_image(f.read())
+    except OSError:
+        image = None
+    if image is None:
+        return {'status': 'invalid_image'}
+    if is_blurry(image):
+        return {'status': 'blurry'}
+
+    locations = detect_faces_batch([image], use_cnn=use_cnn, scale=scale)[0]
+    if not locations:
+        return {'status': 'no_face'}
+    if len(locations) > 1:
+        return {'status': 'multiple_faces'}
+    return {'status': 'ok', 'encoding': FaceAnalysis(image, locations[0]).encoding}
@@ -0,0 +1,30 @@
+import cv2
+from django.core.management.base import BaseCommand, CommandError
+
+from face_app.benchmarks import bench_pipeline
+
+
+class Command(BaseCommand):
+    help = 'Compares per-frame CPU time of the legacy and single-pass (FaceAnalysis) face pipelines.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('image', help='Path to a photo containing one face.')
+        parser.add_argument('--repeats', type=int, default=10)
+        parser.add_argument('--hog', action='store_true', help='Use HOG instead of CNN detection.')
+
+    def handle(self, *args, **options):
+        image = cv2.imread(options['image'])
+        if image is None:
+            raise CommandError(f"Could not read image {options['image']}")
+
+        try:
+            rows = bench_pipeline(image, options['repeats'], use_cnn=not options['hog'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        for row in rows:
+            speedup = f"  speedup {row['speedup']:.2f}x" if 'speedup' in row else ''
+            self.stdout.write(
+                f"{row['pipeline']:<8} {row['model']}  scale={row['scale']}  "
+                f"mean {row['mean_ms']:.1f} ms  p50 {row['p50_ms']:.1f} ms  p95 {row['p95_ms']:.1f} ms{speedup}"
+            )
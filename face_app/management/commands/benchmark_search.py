@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from face_app.benchmarks import bench_search
+
+
+class Command(BaseCommand):
+    help = 'Reports recall@1 and query latency of the IVF and sharded search backends against exact search.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profiles', type=int, nargs='+', default=[10000, 100000])
+        parser.add_argument('--samples', type=int, default=5, help='Encodings per profile.')
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 16, 64])
+        parser.add_argument('--nlist', type=int, default=None, help='IVF lists (default: 4 * sqrt(encodings)).')
+        parser.add_argument('--shards', type=int, nargs='*', default=[],
+                            help='Also run ShardedSearch with each of these shard counts.')
+
+    def handle(self, *args, **options):
+        header = f"{'backend':<8}{'profiles':>10}{'nlist':>7}{'nprobe':>8}{'shards':>8}{'recall@1':>10}{'p50 ms':>9}{'p95 ms':>9}{'build s':>9}"
+        self.stdout.write(header)
+        for n_profiles in options['profiles']:
+            rows = bench_search(n_profiles, options['samples'], options['queries'], options['nprobe'], options['nlist'],
+                                shard_counts=options['shards'])
+            for row in rows:
+                self.stdout.write(
+                    f"{row['backend']:<8}{row['profiles']:>10}{row.get('nlist') or '-':>7}{row['nprobe'] or '-':>8}"
+                    f"{row.get('shards') or '-':>8}"
+                    f"{row['recall_at_1']:>10.3f}{row['p50_ms']:>9.3f}{row['p95_ms']:>9.3f}{row['build_s']:>9.2f}"
+                )
@@ -0,0 +1,28 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from face_app.benchmarks import bench_startup
+
+
+class Command(BaseCommand):
+    help = 'Measures cold-start time and per-process memory with lazy, inline, spawn and forkserver model loading.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=2, help='Inference workers for the pool scenarios.')
+        parser.add_argument('--json', action='store_true', help='Print the raw results as JSON.')
+
+    def handle(self, *args, **options):
+        rows = bench_startup(workers=options['workers'])
+        if options['json']:
+            self.stdout.write(json.dumps(rows, indent=2))
+            return
+
+        for row in rows:
+            process = row['process']
+            line = (f"{row['scenario']:<16} import {row['import_s']:6.2f} s  ready {row['ready_s']:6.2f} s  "
+                    f"web rss {process['rss_mb']:6.0f} MB")
+            for index, worker in enumerate(row.get('workers', [])):
+                pss = f" pss {worker['pss_mb']:.0f}" if 'pss_mb' in worker else ''
+                line += f"  worker{index} rss {worker['rss_mb']:.0f}{pss} MB"
+            self.stdout.write(line)
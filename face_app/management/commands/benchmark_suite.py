@@ -0,0 +1,55 @@
+import json
+
+import cv2
+from django.core.management.base import BaseCommand, CommandError
+
+from face_app.benchmarks import compare_reports, run_suite
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks each face pipeline stage, gallery matching and the test_face view. '
+            'Writes a JSON report and optionally flags regressions against a baseline report.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('image', help='Path to a photo containing one face.')
+        parser.add_argument('--output', help='Write the JSON report to this file (default: stdout).')
+        parser.add_argument('--baseline', help='A previous JSON report to compare against.')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Allowed p50 slowdown before a stage counts as a regression (0.2 = 20%%).')
+        parser.add_argument('--repeats', type=int, default=5)
+        parser.add_argument('--widths', type=int, nargs='+', default=[320, 640, 1280])
+        parser.add_argument('--models', nargs='+', choices=['hog', 'cnn'], default=['hog', 'cnn'])
+        parser.add_argument('--gallery-sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+        parser.add_argument('--skip-end-to-end', action='store_true',
+                            help='Do not POST frames to test_face through the test client.')
+
+    def handle(self, *args, **options):
+        image = cv2.imread(options['image'])
+        if image is None:
+            raise CommandError(f"Could not read image {options['image']}")
+
+        report = run_suite(image, options['repeats'], options['widths'], options['models'],
+                           options['gallery_sizes'], end_to_end=not options['skip_end_to_end'])
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+            report['comparison'] = compare_reports(report, baseline, options['tolerance'])
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+            for row in report['results']:
+                params = ' '.join(f'{key}={value}' for key, value in row['params'].items())
+                self.stdout.write(f"{row['stage']:<18}{params:<36}p50 {row['p50_ms']:>9.3f} ms  "
+                                  f"p95 {row['p95_ms']:>9.3f} ms")
+        else:
+            self.stdout.write(json.dumps(report, indent=2))
+
+        regressions = [row for row in report.get('comparison', []) if row['regression']]
+        for row in regressions:
+            params = ' '.join(f'{key}={value}' for key, value in row['params'].items())
+            self.stderr.write(f"Regression: {row['stage']} {params} p50 {row['baseline']:.3f} -> "
+                              f"{row['current']:.3f} ms ({row['change']:+.0%})")
+        if regressions:
+            raise CommandError(f'{len(regressions)} stage(s) regressed by more than {options["tolerance"]:.0%}.')
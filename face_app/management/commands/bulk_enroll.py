@@ -0,0 +1,214 @@
+import csv
+import multiprocessing
+import os
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from face_app.gallery import get_gallery, get_shared_gallery_config
+from face_app.jobs import enroll_image_job
+from face_app.models import EnrollmentCheckpoint, FaceProfile
+from face_app.workers import _init_worker, get_inference_config
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.webp'}
+
+
+def read_manifest(source):
+    """
+    Returns the (name, path) pairs to enroll, in a stable order. `source` is
+    either a directory of photos named after each person, or a CSV file with
+    `name` and `path` columns (relative paths are resolved against the CSV's
+    directory).
+    """
+    if os.path.isdir(source):
+        entries = []
+        for entry in sorted(os.scandir(source), key=lambda e: e.name):
+            stem, extension = os.path.splitext(entry.name)
+            if entry.is_file() and extension.lower() in IMAGE_EXTENSIONS:
+                entries.append((stem.replace('_', ' '), entry.path))
+        return entries
+
+    base_dir = os.path.dirname(os.path.abspath(source))
+    with open(source, newline='') as f:
+        reader = csv.DictReader(f)
+        if not {'name', 'path'} <= set(reader.fieldnames or []):
+            raise CommandError("The CSV manifest needs 'name' and 'path' columns.")
+        return [(row['name'].strip(), os.path.join(base_dir, row['path'])) for row in reader]
+
+
+class Checkpoint:
+    """
+    Progress through a manifest, kept in an EnrollmentCheckpoint row.
+
+    The row is saved inside the transaction that creates each batch of
+    profiles, so a crash keeps both or neither and an interrupted run
+    resumes exactly after the last committed batch.
+    """
+
+    def __init__(self, source, key=None):
+        self.source = os.path.abspath(source)
+        self.key = key or self.source
+        self.position = 0
+        self.enrolled = 0
+        self.failures = Counter()
+
+    def load(self):
+        record = EnrollmentCheckpoint.objects.filter(key=self.key).first()
+        if record is None:
+            return False
+        if record.source != self.source:
+            raise CommandError(f"Checkpoint {self.key} belongs to {record.source}; use --checkpoint or --restart.")
+        self.position = record.position
+        self.enrolled = record.enrolled
+        self.failures = Counter(record.failures)
+        return True
+
+    def save(self):
+        EnrollmentCheckpoint.objects.update_or_create(key=self.key, defaults={
+            'source': self.source, 'position': self.position, 'enrolled': self.enrolled,
+            'failures': dict(self.failures),
+        })
+
+
+class Command(BaseCommand):
+    help = 'Enrolls one FaceProfile per photo from a directory or CSV manifest, encoding across a process pool.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', help='Directory of photos named after each person, or a CSV with name,path columns.')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Encoding processes (defaults to FACE_INFERENCE WORKERS).')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Photos per bulk_create and checkpoint.')
+        parser.add_argument('--checkpoint', default=None,
+                            help='Name of the progress record (defaults to the absolute source path).')
+        parser.add_argument('--failures', default=None, help='Append rejected photos to this CSV file.')
+        parser.add_argument('--restart', action='store_true', help='Ignore an existing checkpoint.')
+        parser.add_argument('--scale', type=float, default=0.25,
+                            help='Downscale factor for detection; raise it for small photos.')
+        parser.add_argument('--hog', action='store_true', help='Use HOG instead of CNN detection.')
+
+    def handle(self, *args, **options):
+        source = options['source'].rstrip(os.sep)
+        if not os.path.exists(source):
+            raise CommandError(f'{source} does not exist.')
+
+        entries = read_manifest(source)
+        checkpoint = Checkpoint(source, options['checkpoint'])
+        if not options['restart'] and checkpoint.load():
+            self.stdout.write(f'Resuming from checkpoint at {checkpoint.position}/{len(entries)}')
+        if checkpoint.position >= len(entries):
+            self.stdout.write('Nothing left to enroll.')
+            return
+
+        workers = options['workers'] or get_inference_config()['WORKERS'] or 1
+        config = get_inference_config()
+        context = multiprocessing.get_context(config['START_METHOD'])
+        if config['START_METHOD'] == 'forkserver' and config['PRELOAD_MODELS']:
+            context.set_forkserver_preload(['face_recognition'])
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker) as executor:
+            try:
+                self.enroll(executor, entries, checkpoint, options, max_in_flight=workers * 4)
+            except KeyboardInterrupt:
+                executor.shutdown(wait=False, cancel_futures=True)
+                self.stderr.write(f'Interrupted; rerun to resume from {checkpoint.position}/{len(entries)}.')
+                return
+
+        failed = sum(checkpoint.failures.values())
+        self.stdout.write(self.style.SUCCESS(
+            f'Done: {checkpoint.enrolled} enrolled, {failed} failed ({self.format_failures(checkpoint.failures)}).'
+        ))
+        # bulk_create sends no post_save signals, so running servers keep their old gallery
+        if get_shared_gallery_config()['ENABLED']:
+            get_gallery().rebuild()
+            self.stdout.write('Exported a new shared gallery version; web workers switch to it within '
+                              f"{get_shared_gallery_config()['POLL_INTERVAL']}s.")
+        else:
+            self.stdout.write('Restart running web workers to load the new profiles into their gallery index.')
+
+    def enroll(self, executor, entries, checkpoint, options, max_in_flight):
+        """
+        Streams photos through the pool in manifest order, committing a batch
+        of profiles and the checkpoint every `batch_size` photos. Results are
+        consumed in order, so the checkpoint is a single position.
+        """
+        use_cnn = not options['hog']
+        scale = options['scale']
+        batch_size = options['batch_size']
+        remaining = iter(entries[checkpoint.position:])
+        in_flight = deque()
+        profiles, rejected = [], []
+        processed = 0
+        started = time.monotonic()
+
+        def fill():
+            while len(in_flight) < max_in_flight:
+                entry = next(remaining, None)
+                if entry is None:
+                    return
+                in_flight.append((entry, executor.submit(enroll_image_job, entry[1], use_cnn, scale)))
+
+        fill()
+        try:
+            while in_flight:
+                (name, path), future = in_flight.popleft()
+                result = future.result()
+                fill()
+
+                if result['status'] == 'ok':
+                    profile = FaceProfile(name=name)
+                    profile.set_encodings(result['encoding'][None, :])
+                    profiles.append(profile)
+                else:
+                    rejected.append((name, path, result['status']))
+                processed += 1
+
+                if processed % batch_size == 0:
+                    self.commit(checkpoint, profiles, rejected, options['failures'])
+                    profiles, rejected = [], []
+                    self.report(checkpoint, len(entries), processed, started)
+        finally:
+            # Whatever was already encoded is committed, even on interrupt
+            self.commit(checkpoint, profiles, rejected, options['failures'])
+
+        self.report(checkpoint, len(entries), processed, started)
+
+    def commit(self, checkpoint, profiles, rejected, failures_path):
+        """
+        Creates `profiles` and advances the checkpoint past them and the
+        `rejected` photos in one transaction, then records the rejections.
+        """
+        if not profiles and not rejected:
+            return
+        position, enrolled, failures = checkpoint.position, checkpoint.enrolled, checkpoint.failures.copy()
+        checkpoint.position += len(profiles) + len(rejected)
+        checkpoint.enrolled += len(profiles)
+        checkpoint.failures.update(status for _, _, status in rejected)
+        try:
+            with transaction.atomic():
+                FaceProfile.objects.bulk_create(profiles)
+                checkpoint.save()
+        except Exception:
+            checkpoint.position, checkpoint.enrolled, checkpoint.failures = position, enrolled, failures
+            raise
+
+        if failures_path and rejected:
+            with open(failures_path, 'a', newline='') as f:
+                csv.writer(f).writerows(rejected)
+
+    def report(self, checkpoint, total, processed, started):
+        elapsed = time.monotonic() - started
+        rate = processed / elapsed if elapsed else 0.0
+        eta = timedelta(seconds=round((total - checkpoint.position) / rate)) if rate else 'unknown'
+        self.stdout.write(
+            f'{checkpoint.position}/{total}  enrolled {checkpoint.enrolled}  '
+            f'failed {sum(checkpoint.failures.values())} ({self.format_failures(checkpoint.failures)})  '
+            f'{rate:.1f} photos/s  ETA {eta}'
+        )
+
+    @staticmethod
+    def format_failures(failures):
+        return ', '.join(f'{status}: {count}' for status, count in sorted(failures.items())) or 'none'
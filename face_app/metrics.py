@@ -0,0 +1,191 @@
+"""
+Lightweight in-process metrics with Prometheus text exposition.
+
+Pipeline stages are timed with `timed(stage)`. Inside inference workers
+the timings are collected per job (see `collect_timings`) and shipped back
+with the job result, so every histogram lives in the web process that
+serves /metrics.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import ContextDecorator, contextmanager
+from functools import wraps
+from inspect import iscoroutinefunction
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [per-bucket counts (last is +Inf), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((labels, list(counts), total) for labels, (counts, total) in self._series.items())
+        for labels, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}')
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f'{self.name}_sum{label_text} {total}')
+            lines.append(f'{self.name}_count{label_text} {cumulative}')
+        return lines
+
+
+STAGE_SECONDS = Histogram('face_stage_seconds', 'Time spent in each face pipeline stage.', ['stage'])
+REQUEST_SECONDS = Histogram('face_request_seconds', 'Latency of the face endpoints.', ['endpoint', 'method'])
+OUTCOMES = Counter('face_outcomes_total', 'Results of the face pipelines.', ['pipeline', 'outcome'])
+DETECTION_MODES = Counter('face_detection_mode_total', 'Detection jobs per detector and selection reason.',
+                          ['model', 'reason'])
+RECOGNITION_CACHE = Counter('face_recognition_cache_total', 'Recognition cache lookups per level and result.',
+                            ['level', 'result'])
+
+REGISTRY = [STAGE_SECONDS, REQUEST_SECONDS, OUTCOMES, DETECTION_MODES, RECOGNITION_CACHE]
+_collectors = []
+_local = threading.local()
+
+
+def register_collector(collector):
+    """
+    Adds a callable returning extra exposition lines to every /metrics scrape.
+    """
+    _collectors.append(collector)
+
+
+def render_metrics():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    for collector in _collectors:
+        lines.extend(collector())
+    return '\n'.join(lines) + '\n'
+
+
+class timed(ContextDecorator):
+    """
+    Times a pipeline stage, as a context manager or decorator. While a job
+    is collecting timings (inside an inference worker) the measurement is
+    added to the job's timings instead of the local histogram.
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def _recreate_cm(self):
+        # A fresh timer per decorated call, so concurrent calls do not share `start`
+        return timed(self.stage)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        timings = getattr(_local, 'timings', None)
+        if timings is None:
+            STAGE_SECONDS.observe(elapsed, self.stage)
+        else:
+            timings.append((self.stage, elapsed))
+        return False
+
+
+@contextmanager
+def collect_timings():
+    """
+    Collects the `timed` stages run by the current thread into a list of
+    (stage, seconds) pairs, to be returned with a job's result.
+    """
+    previous = getattr(_local, 'timings', None)
+    _local.timings = timings = []
+    try:
+        yield timings
+    finally:
+        _local.timings = previous
+
+
+def record_timings(timings):
+    """
+    Adds timings collected in an inference worker to the stage histograms.
+    """
+    for stage, seconds in timings:
+        STAGE_SECONDS.observe(seconds, stage)
+
+
+def count_outcome(pipeline, outcome):
+    OUTCOMES.inc(pipeline, outcome)
+
+
+def timed_endpoint(endpoint):
+    """
+    View decorator recording the latency of every request, sync or async.
+    """
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await view(request, *args, **kwargs)
+                finally:
+                    REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint, request.method)
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return view(request, *args, **kwargs)
+            finally:
+                REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint, request.method)
+        return wrapper
+    return decorator
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.16 on 2024-10-17 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('face_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='faceprofile',
+            name='face_encoding',
+        ),
+        migrations.AddField(
+            model_name='faceprofile',
+            name='face_encodings',
+            field=models.TextField(default=''),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='faceprofile',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
@@ -0,0 +1,57 @@
+import json
+
+import numpy as np
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+
+def json_to_binary(apps, schema_editor):
+    FaceProfile = apps.get_model('face_app', 'FaceProfile')
+    batch = []
+    for profile in FaceProfile.objects.filter(encoding_data__isnull=True).exclude(face_encodings='').iterator():
+        encodings = np.array(json.loads(profile.face_encodings), dtype='<f4')
+        profile.encoding_data = encodings.tobytes()
+        profile.face_encodings = ''
+        batch.append(profile)
+        if len(batch) >= BATCH_SIZE:
+            FaceProfile.objects.bulk_update(batch, ['encoding_data', 'face_encodings'])
+            batch = []
+    if batch:
+        FaceProfile.objects.bulk_update(batch, ['encoding_data', 'face_encodings'])
+
+
+def binary_to_json(apps, schema_editor):
+    FaceProfile = apps.get_model('face_app', 'FaceProfile')
+    batch = []
+    for profile in FaceProfile.objects.filter(encoding_data__isnull=False).iterator():
+        encodings = np.frombuffer(profile.encoding_data, dtype='<f4').reshape(-1, 128)
+        profile.face_encodings = json.dumps(encodings.tolist())
+        profile.encoding_data = None
+        batch.append(profile)
+        if len(batch) >= BATCH_SIZE:
+            FaceProfile.objects.bulk_update(batch, ['encoding_data', 'face_encodings'])
+            batch = []
+    if batch:
+        FaceProfile.objects.bulk_update(batch, ['encoding_data', 'face_encodings'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('face_app', '0002_remove_faceprofile_face_encoding_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='faceprofile',
+            name='encoding_data',
+            field=models.BinaryField(editable=False, null=True),
+        ),
+        migrations.AlterField(
+            model_name='faceprofile',
+            name='face_encodings',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.RunPython(json_to_binary, binary_to_json),
+    ]
@@ -2,17 +2,55 @@ from django.db import models
 import numpy as np
 import json
 
+ENCODING_DTYPE = np.dtype('<f4')
+ENCODING_SIZE = 128
+
+
+def pack_encodings(encodings):
+    """
+    Packs a list of face encodings into little-endian float32 bytes.
+    """
+    return np.ascontiguousarray(encodings, dtype=ENCODING_DTYPE).tobytes()
+
+
+def unpack_encodings(data):
+    """
+    Decodes packed float32 bytes without copying. The returned array is a
+    read-only view onto `data`.
+    """
+    return np.frombuffer(data, dtype=ENCODING_DTYPE).reshape(-1, ENCODING_SIZE)
+
+
 class FaceProfile(models.Model):
     name = models.CharField(max_length=100)
-    face_encodings = models.TextField()  # Store multiple encodings as a JSON string
+    face_encodings = models.TextField(blank=True, default='')  # Legacy JSON storage, only read as a fallback
+    encoding_data = models.BinaryField(null=True, editable=False)  # Multiple encodings as packed float32
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     def set_encodings(self, encodings):
-        self.face_encodings = json.dumps([enc.tolist() for enc in encodings])
+        self.encoding_data = pack_encodings(encodings)
+        self.face_encodings = ''
 
     def get_encodings(self):
-        return np.array(json.loads(self.face_encodings))
+        if self.encoding_data:
+            return unpack_encodings(self.encoding_data)
+        if self.face_encodings:
+            return np.array(json.loads(self.face_encodings), dtype=ENCODING_DTYPE).reshape(-1, ENCODING_SIZE)
+        return np.empty((0, ENCODING_SIZE), dtype=ENCODING_DTYPE)
+
+    def __str__(self):
+        return self.name
+
+
+class EnrollmentCheckpoint(models.Model):
+    # Progress of a bulk_enroll run, saved in the same transaction as each batch of profiles
+    key = models.CharField(max_length=255, unique=True)
+    source = models.TextField()
+    position = models.PositiveIntegerField(default=0)
+    enrolled = models.PositiveIntegerField(default=0)
+    failures = models.JSONField(default=dict)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
-        return self.name
\ No newline at end of file
+        return f'{self.key}: {self.position}'
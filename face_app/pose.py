@@ -0,0 +1,91 @@
+"""
+Head pose features from 68-point face landmarks.
+
+The landmark parts the pose checks need are stacked into one array per
+face, and every feature is computed for a whole batch in one vectorized
+pass:
+
+- roll: angle of the eye line, in degrees
+- yaw: horizontal position of the nose tip between the eye centres
+  (0 at the left eye, 1 at the right eye)
+- pitch: eye-centre to top-lip distance in pixels, rescaled to a frame
+  REFERENCE_FRAME_WIDTH wide
+
+Roll and yaw are scale free. Pitch is not: it keeps the original pixel
+thresholds, which were tuned on 400 px wide registration captures, and
+only rescales the measured distance to that width. The thresholds hold
+across frame sizes and decode reductions, but the result still depends on
+how far the subject is from the camera, as it did before. A pose is
+accepted when every feature lies inside its bounds in POSE_BOUNDS, so
+classifying a batch is a single table comparison.
+"""
+import numpy as np
+
+LANDMARK_PARTS = ('left_eye', 'right_eye', 'nose_tip', 'top_lip')
+LEFT_EYE, RIGHT_EYE, NOSE_TIP, TOP_LIP = slice(0, 6), slice(6, 12), slice(12, 17), slice(17, 29)
+LANDMARK_POINTS = 29
+
+FEATURES = ('roll', 'yaw', 'pitch')
+
+# Width of the registration capture the pitch thresholds were tuned on, at
+# the subject distance of that capture
+REFERENCE_FRAME_WIDTH = 400.0
+
+POSES = ('front', 'left', 'right', 'up', 'down')
+
+# Open (low, high) bounds per pose and feature, in FEATURES order
+POSE_BOUNDS = np.array([
+    # roll             yaw                 pitch
+    [[-15.0, 15.0], [-np.inf, np.inf], [-np.inf, np.inf]],  # front
+    [[-np.inf, np.inf], [0.30, np.inf], [-np.inf, np.inf]],  # left
+    [[-np.inf, np.inf], [-np.inf, 0.30], [-np.inf, np.inf]],  # right
+    [[-np.inf, np.inf], [-np.inf, np.inf], [-np.inf, 55.0]],  # up
+    [[-np.inf, np.inf], [-np.inf, np.inf], [50.0, 62.0]],  # down
+])
+
+
+def landmarks_array(landmarks):
+    """
+    Stacks the parts of a face_recognition landmark dict used for pose
+    estimation into a (29, 2) float array.
+    """
+    return np.array([point for part in LANDMARK_PARTS for point in landmarks[part]], dtype=np.float64)
+
+
+def pose_features(points, frame_width):
+    """
+    Returns the (n, 3) roll, yaw and pitch of (n, 29, 2) landmark arrays
+    (see `landmarks_array`) found in frames `frame_width` pixels wide (a
+    scalar or one width per face).
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, LANDMARK_POINTS, 2)
+    left_eye = points[:, LEFT_EYE].mean(axis=1)
+    right_eye = points[:, RIGHT_EYE].mean(axis=1)
+    nose_tip = points[:, NOSE_TIP.start]
+    mouth = points[:, TOP_LIP].mean(axis=1)
+
+    eye_line = right_eye - left_eye
+    with np.errstate(divide='ignore', invalid='ignore'):
+        roll = np.degrees(np.arctan2(eye_line[:, 1], eye_line[:, 0]))
+        yaw = (nose_tip[:, 0] - left_eye[:, 0]) / eye_line[:, 0]
+    eye_mouth_distance = np.linalg.norm((left_eye + right_eye) / 2 - mouth, axis=1)
+    pitch = eye_mouth_distance * (REFERENCE_FRAME_WIDTH / np.asarray(frame_width, dtype=np.float64))
+    return np.stack([roll, yaw, pitch], axis=1)
+
+
+def classify_poses(features):
+    """
+    Returns an (n, len(POSES)) boolean array: whether each face's features
+    fall inside the bounds of each pose. Undefined features match nothing.
+    """
+    features = np.asarray(features, dtype=np.float64).reshape(-1, 1, len(FEATURES))
+    inside = (features > POSE_BOUNDS[:, :, 0]) & (features < POSE_BOUNDS[:, :, 1])
+    return inside.all(axis=2)
+
+
+def pose_matches(landmarks, pose, frame_width):
+    """
+    Whether a single face, given as a face_recognition landmark dict found
+    in a frame `frame_width` pixels wide, is in `pose`.
+    """
+    return bool(classify_poses(pose_features(landmarks_array(landmarks), frame_width))[0, POSES.index(pose)])
@@ -0,0 +1,198 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import cv2
+import numpy as np
+from django.conf import settings
+
+from .gating import REDUCED_GRAYSCALE_FLAGS
+from .metrics import RECOGNITION_CACHE, register_collector
+from .models import ENCODING_SIZE
+
+DEFAULT_RECOGNITION_CACHE_CONFIG = {
+    'ENABLED': True,
+    'TTL': 30.0,  # Seconds a cached identity is trusted
+    'HASH_DECODE_SCALE': 8,  # Frames are hashed from a 1/2, 1/4 or 1/8 size grayscale decode
+    'HASH_SIZE': 16,  # The difference hash has HASH_SIZE x HASH_SIZE bits
+    'MAX_HASH_DISTANCE': 12,  # Differing hash bits still counted as the same frame
+    'FRAMES_PER_CLIENT': 4,  # Recent frame results remembered per client
+    'MAX_CLIENTS': 1000,
+    'MAX_ENCODINGS': 1024,  # Recent encodings remembered with the profile they matched
+    'ENCODING_STEP': 0.004,  # Quantization step of the remembered encodings (int8)
+    'MAX_ENCODING_DISTANCE': 0.1,  # Encodings closer than this are scored against the cached profile only
+}
+
+
+def get_recognition_cache_config():
+    return {**DEFAULT_RECOGNITION_CACHE_CONFIG, **getattr(settings, 'FACE_RECOGNITION_CACHE', {})}
+
+
+FrameKey = namedtuple('FrameKey', 'scope frame_hash generation')
+
+
+class RecognitionCache:
+    """
+    Short-lived results of the recognition pipeline, so a person standing
+    in front of a kiosk is not detected, encoded and matched again for every
+    near-identical frame.
+
+    Two levels:
+
+    - frame: the response for a frame, keyed by client and a perceptual
+      (difference) hash of a reduced grayscale decode. A hit skips the
+      inference job altogether.
+    - encoding: the profile an encoding matched, keyed by the encoding as
+      an int8-quantized vector. A new encoding within MAX_ENCODING_DISTANCE
+      of a remembered one is scored against that profile's encodings only,
+      instead of searching the whole gallery. Only the candidate is cached:
+      the distance, and so the match decision, is always the new encoding's.
+
+    Both levels expire after TTL seconds and are dropped whenever a
+    FaceProfile changes. Results computed before an invalidation are not
+    stored afterwards (see `generation`).
+    """
+
+    def __init__(self, config=None):
+        self.config = config or get_recognition_cache_config()
+        self.enabled = self.config['ENABLED']
+        self.generation = 0
+        self._frames = OrderedDict()  # scope -> [(frame_hash, expires_at, result), ...], newest last
+        self._encodings = np.zeros((self.config['MAX_ENCODINGS'], ENCODING_SIZE), dtype=np.int8)
+        self._encoding_expires = np.zeros(self.config['MAX_ENCODINGS'])
+        self._encoding_candidates = np.full(self.config['MAX_ENCODINGS'], -1, dtype=np.int64)
+        self._next_encoding = 0
+        self._lock = threading.Lock()
+
+    def frame_key(self, image_bytes, scope):
+        """
+        Hashes an encoded frame for `scope` (the pipeline variant and
+        client). Returns None if the frame could not be decoded.
+        """
+        flag = REDUCED_GRAYSCALE_FLAGS[self.config['HASH_DECODE_SCALE']]
+        gray = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), flag)
+        if gray is None:
+            return None
+        size = self.config['HASH_SIZE']
+        small = cv2.resize(gray, (size + 1, size), interpolation=cv2.INTER_AREA)
+        bits = small[:, 1:] > small[:, :-1]
+        return FrameKey(scope, int.from_bytes(np.packbits(bits).tobytes(), 'big'), self.generation)
+
+    def get_result(self, key):
+        if key is None:
+            return None
+        now = time.monotonic()
+        max_distance = self.config['MAX_HASH_DISTANCE']
+        with self._lock:
+            entries = self._frames.get(key.scope, ())
+            for frame_hash, expires_at, result in reversed(entries):
+                if expires_at > now and (frame_hash ^ key.frame_hash).bit_count() <= max_distance:
+                    self._frames.move_to_end(key.scope)
+                    RECOGNITION_CACHE.inc('frame', 'hit')
+                    return result
+        RECOGNITION_CACHE.inc('frame', 'miss')
+        return None
+
+    def put_result(self, key, result):
+        if key is None:
+            return
+        with self._lock:
+            if key.generation != self.generation:
+                return
+            entries = self._frames.pop(key.scope, [])
+            entries.append((key.frame_hash, time.monotonic() + self.config['TTL'], result))
+            self._frames[key.scope] = entries[-self.config['FRAMES_PER_CLIENT']:]
+            while len(self._frames) > self.config['MAX_CLIENTS']:
+                self._frames.popitem(last=False)
+
+    def get_candidates(self, encodings):
+        """
+        Returns the profile id a remembered encoding close to each of the
+        (n, 128) `encodings` matched, or None where none is close enough.
+        """
+        if not len(encodings):
+            return []
+        step = self.config['ENCODING_STEP']
+        with self._lock:
+            live = np.flatnonzero(self._encoding_expires > time.monotonic())
+            remembered = self._encodings[live].astype(np.float32) * step
+            candidates = self._encoding_candidates[live]
+        if not len(live):
+            RECOGNITION_CACHE.inc('encoding', 'miss', amount=len(encodings))
+            return [None] * len(encodings)
+
+        squared = (np.einsum('ij,ij->i', encodings, encodings)[:, None]
+                   + np.einsum('ij,ij->i', remembered, remembered)[None, :]
+                   - 2 * encodings @ remembered.T)
+        nearest = squared.argmin(axis=1)
+        close = squared[np.arange(len(encodings)), nearest] <= self.config['MAX_ENCODING_DISTANCE'] ** 2
+        hits = int(close.sum())
+        RECOGNITION_CACHE.inc('encoding', 'hit', amount=hits)
+        RECOGNITION_CACHE.inc('encoding', 'miss', amount=len(encodings) - hits)
+        return [int(candidates[index]) if hit else None for index, hit in zip(nearest, close)]
+
+    def put_candidate(self, encoding, profile_id, generation):
+        step = self.config['ENCODING_STEP']
+        quantized = np.clip(np.rint(np.asarray(encoding) / step), -127, 127).astype(np.int8)
+        with self._lock:
+            if generation != self.generation:
+                return
+            slot = self._next_encoding
+            self._encodings[slot] = quantized
+            self._encoding_expires[slot] = time.monotonic() + self.config['TTL']
+            self._encoding_candidates[slot] = profile_id
+            self._next_encoding = (slot + 1) % len(self._encodings)
+
+    def discard(self, client_key):
+        """
+        Forgets the frame results of a client whose connection closed.
+        """
+        with self._lock:
+            for scope in [scope for scope in self._frames if scope[1] == client_key]:
+                del self._frames[scope]
+
+    def invalidate(self):
+        """
+        Drops every cached result, e.g. because a FaceProfile changed.
+        """
+        with self._lock:
+            self.generation += 1
+            self._frames.clear()
+            self._encoding_expires[:] = 0
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            frames = sum(len(entries) for entries in self._frames.values())
+            encodings = int((self._encoding_expires > now).sum())
+        return {'frames': frames, 'encodings': encodings}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_recognition_cache():
+    """
+    Returns the process-wide recognition cache, configured by settings.FACE_RECOGNITION_CACHE.
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = RecognitionCache()
+    return _cache
+
+
+def render_cache_metrics():
+    stats = get_recognition_cache().stats()
+    lines = [
+        '# HELP face_recognition_cache_entries Live entries per recognition cache level.',
+        '# TYPE face_recognition_cache_entries gauge',
+    ]
+    lines += [f'face_recognition_cache_entries{{level="{level}"}} {stats[key]}'
+              for level, key in (('frame', 'frames'), ('encoding', 'encodings'))]
+    return lines
+
+
+register_collector(render_cache_metrics)
@@ -0,0 +1,663 @@
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+
+import numpy as np
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+
+def _squared_distances(matrix, sq_norms, query):
+    # ||a - b||^2 = ||a||^2 - 2 a.b + ||b||^2, so one mat-vec product covers every row
+    return np.maximum(sq_norms - 2.0 * (matrix @ query) + query @ query, 0.0)
+
+
+def top_k_labels(distances, labels, k, max_per_label):
+    """
+    Returns up to `k` (label, distance) pairs for the closest labels, scoring
+    each label by its nearest row.
+
+    A label owns at most `max_per_label` rows, so the best k * max_per_label
+    rows are guaranteed to contain the best row of each of the top k labels.
+    """
+    if not len(distances):
+        return []
+
+    if k == 1:
+        row = int(np.argmin(distances))
+        return [(int(labels[row]), float(distances[row]))]
+
+    candidates = min(len(distances), k * max_per_label)
+    rows = np.argpartition(distances, candidates - 1)[:candidates]
+    rows = rows[np.argsort(distances[rows], kind='stable')]
+
+    results, seen = [], set()
+    for row in rows:
+        label = int(labels[row])
+        if label in seen:
+            continue
+        seen.add(label)
+        results.append((label, float(distances[row])))
+        if len(results) == k:
+            break
+    return results
+
+
+class SearchBackend:
+    """
+    Nearest-neighbour search over labelled encodings.
+
+    Each label (a FaceProfile id) may own several rows. Searches return the
+    closest labels, not rows.
+    """
+
+    def build(self, encodings, labels):
+        raise NotImplementedError
+
+    def add(self, encodings, label):
+        raise NotImplementedError
+
+    def remove(self, label):
+        raise NotImplementedError
+
+    def search(self, query, k=1):
+        raise NotImplementedError
+
+    def search_batch(self, queries, k=1):
+        """
+        Searches several queries at once. Returns one result list per query.
+        """
+        return [self.search(query, k=k) for query in queries]
+
+    def label_distances(self, queries, labels):
+        """
+        Returns the distance of each query to the nearest row of its label,
+        or None where the label has no rows. Backends that cannot look up a
+        label's rows return None throughout.
+        """
+        return [None] * len(labels)
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def save(self, path):
+        """
+        Persists any trained state. Backends without training have nothing to save.
+        """
+
+    def load(self, path):
+        """
+        Restores trained state saved by `save`. Returns True if anything was loaded.
+        """
+        return False
+
+
+class _RowBlock:
+    """
+    A contiguous float32 matrix of rows with their labels and squared norms.
+
+    The three arrays are swapped in as one tuple, so a concurrent reader
+    never sees them out of step.
+    """
+
+    def __init__(self, encodings=None, labels=None, dim=128, sq_norms=None):
+        if encodings is None:
+            encodings = np.empty((0, dim), dtype=np.float32)
+            labels = np.empty(0, dtype=np.int64)
+        self.set(encodings, labels, sq_norms)
+
+    def set(self, encodings, labels, sq_norms=None):
+        encodings = np.ascontiguousarray(encodings, dtype=np.float32)
+        labels = np.asarray(labels, dtype=np.int64)
+        if sq_norms is None:
+            sq_norms = np.einsum('ij,ij->i', encodings, encodings)
+        self.arrays = (encodings, labels, sq_norms)
+
+    def append(self, encodings, label):
+        current, labels, _ = self.arrays
+        self.set(np.concatenate([current, encodings]),
+                 np.concatenate([labels, np.full(len(encodings), label, dtype=np.int64)]))
+
+    def discard(self, label):
+        encodings, labels, _ = self.arrays
+        keep = labels != label
+        if not keep.all():
+            self.set(encodings[keep], labels[keep])
+
+    def distances(self, query):
+        encodings, labels, sq_norms = self.arrays
+        return np.sqrt(_squared_distances(encodings, sq_norms, query)), labels
+
+    def label_distance(self, query, label, alive=None):
+        """
+        Distance from `query` to the nearest row of `label` (among the
+        `alive` rows, if given), or None if it has none.
+        """
+        encodings, labels, sq_norms = self.arrays
+        rows = labels == label
+        if alive is not None:
+            rows &= alive
+        rows = np.flatnonzero(rows)
+        if not len(rows):
+            return None
+        return float(np.sqrt(_squared_distances(encodings[rows], sq_norms[rows], query).min()))
+
+    def batch_distances(self, queries, chunk_elements=1 << 24):
+        """
+        Yields (labels, distance rows) for chunks of `queries`, computed as a
+        matrix-matrix product and sized to keep each distance block bounded.
+        """
+        encodings, labels, sq_norms = self.arrays
+        chunk_size = max(1, chunk_elements // max(1, len(labels)))
+        for start in range(0, len(queries), chunk_size):
+            chunk = queries[start:start + chunk_size]
+            query_sq_norms = np.einsum('ij,ij->i', chunk, chunk)
+            sq_distances = sq_norms[None, :] - 2.0 * (chunk @ encodings.T) + query_sq_norms[:, None]
+            yield labels, np.sqrt(np.maximum(sq_distances, 0.0))
+
+    def __len__(self):
+        return len(self.arrays[1])
+
+
+def _count_labels(labels):
+    ids, counts = np.unique(labels, return_counts=True)
+    return dict(zip(ids.tolist(), counts.tolist())), int(counts.max(initial=1))
+
+
+class ExactSearch(SearchBackend):
+    """
+    Brute-force scan over every row. Exact, and fast enough for small galleries.
+    """
+
+    def __init__(self, dim=128):
+        self.dim = dim
+        self._block = _RowBlock(dim=dim)
+        self._counts = {}
+        self._max_per_label = 1
+
+    def build(self, encodings, labels):
+        self._block.set(encodings, labels)
+        self._counts, self._max_per_label = _count_labels(labels)
+
+    def add(self, encodings, label):
+        self.remove(label)
+        if len(encodings):
+            self._block.append(encodings, label)
+            self._counts[label] = len(encodings)
+            self._max_per_label = max(self._max_per_label, len(encodings))
+
+    def remove(self, label):
+        if self._counts.pop(label, None) is not None:
+            self._block.discard(label)
+
+    def search(self, query, k=1):
+        distances, labels = self._block.distances(np.asarray(query, dtype=np.float32))
+        return top_k_labels(distances, labels, k, self._max_per_label)
+
+    def search_batch(self, queries, k=1):
+        queries = np.ascontiguousarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        results = []
+        for labels, distances in self._block.batch_distances(queries):
+            results.extend(top_k_labels(row, labels, k, self._max_per_label) for row in distances)
+        return results
+
+    def label_distances(self, queries, labels):
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        return [self._block.label_distance(query, label) if label in self._counts else None
+                for query, label in zip(queries, labels)]
+
+    def __len__(self):
+        return len(self._block)
+
+
+def nearest_centroids(data, centroids, centroid_sq_norms, chunk_size=8192):
+    """
+    Assigns every row of `data` to its closest centroid, in chunks so the
+    distance matrix never grows past chunk_size x n_centroids.
+    """
+    assignment = np.empty(len(data), dtype=np.int64)
+    for start in range(0, len(data), chunk_size):
+        chunk = data[start:start + chunk_size]
+        sq_distances = centroid_sq_norms[None, :] - 2.0 * (chunk @ centroids.T)
+        assignment[start:start + chunk_size] = np.argmin(sq_distances, axis=1)
+    return assignment
+
+
+def kmeans(data, n_clusters, iterations=10, seed=0):
+    """
+    Plain Lloyd's k-means. Returns the float32 centroid matrix.
+    """
+    rng = np.random.default_rng(seed)
+    data = np.ascontiguousarray(data, dtype=np.float32)
+    centroids = data[rng.choice(len(data), n_clusters, replace=False)].copy()
+
+    for _ in range(iterations):
+        centroid_sq_norms = np.einsum('ij,ij->i', centroids, centroids)
+        assignment = nearest_centroids(data, centroids, centroid_sq_norms)
+
+        order = np.argsort(assignment, kind='stable')
+        counts = np.bincount(assignment, minlength=n_clusters)
+        occupied = np.flatnonzero(counts)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[occupied]
+        centroids[occupied] = np.add.reduceat(data[order], starts, axis=0) / counts[occupied, None]
+
+        # Re-seed empty clusters from random points so every list stays useful
+        empty = counts == 0
+        if empty.any():
+            centroids[empty] = data[rng.choice(len(data), int(empty.sum()), replace=False)]
+
+    return centroids
+
+
+class IVFSearch(SearchBackend):
+    """
+    Inverted-file approximate search.
+
+    A k-means coarse quantizer splits the gallery into `nlist` lists and a
+    query only scans the `nprobe` lists whose centroids are closest to it.
+    Raising `nprobe` trades latency for recall. Until there are enough rows
+    to train the quantizer, every row lives in a single list and searches
+    are exact.
+    """
+
+    MIN_POINTS_PER_LIST = 39
+    MAX_TRAINING_POINTS_PER_LIST = 64
+
+    def __init__(self, nlist=None, nprobe=8, train_iterations=10, seed=0, dim=128):
+        self.dim = dim
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.train_iterations = train_iterations
+        self.seed = seed
+        self.centroids = None
+        self._centroid_sq_norms = None
+        self._lists = [_RowBlock(dim=dim)]
+        self._label_lists = {}
+        self._counts = {}
+        self._max_per_label = 1
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    def train(self, encodings):
+        encodings = np.asarray(encodings, dtype=np.float32)
+        nlist = self.nlist or max(1, int(4 * np.sqrt(len(encodings))))
+        if len(encodings) < nlist * self.MIN_POINTS_PER_LIST:
+            logger.info(f"Not enough encodings ({len(encodings)}) to train {nlist} IVF lists, using exact search")
+            return False
+
+        sample_size = min(len(encodings), nlist * self.MAX_TRAINING_POINTS_PER_LIST)
+        rng = np.random.default_rng(self.seed)
+        sample = encodings[rng.choice(len(encodings), sample_size, replace=False)]
+        self._set_centroids(kmeans(sample, nlist, self.train_iterations, self.seed))
+        logger.info(f"Trained IVF quantizer with {nlist} lists on {sample_size} encodings")
+        return True
+
+    def build(self, encodings, labels):
+        encodings = np.asarray(encodings, dtype=np.float32)
+        labels = np.asarray(labels, dtype=np.int64)
+        if not self.is_trained:
+            self.train(encodings)
+
+        self._counts, self._max_per_label = _count_labels(labels)
+
+        if not self.is_trained:
+            self._label_lists = {label: {0} for label in self._counts}
+            self._lists = [_RowBlock(encodings, labels, self.dim)]
+            return
+
+        assignment = self._assign(encodings)
+        order = np.argsort(assignment, kind='stable')
+        bounds = np.searchsorted(assignment[order], np.arange(len(self.centroids) + 1))
+        lists = []
+        for list_id in range(len(self.centroids)):
+            rows = order[bounds[list_id]:bounds[list_id + 1]]
+            lists.append(_RowBlock(encodings[rows], labels[rows], self.dim))
+
+        label_lists = {}
+        for label, list_id in zip(labels.tolist(), assignment.tolist()):
+            label_lists.setdefault(label, set()).add(list_id)
+        self._label_lists = label_lists
+        self._lists = lists
+
+    def add(self, encodings, label):
+        self.remove(label)
+        encodings = np.asarray(encodings, dtype=np.float32)
+        if not len(encodings):
+            return
+
+        assignment = self._assign(encodings) if self.is_trained else np.zeros(len(encodings), dtype=np.int64)
+        for list_id in np.unique(assignment).tolist():
+            self._lists[list_id].append(encodings[assignment == list_id], label)
+            self._label_lists.setdefault(label, set()).add(list_id)
+        self._counts[label] = len(encodings)
+        self._max_per_label = max(self._max_per_label, len(encodings))
+
+    def remove(self, label):
+        for list_id in self._label_lists.pop(label, ()):
+            self._lists[list_id].discard(label)
+        self._counts.pop(label, None)
+
+    def search(self, query, k=1, nprobe=None):
+        query = np.asarray(query, dtype=np.float32)
+        if self.is_trained:
+            nprobe = min(nprobe or self.nprobe, len(self._lists))
+            coarse = _squared_distances(self.centroids, self._centroid_sq_norms, query)
+            probed = [self._lists[i] for i in np.argpartition(coarse, nprobe - 1)[:nprobe]]
+        else:
+            probed = self._lists
+
+        distances, labels = [], []
+        for block in probed:
+            if len(block):
+                block_distances, block_labels = block.distances(query)
+                distances.append(block_distances)
+                labels.append(block_labels)
+        if not distances:
+            return []
+
+        return top_k_labels(np.concatenate(distances), np.concatenate(labels), k, self._max_per_label)
+
+    def label_distances(self, queries, labels):
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        results = []
+        for query, label in zip(queries, labels):
+            distances = [self._lists[list_id].label_distance(query, label)
+                         for list_id in self._label_lists.get(label, ())]
+            distances = [distance for distance in distances if distance is not None]
+            results.append(min(distances) if distances else None)
+        return results
+
+    def __len__(self):
+        return sum(len(block) for block in self._lists)
+
+    def save(self, path):
+        if not self.is_trained:
+            return
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, centroids=self.centroids)
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        if not path or not os.path.exists(path):
+            return False
+        with np.load(path) as data:
+            centroids = data['centroids']
+        if centroids.ndim != 2 or centroids.shape[1] != self.dim:
+            logger.warning(f"Ignoring IVF index at {path}: unexpected shape {centroids.shape}")
+            return False
+        self._set_centroids(centroids)
+        logger.info(f"Loaded IVF quantizer with {len(centroids)} lists from {path}")
+        return True
+
+    def _set_centroids(self, centroids):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self._centroid_sq_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+
+    def _assign(self, encodings):
+        return nearest_centroids(encodings, self.centroids, self._centroid_sq_norms)
+
+
+def hash_router(label, shards):
+    """
+    Default shard routing: spreads profile ids evenly over the shards.
+    """
+    return label % shards
+
+
+def save_array(path, array):
+    """
+    Writes an .npy file beside `path` and renames it into place, so a
+    reader never maps a half-written file.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def save_meta(path, meta):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, path)
+
+
+class ShardIndex:
+    """
+    Exact search over a memory-mapped encoding matrix on disk (a shard
+    written by ShardedSearch.build, or a shared gallery version), plus the
+    profiles added or removed since it was written.
+
+    The encodings, labels and, when present, squared norms stay mapped
+    read-only, so processes opening the same files share them through the
+    page cache. Removed profiles are masked out, and added ones live in a
+    small in-memory ExactSearch until the files are rewritten.
+    """
+
+    def __init__(self, path, dim=128):
+        self.path = path
+        self.dim = dim
+        self.load()
+
+    def load(self):
+        encodings = np.load(f'{self.path}.encodings.npy', mmap_mode='r')
+        labels = np.load(f'{self.path}.labels.npy', mmap_mode='r')
+        sq_norms = np.load(f'{self.path}.norms.npy', mmap_mode='r') if os.path.exists(f'{self.path}.norms.npy') else None
+        self._base = _RowBlock(encodings, labels, self.dim, sq_norms)
+        if os.path.exists(f'{self.path}.meta.json'):
+            with open(f'{self.path}.meta.json') as f:
+                self._max_per_label = json.load(f)['max_per_label']
+        else:
+            self._max_per_label = _count_labels(labels)[1]
+        self._alive = None  # Row mask, created on the first removal
+        self._added = ExactSearch(self.dim)
+
+    def add(self, encodings, label):
+        self.remove(label)
+        encodings = np.asarray(encodings, dtype=np.float32).reshape(-1, self.dim)
+        self._added.add(encodings, label)
+        self._max_per_label = max(self._max_per_label, len(encodings))
+
+    def remove(self, label):
+        rows = self._base.arrays[1] == label
+        if rows.any():
+            if self._alive is None:
+                self._alive = np.ones(len(self._base), dtype=bool)
+            self._alive &= ~rows
+        self._added.remove(label)
+
+    def search(self, query, k=1):
+        return self.search_batch(np.asarray(query, dtype=np.float32).reshape(1, -1), k)[0]
+
+    def search_batch(self, queries, k=1):
+        queries = np.ascontiguousarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        results = []
+        if len(self._base):
+            for labels, distances in self._base.batch_distances(queries):
+                if self._alive is not None:
+                    distances[:, ~self._alive] = np.inf
+                results.extend([(label, distance) for label, distance in
+                                top_k_labels(row, labels, k, self._max_per_label) if distance != np.inf]
+                               for row in distances)
+        else:
+            results = [[] for _ in queries]
+        if len(self._added):
+            for matches, added in zip(results, self._added.search_batch(queries, k)):
+                matches.extend(added)
+                matches.sort(key=lambda match: match[1])
+                del matches[k:]
+        return results
+
+    def label_distances(self, queries, labels):
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        # A label added since the files were written is masked out of the base rows
+        added = self._added.label_distances(queries, labels)
+        return [distance if distance is not None else self._base.label_distance(query, label, self._alive)
+                for query, label, distance in zip(queries, labels, added)]
+
+    def __len__(self):
+        alive = len(self._base) if self._alive is None else int(self._alive.sum())
+        return alive + len(self._added)
+
+
+def _serve_shard(conn, path, dim):
+    """
+    Shard worker process: answers (method, args) requests for one
+    ShardIndex until the coordinator closes the pipe.
+    """
+    shard = ShardIndex(path, dim)
+    while True:
+        try:
+            method, args = conn.recv()
+        except EOFError:
+            return
+        try:
+            result = len(shard) if method == '__len__' else getattr(shard, method)(*args)
+            conn.send(('ok', result))
+        except Exception as e:
+            conn.send(('error', f'{type(e).__name__}: {e}'))
+
+
+class _ShardProcess:
+    """
+    Coordinator-side handle of one shard worker and its pipe.
+    """
+
+    def __init__(self, context, path, dim):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_serve_shard, args=(child_conn, path, dim), daemon=True,
+                                       name=f'face-shard-{os.path.basename(path)}')
+        self.process.start()
+        child_conn.close()
+        self.lock = threading.Lock()
+
+    def close(self):
+        self.conn.close()
+        self.process.join(timeout=1)
+
+
+class ShardedSearch(SearchBackend):
+    """
+    Exact search over a gallery partitioned into `shards`, for deployments
+    too large for one scan.
+
+    Each shard is a memory-mapped encoding matrix under `directory`, served
+    by its own worker process (or searched in-process with
+    `processes=False`). A query is sent to every shard over a pipe, the
+    shards scan their rows in parallel, and the coordinator merges their
+    top-k lists. A profile lives in exactly one shard, picked by `router`
+    (a dotted path to a callable(profile_id, shards), e.g. mapping profiles
+    to their site or tenant; hashing by id by default), so adds and removes
+    go to that shard only.
+    """
+
+    def __init__(self, shards=None, directory=None, router=None, processes=True, start_method='spawn', dim=128):
+        self.shards = shards or max(1, (os.cpu_count() or 2) - 1)
+        self.directory = directory or tempfile.mkdtemp(prefix='face-shards-')
+        self.router = import_string(router) if router else hash_router
+        self.processes = processes
+        self.start_method = start_method
+        self.dim = dim
+        self._workers = []
+        self._local = []
+
+    def shard_path(self, shard):
+        return os.path.join(self.directory, f'shard-{shard}')
+
+    def shard_for(self, label):
+        return self.router(label, self.shards)
+
+    def build(self, encodings, labels):
+        encodings = np.ascontiguousarray(encodings, dtype=np.float32).reshape(-1, self.dim)
+        labels = np.asarray(labels, dtype=np.int64)
+        os.makedirs(self.directory, exist_ok=True)
+
+        routes = np.array([self.shard_for(label) for label in labels.tolist()], dtype=np.int64)
+        for shard in range(self.shards):
+            rows = np.flatnonzero(routes == shard)
+            save_array(f'{self.shard_path(shard)}.encodings.npy', encodings[rows])
+            save_array(f'{self.shard_path(shard)}.labels.npy', labels[rows])
+            save_meta(f'{self.shard_path(shard)}.meta.json', {'max_per_label': _count_labels(labels[rows])[1]})
+        logger.info(f"Wrote {len(labels)} encodings to {self.shards} shards in {self.directory}")
+
+        if not self.processes:
+            self._local = [ShardIndex(self.shard_path(shard), self.dim) for shard in range(self.shards)]
+        elif self._workers:
+            self._call_all('load')
+        else:
+            context = multiprocessing.get_context(self.start_method)
+            self._workers = [_ShardProcess(context, self.shard_path(shard), self.dim) for shard in range(self.shards)]
+
+    def add(self, encodings, label):
+        self._call(self.shard_for(label), 'add', np.asarray(encodings, dtype=np.float32), label)
+
+    def remove(self, label):
+        self._call(self.shard_for(label), 'remove', label)
+
+    def search(self, query, k=1):
+        return self.search_batch(np.asarray(query, dtype=np.float32).reshape(1, -1), k)[0]
+
+    def search_batch(self, queries, k=1):
+        queries = np.ascontiguousarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        results = [[] for _ in queries]
+        # A profile lives in one shard, so merging the shards' top k lists is exact
+        for shard_results in self._call_all('search_batch', queries, k):
+            for matches, shard_matches in zip(results, shard_results):
+                matches.extend(shard_matches)
+        for matches in results:
+            matches.sort(key=lambda match: match[1])
+            del matches[k:]
+        return results
+
+    def label_distances(self, queries, labels):
+        queries = np.ascontiguousarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        by_shard = {}
+        for index, label in enumerate(labels):
+            by_shard.setdefault(self.shard_for(label), []).append(index)
+        results = [None] * len(labels)
+        for shard, indexes in by_shard.items():
+            distances = self._call(shard, 'label_distances', queries[indexes], [labels[i] for i in indexes])
+            for index, distance in zip(indexes, distances):
+                results[index] = distance
+        return results
+
+    def __len__(self):
+        return sum(self._call_all('__len__'))
+
+    def close(self):
+        for worker in self._workers:
+            worker.close()
+        self._workers = []
+
+    def _call(self, shard, method, *args):
+        return self._call_all(method, *args, shards=[shard])[0]
+
+    def _call_all(self, method, *args, shards=None):
+        shards = range(self.shards) if shards is None else shards
+        if not self.processes:
+            return [len(self._local[shard]) if method == '__len__' else getattr(self._local[shard], method)(*args)
+                    for shard in shards]
+
+        # Locks are taken in shard order, so concurrent callers cannot deadlock
+        workers = [self._workers[shard] for shard in shards]
+        for worker in workers:
+            worker.lock.acquire()
+        try:
+            for worker in workers:
+                worker.conn.send((method, args))
+            replies = [worker.conn.recv() for worker in workers]
+        finally:
+            for worker in workers:
+                worker.lock.release()
+
+        for shard, (status, result) in zip(shards, replies):
+            if status != 'ok':
+                raise RuntimeError(f'Gallery shard {shard} failed: {result}')
+        return [result for _, result in replies]
@@ -0,0 +1,32 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .gallery import get_gallery
+from .gating import get_frame_gate
+from .models import FaceProfile
+from .recognition_cache import get_recognition_cache
+from .tracking import get_tracker_registry
+
+
+@receiver(post_save, sender=FaceProfile)
+def add_profile_to_gallery(sender, instance, **kwargs):
+    gallery = get_gallery()
+    if gallery.is_built:
+        transaction.on_commit(lambda: gallery.add_profile(instance))
+    # Identities cached on tracks, in the recognition cache or replayed for
+    # unchanged frames may no longer be the best match
+    transaction.on_commit(get_tracker_registry().invalidate)
+    transaction.on_commit(get_recognition_cache().invalidate)
+    transaction.on_commit(get_frame_gate().invalidate)
+
+
+@receiver(post_delete, sender=FaceProfile)
+def remove_profile_from_gallery(sender, instance, **kwargs):
+    gallery = get_gallery()
+    if gallery.is_built:
+        profile_id = instance.pk
+        transaction.on_commit(lambda: gallery.remove_profile(profile_id))
+    transaction.on_commit(get_tracker_registry().invalidate)
+    transaction.on_commit(get_recognition_cache().invalidate)
+    transaction.on_commit(get_frame_gate().invalidate)
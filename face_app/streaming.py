@@ -0,0 +1,233 @@
+import asyncio
+import json
+import logging
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from asgiref.sync import sync_to_async
+
+from . import views
+from .enrollment import get_enrollment_store
+from .gating import get_frame_gate
+from .metrics import count_outcome
+from .recognition_cache import get_recognition_cache
+from .tracking import get_tracker_registry, get_tracking_config
+from .workers import InferenceTimeout, QueueFull
+
+logger = logging.getLogger(__name__)
+
+MAX_FRAME_BYTES = 2 * 1024 * 1024
+# A streamed pose counts one attempt per this many seconds without a capture, not one per frame
+POSE_ATTEMPT_SECONDS = 3.0
+
+
+class FrameStream:
+    """
+    One WebSocket connection streaming binary JPEG frames.
+
+    Frames are kept in a single "latest" slot: if a new frame arrives while
+    the previous one is still being processed, the older one is dropped, so
+    the server always works on the most recent view of the camera. Results
+    are pushed back as JSON text messages as soon as they are ready.
+    """
+
+    def __init__(self, scope, receive, send):
+        self.scope = scope
+        self.receive = receive
+        self.send = send
+        self.latest_frame = None
+        self.frame_ready = asyncio.Event()
+        self.frames_received = 0
+        self.frames_dropped = 0
+
+    async def run(self):
+        message = await self.receive()
+        if message['type'] != 'websocket.connect':
+            return
+        if not self.origin_allowed():
+            await self.send({'type': 'websocket.close', 'code': 4003})
+            return
+        if not await self.connect():
+            await self.send({'type': 'websocket.close', 'code': 4001})
+            return
+
+        await self.send({'type': 'websocket.accept'})
+        await self.send_json(await self.hello())
+
+        processor = asyncio.create_task(self.process_frames())
+        try:
+            while True:
+                message = await self.receive()
+                if message['type'] == 'websocket.disconnect':
+                    break
+                if message.get('bytes') is not None:
+                    if len(message['bytes']) > MAX_FRAME_BYTES:
+                        await self.send({'type': 'websocket.close', 'code': 1009})
+                        break
+                    self.push_frame(message['bytes'])
+        finally:
+            processor.cancel()
+
+    def push_frame(self, frame):
+        self.frames_received += 1
+        if self.latest_frame is not None:
+            self.frames_dropped += 1
+        self.latest_frame = frame
+        self.frame_ready.set()
+
+    def discard_pending_frame(self):
+        self.latest_frame = None
+        self.frame_ready.clear()
+
+    async def process_frames(self):
+        while True:
+            await self.frame_ready.wait()
+            self.frame_ready.clear()
+            frame, self.latest_frame = self.latest_frame, None
+            if frame is None:
+                continue
+
+            try:
+                result = await self.handle_frame(frame)
+            except QueueFull:
+                count_outcome(self.pipeline, 'busy')
+                result = {'success': False, 'error': views.BUSY_MESSAGE, 'busy': True}
+            except InferenceTimeout:
+                count_outcome(self.pipeline, 'timeout')
+                result = {'success': False, 'error': views.TIMEOUT_MESSAGE}
+            except Exception as e:
+                logger.exception("An error occurred while processing a streamed frame")
+                result = {'success': False, 'error': f'An error occurred: {str(e)}'}
+
+            # A copy: the gate and the recognition cache keep the result itself
+            await self.send_json({**result, 'frames_dropped': self.frames_dropped})
+
+    async def send_json(self, data):
+        await self.send({'type': 'websocket.send', 'text': json.dumps(data)})
+
+    def origin_allowed(self):
+        """
+        Rejects cross-site connections: the Origin host must match the Host header.
+        """
+        headers = dict(self.scope.get('headers', []))
+        origin = headers.get(b'origin')
+        if origin is None:
+            return True
+        return urlsplit(origin.decode('latin1')).netloc == headers.get(b'host', b'').decode('latin1')
+
+    async def connect(self):
+        return True
+
+    async def hello(self):
+        return {'ready': True, 'frame_format': views.get_frame_format()}
+
+    async def handle_frame(self, frame):
+        raise NotImplementedError
+
+
+class RecognitionStream(FrameStream):
+    """
+    Continuous recognition with a per-connection face tracker. Connecting
+    with `?multi=1` recognizes every face in each frame instead of only the
+    largest one.
+    """
+
+    pipeline = 'recognize'
+
+    def __init__(self, scope, receive, send):
+        super().__init__(scope, receive, send)
+        self.tracker_key = f'ws:{id(self)}'
+        query = parse_qs(scope.get('query_string', b'').decode('latin1'))
+        self.multi_face = query.get('multi') == ['1']
+
+    async def run(self):
+        try:
+            await super().run()
+        finally:
+            get_tracker_registry().discard(self.tracker_key)
+            get_frame_gate().discard(self.tracker_key)
+            get_recognition_cache().discard(self.tracker_key)
+
+    async def handle_frame(self, frame):
+        tracker = None
+        if get_tracking_config()['ENABLED']:
+            tracker = get_tracker_registry().get(self.tracker_key)
+        if self.multi_face:
+            return await views.recognize_faces_frame(frame, tracker, self.tracker_key)
+        if tracker is None:
+            return await views.recognize_frame(frame, self.tracker_key)
+        return await views.recognize_tracked_frame(tracker, frame, self.tracker_key)
+
+
+class EnrollmentStream(FrameStream):
+    """
+    Walks through the registration poses for the enrollment named by the
+    `token` query parameter. The current pose is tracked on the connection;
+    each accepted frame is added to the enrollment store, ready for
+    save_face_profile.
+
+    Frames arrive several times a second, so attempts are counted by time
+    spent on the pose rather than per rejected frame. Running out of
+    attempts restarts the current pose; poses already captured are kept.
+    """
+
+    pipeline = 'register'
+
+    async def connect(self):
+        self.token = parse_qs(self.scope.get('query_string', b'').decode('latin1')).get('token', [''])[0]
+        self.sample_count = 0
+        self.attempt_count = 0
+        self.pose_started = None
+        # (Re)starting the capture discards samples from an interrupted attempt
+        return await sync_to_async(get_enrollment_store().reset, thread_sensitive=False)(self.token)
+
+    async def hello(self):
+        return {**await super().hello(), 'instruction': views.POSES[0]['instruction'], 'sample_count': 0}
+
+    async def handle_frame(self, frame):
+        if self.sample_count >= views.REQUIRED_SAMPLES:
+            return {'success': True, 'complete': True}
+
+        if self.pose_started is None:
+            # The pose's clock starts with its first frame, after the page's pause between poses
+            self.pose_started = time.monotonic()
+        result = await views.register_frame(self.token, frame, self.sample_count, self.attempt_count)
+        if result['success']:
+            self.sample_count += 1
+            self.attempt_count = 0
+            self.pose_started = None
+            # Frames queued meanwhile were taken for the previous pose
+            self.discard_pending_frame()
+            if not result['complete']:
+                result['instruction'] = views.POSES[self.sample_count]['instruction']
+            return result
+
+        if result.get('reset'):
+            return result
+        self.attempt_count = int((time.monotonic() - self.pose_started) // POSE_ATTEMPT_SECONDS)
+        if self.attempt_count >= views.MAX_ATTEMPTS:
+            self.attempt_count = 0
+            self.pose_started = None
+            self.discard_pending_frame()
+            instruction = views.POSES[self.sample_count]['instruction']
+            return {'success': False, 'error': f'Pose not captured. Please {instruction.lower()} and hold still.',
+                    'instruction': instruction, 'sample_count': self.sample_count}
+        return {**result, 'attempt_count': self.attempt_count}
+
+
+WEBSOCKET_ROUTES = {
+    '/ws/test_face/': RecognitionStream,
+    '/ws/register_face/': EnrollmentStream,
+}
+
+
+async def websocket_application(scope, receive, send):
+    """
+    ASGI application for the frame-streaming WebSocket endpoints.
+    """
+    stream_class = WEBSOCKET_ROUTES.get(scope['path'])
+    if stream_class is None:
+        await receive()
+        await send({'type': 'websocket.close', 'code': 4004})
+        return
+    await stream_class(scope, receive, send).run()
@@ -1,3 +1,1256 @@
-from django.test import TestCase
+import asyncio
+import base64
+import io
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
-# Create your tests here.
+import cv2
+import numpy as np
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+
+from . import streaming, utils, views
+from .enrollment import CacheEnrollmentStore, LocalEnrollmentStore, get_enrollment_store
+from .management.commands import bulk_enroll
+from .benchmarks import bench_pipeline, synthetic_gallery, synthetic_queries
+from .detection import DetectionPolicy, default_detection_mode, get_detection_config
+from .gallery import DEFAULT_SHARED_GALLERY, GalleryIndex, MappedNames, SharedGalleryIndex, encode_names, merge_names
+from .gating import FrameGate, get_frame_gate, get_gating_config
+from .jobs import encode_all_faces_job, encode_face_job, encode_faces_batch_job
+from .metrics import Counter, Histogram
+from .models import FaceProfile, pack_encodings, unpack_encodings
+from .pose import LANDMARK_PARTS, POSES, classify_poses, landmarks_array, pose_features, pose_matches
+from .search import ExactSearch, IVFSearch, ShardedSearch, ShardIndex, save_array
+from .tracking import FaceTracker, TrackerRegistry, box_iou, get_tracker_registry, get_tracking_config
+from .utils import FaceAnalysis, LazyModule, decode_image, image_size, load_models
+from .workers import InferencePool, InferenceTimeout, QueueFull, get_inference_config
+from .recognition_cache import RecognitionCache, get_recognition_cache, get_recognition_cache_config
+
+TESTDATA = os.path.join(os.path.dirname(__file__), 'testdata')
+
+
+def read_testdata(name):
+    with open(os.path.join(TESTDATA, name), 'rb') as f:
+        return f.read()
+
+
+def encode_jpeg(image):
+    return cv2.imencode('.jpg', image)[1].tobytes()
+
+
+def textured_frame(seed=0, width=320, height=240):
+    """
+    A sharp, mid-grey frame that passes the sharpness and exposure stages.
+    """
+    rng = np.random.default_rng(seed)
+    blocks = rng.integers(60, 200, (height // 8, width // 8), dtype=np.uint8)
+    return cv2.cvtColor(cv2.resize(blocks, (width, height), interpolation=cv2.INTER_NEAREST), cv2.COLOR_GRAY2BGR)
+
+
+def make_stream(stream_class, query_string=b''):
+    """
+    Returns a stream on a fake connection and the list its JSON messages are sent to.
+    """
+    messages = []
+
+    async def receive():
+        return {'type': 'websocket.disconnect'}
+
+    async def send(message):
+        messages.append(json.loads(message['text']))
+
+    scope = {'type': 'websocket', 'headers': [], 'query_string': query_string}
+    return stream_class(scope, receive, send), messages
+
+
+class InferencePoolTests(TestCase):
+    """
+    A pool with one worker and two slots, whose blocking jobs hold the
+    worker until released. A thread executor stands in for the processes.
+    """
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+        self.pool = InferencePool(1, max_pending=2, timeout=0.2)
+        self.pool._executor = ThreadPoolExecutor(1)
+        self.addCleanup(self.pool.shutdown)
+        self.frame = read_testdata('astronaut.jpg')
+
+    def block(self):
+        self.release.wait(5)
+        return {'status': 'ok'}
+
+    def post_frame(self):
+        with mock.patch.object(views, 'get_inference_pool', return_value=self.pool), \
+                mock.patch.object(views, 'get_frame_gate', return_value=FrameGate()):
+            return self.client.post('/test_face/', {'image': SimpleUploadedFile('frame.jpg', self.frame)})
+
+    def test_full_queue_is_a_503_with_retry_after(self):
+        jobs = [self.pool.submit(self.block) for _ in range(2)]
+        with self.assertRaises(QueueFull):
+            self.pool.submit(self.block)
+
+        response = self.post_frame()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], str(get_inference_config()['RETRY_AFTER']))
+        self.assertEqual(response.json()['error'], views.BUSY_MESSAGE)
+
+        self.release.set()
+        for job in jobs:
+            job.result()
+        self.assertEqual(self.pool.pending, 0)
+        self.assertEqual(self.pool.run(lambda: 'done'), 'done')
+
+    def test_slow_job_is_a_504(self):
+        # The request's job waits behind one that holds the only worker
+        self.pool.submit(self.block)
+        with self.assertRaises(InferenceTimeout):
+            self.pool.run(self.block)
+
+        response = self.post_frame()
+        self.assertEqual(response.status_code, 504)
+        self.assertEqual(response.json()['error'], views.TIMEOUT_MESSAGE)
+
+
+class StreamTests(SimpleTestCase):
+    def test_frames_dropped_is_added_to_a_copy_of_the_result(self):
+        result = {'success': True, 'name': 'Bob'}
+
+        async def recognize_frame(frame, client_key=None):
+            return result
+
+        async def process(stream):
+            processor = asyncio.create_task(stream.process_frames())
+            stream.push_frame(b'frame')
+            while not messages:
+                await asyncio.sleep(0.01)
+            processor.cancel()
+
+        stream, messages = make_stream(streaming.RecognitionStream)
+        with mock.patch.object(views, 'recognize_frame', recognize_frame), \
+                mock.patch.object(streaming, 'get_tracking_config', return_value={'ENABLED': False}):
+            asyncio.run(process(stream))
+
+        self.assertEqual(messages, [{'success': True, 'name': 'Bob', 'frames_dropped': 0}])
+        self.assertNotIn('frames_dropped', result)
+
+    def test_enrollment_attempts_reset_after_a_capture(self):
+        token = get_enrollment_store().create()
+        replies = [
+            {'success': False, 'error': 'Bad pose', 'attempt_count': 1},
+            {'success': False, 'error': 'Bad pose', 'attempt_count': 2},
+            {'success': True, 'complete': False, 'sample_count': 1, 'attempt_count': 0},
+            {'success': False, 'error': 'Bad pose', 'attempt_count': 1},
+        ]
+        calls = []
+
+        async def register_frame(token, frame, sample_count, attempt_count=0):
+            calls.append((sample_count, attempt_count))
+            return dict(replies[len(calls) - 1])
+
+        stream, _ = make_stream(streaming.EnrollmentStream, f'token={token}'.encode())
+        with mock.patch.object(views, 'register_frame', register_frame):
+            async def run():
+                await stream.connect()
+                for frame in (b'1', b'2', b'3', b'4'):
+                    await stream.handle_frame(frame)
+
+            asyncio.run(run())
+
+        # Frames a fraction of a second apart are all the same attempt
+        self.assertEqual(calls, [(0, 0), (0, 0), (0, 0), (1, 0)])
+        self.assertEqual(stream.attempt_count, 0)
+
+    def test_enrollment_attempts_are_counted_by_time(self):
+        token = get_enrollment_store().create()
+        clock = [100.0]
+
+        async def register_frame(token, frame, sample_count, attempt_count=0):
+            return {'success': False, 'error': 'Bad pose', 'attempt_count': attempt_count + 1}
+
+        stream, _ = make_stream(streaming.EnrollmentStream, f'token={token}'.encode())
+        with mock.patch.object(views, 'register_frame', register_frame), \
+                mock.patch.object(streaming, 'time', mock.Mock(monotonic=lambda: clock[0])):
+            async def run():
+                await stream.connect()
+                get_enrollment_store().add(token, np.zeros(128, dtype=np.float32))
+                stream.sample_count = 1
+                results = []
+                # A rejected frame every 250 ms for just under the pose's attempts
+                for _ in range(int(views.MAX_ATTEMPTS * streaming.POSE_ATTEMPT_SECONDS / 0.25)):
+                    results.append(await stream.handle_frame(b'frame'))
+                    clock[0] += 0.25
+                results.append(await stream.handle_frame(b'frame'))
+                return results
+
+            results = asyncio.run(run())
+
+        self.assertEqual(results[0]['attempt_count'], 0)
+        self.assertEqual(results[-2]['attempt_count'], views.MAX_ATTEMPTS - 1)
+        # Out of time, the pose starts over but the captured sample is kept
+        self.assertNotIn('reset', results[-1])
+        self.assertEqual(results[-1]['instruction'], views.POSES[1]['instruction'])
+        self.assertEqual((stream.sample_count, stream.attempt_count), (1, 0))
+        self.assertEqual(len(get_enrollment_store().pop(token)), 1)
+
+
+class FrameGateTests(TestCase):
+    def setUp(self):
+        self.frame = encode_jpeg(textured_frame())
+        get_frame_gate().invalidate()
+
+    def test_unchanged_frame_replays_the_previous_result(self):
+        gate = FrameGate(get_gating_config())
+        self.assertIsNone(gate.check(self.frame, ['motion'], 'client'))
+        gate.remember_result('client', {'name': 'Bob'})
+        self.assertEqual(gate.check(self.frame, ['motion'], 'client'), 'motion')
+        self.assertEqual(gate.previous_result('client'), {'name': 'Bob'})
+        self.assertIsNone(gate.check(encode_jpeg(textured_frame(seed=1)), ['motion'], 'client'))
+
+    def test_previous_result_expires(self):
+        gate = FrameGate({**get_gating_config(), 'MAX_RESULT_AGE': 0.0})
+        gate.check(self.frame, ['motion'], 'client')
+        gate.remember_result('client', {'name': 'Bob'})
+        self.assertIsNone(gate.previous_result('client'))
+        self.assertIsNone(gate.check(self.frame, ['motion'], 'client'))
+
+    def test_profile_changes_invalidate_the_gate(self):
+        gate = get_frame_gate()
+        gate.check(self.frame, ['motion'], 'client')
+        gate.remember_result('client', {'name': 'Bob'})
+        profile = FaceProfile(name='Bob')
+        profile.set_encodings(np.zeros((1, 128)))
+        with self.captureOnCommitCallbacks(execute=True):
+            profile.save()
+        self.assertIsNone(gate.previous_result('client'))
+
+        gate.check(self.frame, ['motion'], 'client')
+        gate.remember_result('client', {'name': 'Bob'})
+        with self.captureOnCommitCallbacks(execute=True):
+            profile.delete()
+        self.assertIsNone(gate.check(self.frame, ['motion'], 'client'))
+
+    def test_face_probe_finds_faces_at_webcam_sizes(self):
+        gate = FrameGate(get_gating_config())
+        stages = get_gating_config()['RECOGNITION_STAGES']
+        face = decode_image(read_testdata('astronaut.jpg'))
+        for width in (240, 320, 400, 640):
+            with self.subTest(width=width):
+                frame = encode_jpeg(cv2.resize(face, (width, width), interpolation=cv2.INTER_AREA))
+                self.assertIsNone(gate.check(frame, stages, face_fraction=get_detection_config()['FACE_FRACTION']))
+
+        no_face = encode_jpeg(textured_frame(width=640, height=480))
+        self.assertEqual(gate.check(no_face, stages, face_fraction=get_detection_config()['FACE_FRACTION']),
+                         'face_probe')
+
+    def test_probe_reduction_keeps_the_smallest_face_above_the_window(self):
+        gate = FrameGate(get_gating_config())
+        self.assertEqual(gate.probe_reduction(320, 0.25), 1)
+        self.assertEqual(gate.probe_reduction(640, 0.25), 2)
+        self.assertEqual(gate.probe_reduction(1920, 0.25), 4)
+        self.assertEqual(gate.probe_reduction(640, 0.1), 1)
+        # Group faces in a small frame are below the cascade window even at full size
+        self.assertIsNone(gate.probe_reduction(320, 0.1))
+        self.assertIsNone(gate.check(encode_jpeg(textured_frame()), ['face_probe'], face_fraction=0.1))
+
+    def test_gate_frame_proceeds_when_the_previous_result_is_gone(self):
+        with mock.patch.object(FrameGate, 'check', return_value='motion'):
+            self.assertIsNone(asyncio.run(views.gate_frame(self.frame, 'RECOGNITION_STAGES', 'client')))
+
+
+class DetectionPolicyTests(SimpleTestCase):
+    def setUp(self):
+        self.policy = DetectionPolicy({**get_detection_config(), 'MODEL': 'cnn'})
+        self.pool = mock.Mock(workers=2, pending=0, max_pending=8)
+
+    def test_scale_for_frame_size(self):
+        mode = default_detection_mode('hog')
+        # A quarter-width face in a 640 px frame is 160 px; 48 / 160 rounds to 2/8
+        self.assertEqual(mode.scale_for((480, 640, 3)), 0.25)
+        self.assertEqual(mode.scale_for((3000, 4000, 3)), mode.min_scale)
+        self.assertEqual(mode.scale_for((120, 160, 3)), mode.max_scale)
+        group = default_detection_mode('hog', group=True)
+        self.assertEqual(group.face_fraction, get_detection_config()['GROUP_FACE_FRACTION'])
+        self.assertGreater(group.scale_for((480, 640, 3)), mode.scale_for((480, 640, 3)))
+
+    def test_decode_reduction_keeps_faces_encodable(self):
+        mode = default_detection_mode('hog')
+        self.assertEqual(mode.decode_reduction((3000, 4000, 3), encode=False), 8)
+        # 1000 px faces stay above ENCODE_FACE_PX at 1/8, 160 px ones only at full size
+        self.assertEqual(mode.decode_reduction((3000, 4000, 3)), 8)
+        self.assertEqual(mode.decode_reduction((480, 640, 3)), 1)
+
+    def test_cnn_when_idle(self):
+        mode = self.policy.choose(self.pool)
+        self.assertEqual((mode.model, mode.reason, mode.target_face_px), ('cnn', 'normal', 48))
+
+    def test_hog_when_queue_is_deep(self):
+        self.pool.pending = 4
+        mode = self.policy.choose(self.pool)
+        self.assertEqual((mode.model, mode.reason), ('hog', 'queue'))
+        # Without workers the queue is never the bottleneck
+        self.pool.workers = 0
+        self.assertEqual(self.policy.choose(self.pool).model, 'cnn')
+
+    def test_hog_and_degraded_target_on_latency(self):
+        self.policy.record_latency('cnn', 2.0)
+        mode = self.policy.choose(self.pool)
+        self.assertEqual((mode.model, mode.reason, mode.target_face_px), ('hog', 'latency', 48))
+
+        self.policy.record_latency('hog', 1.0)
+        mode = self.policy.choose(self.pool, group=True)
+        self.assertEqual((mode.model, mode.reason), ('hog', 'latency'))
+        self.assertEqual(mode.target_face_px, get_detection_config()['DEGRADED_TARGET_FACE_PX'])
+        self.assertEqual(mode.face_fraction, get_detection_config()['GROUP_FACE_FRACTION'])
+
+    def test_latency_goes_stale(self):
+        self.policy.record_latency('cnn', 2.0)
+        self.policy.record_latency('cnn', 1.0)
+        self.assertAlmostEqual(self.policy.latency('cnn'), 1.8)
+        later = mock.Mock(monotonic=mock.Mock(return_value=time.monotonic() + 11))
+        with mock.patch('face_app.detection.time', later):
+            self.assertEqual(self.policy.latency('cnn'), 0.0)
+            self.assertEqual(self.policy.choose(self.pool).model, 'cnn')
+
+
+class FaceAnalysisTests(SimpleTestCase):
+    def setUp(self):
+        landmarks = {'left_eye': [(110, 120), (130, 120)], 'right_eye': [(170, 124), (190, 124)]}
+        self.face_recognition = mock.Mock()
+        self.face_recognition.face_locations.return_value = [(25, 60, 65, 20)]
+        self.face_recognition.face_landmarks.return_value = [landmarks]
+        self.face_recognition.face_encodings.return_value = [np.zeros(128)]
+        patcher = mock.patch.object(utils, 'face_recognition', self.face_recognition)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_detect_scales_the_box_back(self):
+        image = np.zeros((320, 320, 3), dtype=np.uint8)
+        analysis = FaceAnalysis.detect(image, use_cnn=False, scale=0.25)
+        small_image = self.face_recognition.face_locations.call_args.args[0]
+        self.assertEqual(small_image.shape[:2], (80, 80))
+        self.assertEqual(self.face_recognition.face_locations.call_args.kwargs, {'model': 'hog'})
+        self.assertEqual(analysis.location, (100, 240, 260, 80))
+
+        self.face_recognition.face_locations.return_value = []
+        self.assertIsNone(FaceAnalysis.detect(image))
+
+    def test_landmarks_and_encoding_are_computed_once(self):
+        analysis = FaceAnalysis(np.zeros((320, 320, 3), dtype=np.uint8), (80, 230, 230, 80))
+        for _ in range(3):
+            analysis.landmarks
+            analysis.alignment
+            analysis.encoding
+        self.face_recognition.face_landmarks.assert_called_once()
+        self.assertEqual(self.face_recognition.face_landmarks.call_args.kwargs,
+                         {'face_locations': [(80, 230, 230, 80)]})
+        self.face_recognition.face_encodings.assert_called_once()
+        self.face_recognition.face_locations.assert_not_called()
+
+
+class MetricsTests(SimpleTestCase):
+    def test_counter_render(self):
+        counter = Counter('face_test_total', 'Test outcomes.', ['pipeline', 'outcome'])
+        counter.inc('enroll', 'ok')
+        counter.inc('enroll', 'ok', amount=2)
+        counter.inc('enroll', 'no_face')
+        self.assertEqual(counter.render(), [
+            '# HELP face_test_total Test outcomes.',
+            '# TYPE face_test_total counter',
+            'face_test_total{pipeline="enroll",outcome="no_face"} 1',
+            'face_test_total{pipeline="enroll",outcome="ok"} 3',
+        ])
+
+    def test_histogram_render_is_cumulative(self):
+        histogram = Histogram('face_test_seconds', 'Test latency.', ['stage'], buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.7, 3.0):
+            histogram.observe(value, 'detect')
+        self.assertEqual(histogram.render()[2:], [
+            'face_test_seconds_bucket{stage="detect",le="0.1"} 1',
+            'face_test_seconds_bucket{stage="detect",le="1.0"} 3',
+            'face_test_seconds_bucket{stage="detect",le="+Inf"} 4',
+            'face_test_seconds_sum{stage="detect"} 4.25',
+            'face_test_seconds_count{stage="detect"} 4',
+        ])
+
+    def test_label_values_are_escaped(self):
+        counter = Counter('face_test_total', 'Test outcomes.', ['outcome'])
+        counter.inc('say "hi"\\path\nnext')
+        self.assertEqual(counter.render()[2], 'face_test_total{outcome="say \\"hi\\"\\\\path\\nnext"} 1')
+
+
+class TrackerTests(SimpleTestCase):
+    def make_tracker(self, **config):
+        return FaceTracker({**get_tracking_config(), **config})
+
+    def test_box_iou(self):
+        box = (0, 10, 10, 0)
+        np.testing.assert_allclose(box_iou(box, [box, (0, 15, 10, 5), (20, 30, 30, 20)]), [1.0, 1 / 3, 0.0])
+
+    def test_boxes_are_associated_by_overlap(self):
+        tracker = self.make_tracker()
+        first, second = tracker.update([(0, 100, 100, 0), (0, 300, 100, 200)])
+        # The faces moved a little and come back in the other order
+        again = tracker.update([(5, 305, 105, 205), (5, 105, 105, 5)])
+        self.assertEqual(again, [second, first])
+        self.assertEqual(first.box, (5, 105, 105, 5))
+
+        far = tracker.update([(0, 700, 100, 600)])[0]
+        self.assertNotIn(far, (first, second))
+
+    def test_identity_is_reused_until_it_decays_or_is_due(self):
+        tracker = self.make_tracker(REENCODE_INTERVAL=3, CONFIDENCE_DECAY=0.5, MIN_CONFIDENCE=0.1)
+        box = (0, 100, 100, 0)
+        track, = tracker.update([box])
+        self.assertTrue(tracker.needs_encoding(track))
+        tracker.record_match(track, (1, 'Bob', 0.3), 0.6)
+        self.assertEqual(track.confidence, 0.5)
+
+        tracker.update([box])
+        self.assertFalse(tracker.needs_encoding(track))
+        tracker.update([box])
+        tracker.update([box])
+        # 0.5 halved three times is below MIN_CONFIDENCE, and the interval is up too
+        self.assertTrue(tracker.needs_encoding(track))
+
+        tracker.record_match(track, (1, 'Bob', 0.3), 0.6)
+        tracker.invalidate()
+        self.assertTrue(tracker.needs_encoding(track))
+
+    def test_tracks_expire_after_max_missed(self):
+        tracker = self.make_tracker(MAX_MISSED=2)
+        track, = tracker.update([(0, 100, 100, 0)])
+        for _ in range(2):
+            tracker.update([])
+        self.assertEqual(tracker.tracks, [track])
+        tracker.update([])
+        self.assertEqual(tracker.tracks, [])
+        self.assertIsNot(tracker.update([(0, 100, 100, 0)])[0], track)
+
+    def test_registry_evicts_idle_and_least_recent_trackers(self):
+        registry = TrackerRegistry(max_trackers=2, idle_timeout=60)
+        first = registry.get('a')
+        registry.get('b')
+        self.assertIs(registry.get('a'), first)
+        registry.get('c')  # Evicts 'b', the least recently used
+        self.assertIs(registry.get('a'), first)
+        self.assertEqual(list(registry._trackers), ['c', 'a'])
+
+        registry._trackers['c'].last_used -= 61
+        registry.get('a')
+        self.assertEqual(list(registry._trackers), ['a'])
+
+
+class BulkEnrollTests(TestCase):
+    def enroll(self, entries, checkpoint, batch_size=2):
+        encoded = []
+
+        def enroll_image_job(path, use_cnn, scale):
+            encoded.append(path)
+            return {'status': 'ok', 'encoding': np.zeros(128, dtype=np.float32)}
+
+        options = {'hog': True, 'scale': 0.25, 'batch_size': batch_size, 'failures': None}
+        with mock.patch.object(bulk_enroll, 'enroll_image_job', enroll_image_job), ThreadPoolExecutor(1) as executor:
+            bulk_enroll.Command(stdout=io.StringIO()).enroll(executor, entries, checkpoint, options, max_in_flight=4)
+        return encoded
+
+    def test_a_batch_and_its_checkpoint_commit_together(self):
+        entries = [('Ann', 'ann.jpg'), ('Ben', 'ben.jpg'), ('Cat', 'cat.jpg')]
+        checkpoint = bulk_enroll.Checkpoint('/photos')
+        # The run dies while saving the first batch's checkpoint
+        with mock.patch.object(bulk_enroll.Checkpoint, 'save', side_effect=RuntimeError('killed')):
+            with self.assertRaises(RuntimeError):
+                self.enroll(entries, checkpoint)
+        self.assertFalse(FaceProfile.objects.exists())
+        self.assertEqual(checkpoint.position, 0)
+
+        checkpoint = bulk_enroll.Checkpoint('/photos')
+        self.assertFalse(checkpoint.load())
+        self.assertEqual(self.enroll(entries, checkpoint), ['ann.jpg', 'ben.jpg', 'cat.jpg'])
+        self.assertEqual(sorted(FaceProfile.objects.values_list('name', flat=True)), ['Ann', 'Ben', 'Cat'])
+
+    def test_resume_continues_after_the_last_committed_batch(self):
+        entries = [('Ann', 'ann.jpg'), ('Ben', 'ben.jpg'), ('Cat', 'cat.jpg')]
+        checkpoint = bulk_enroll.Checkpoint('/photos')
+        self.enroll(entries[:2], checkpoint)
+        # Someone with the same name registered through the web page meanwhile
+        FaceProfile.objects.create(name='Cat', encoding_data=b'')
+
+        checkpoint = bulk_enroll.Checkpoint('/photos')
+        self.assertTrue(checkpoint.load())
+        self.assertEqual(self.enroll(entries, checkpoint), ['cat.jpg'])
+        self.assertEqual(FaceProfile.objects.filter(name='Cat').count(), 2)
+        self.assertEqual((checkpoint.position, checkpoint.enrolled), (3, 3))
+
+        with self.assertRaises(bulk_enroll.CommandError):
+            bulk_enroll.Checkpoint('/other', checkpoint.key).load()
+
+    def test_fresh_run_enrolls_duplicate_names(self):
+        FaceProfile.objects.create(name='Ann', encoding_data=b'')
+        checkpoint = bulk_enroll.Checkpoint('/photos')
+        encoded = self.enroll([('Ann', 'ann.jpg')], checkpoint)
+        self.assertEqual(encoded, ['ann.jpg'])
+        self.assertEqual(FaceProfile.objects.filter(name='Ann').count(), 2)
+
+
+class BatchJobTests(SimpleTestCase):
+    def test_mixed_sizes_are_detected_at_their_own_scale(self):
+        face = read_testdata('astronaut.jpg')
+        # A large frame first would set a scale that shrinks the small frame's face below the detector's minimum
+        large = encode_jpeg(textured_frame(width=1280, height=960))
+        mode = default_detection_mode('hog')
+        job = encode_faces_batch_job([large, face, b'not an image'], mode)
+        self.assertEqual([result['status'] for result in job['results']], ['no_face', 'ok', 'invalid_image'])
+        # Each result describes the scale its own size group was detected at
+        self.assertEqual([result.get('detection') for result in job['results']],
+                         [mode.describe((960, 1280, 3)), mode.describe((320, 320, 3)), None])
+        self.assertNotEqual(mode.scale_for((960, 1280, 3)), mode.scale_for((320, 320, 3)))
+
+
+class MultiFaceJobTests(SimpleTestCase):
+    def test_every_face_is_encoded(self):
+        face = decode_image(read_testdata('astronaut.jpg'))
+        single = encode_face_job(encode_jpeg(face), default_detection_mode('hog'))['encoding']
+        pair = encode_jpeg(np.hstack([face, face]))
+        job = encode_all_faces_job(pair, default_detection_mode('hog', group=True))
+        self.assertEqual(job['status'], 'ok')
+        self.assertEqual(len(job['boxes']), 2)
+        self.assertEqual(len(job['encodings']), 2)
+        # One face in each half, both the same person as the single-face encoding
+        centres = sorted((left + right) / 2 for _, right, _, left in job['boxes'])
+        self.assertLess(centres[0], face.shape[1])
+        self.assertGreater(centres[1], face.shape[1])
+        for encoding in job['encodings']:
+            self.assertLess(np.linalg.norm(np.asarray(encoding) - single), 0.3)
+
+    def test_no_face(self):
+        job = encode_all_faces_job(encode_jpeg(textured_frame()), default_detection_mode('hog', group=True))
+        self.assertEqual(job['status'], 'no_face')
+
+
+class PipelineBenchmarkTests(SimpleTestCase):
+    def test_both_pipelines_run_at_the_policy_scale(self):
+        face = decode_image(read_testdata('astronaut.jpg'))
+        rows = bench_pipeline(face, repeats=1, use_cnn=False)
+        scale = default_detection_mode('hog').scale_for(face.shape)
+        self.assertEqual([(row['pipeline'], row['scale']) for row in rows], [('legacy', scale), ('unified', scale)])
+        self.assertIn('speedup', rows[1])
+
+    def test_no_face_is_an_error_not_a_speedup(self):
+        with self.assertRaises(ValueError):
+            bench_pipeline(textured_frame(), repeats=1, use_cnn=False)
+
+
+class RecognitionCacheTests(TestCase):
+    def setUp(self):
+        self.cache = RecognitionCache(get_recognition_cache_config())
+        self.frame = encode_jpeg(textured_frame())
+
+    def test_near_identical_frames_share_a_result(self):
+        key = self.cache.frame_key(self.frame, ('face', 'client'))
+        self.cache.put_result(key, {'name': 'Bob'})
+        noisy = textured_frame().astype(np.int16) + np.random.default_rng(0).integers(-2, 3, (240, 320, 3))
+        again = self.cache.frame_key(encode_jpeg(np.clip(noisy, 0, 255).astype(np.uint8)), ('face', 'client'))
+        self.assertEqual(self.cache.get_result(again), {'name': 'Bob'})
+        self.assertIsNone(self.cache.get_result(self.cache.frame_key(self.frame, ('face', 'other'))))
+        self.assertIsNone(self.cache.get_result(self.cache.frame_key(encode_jpeg(textured_frame(seed=1)),
+                                                                     ('face', 'client'))))
+
+    def test_close_encodings_reuse_a_candidate(self):
+        encoding = np.random.default_rng(0).normal(0, 0.1, 128).astype(np.float32)
+        self.cache.put_candidate(encoding, 1, self.cache.generation)
+        far = encoding + 0.05
+        self.assertEqual(self.cache.get_candidates(np.stack([encoding + 0.001, far])), [1, None])
+
+    def test_cached_candidates_are_scored_against_the_new_encoding(self):
+        rng = np.random.default_rng(0)
+        bob = rng.normal(0, 0.1, 128).astype(np.float32)
+        gallery = GalleryIndex({'BACKEND': 'face_app.search.ExactSearch', 'OPTIONS': {}, 'INDEX_PATH': None})
+        profiles = (np.stack([bob, bob + 1.0]), np.array([1, 2]), {1: 'Bob', 2: 'Alice'})
+        with mock.patch.object(GalleryIndex, 'load_profiles', return_value=profiles):
+            gallery.build()
+        # Remembered when a probe 0.55 from Bob matched him
+        direction = rng.normal(0, 1, 128).astype(np.float32)
+        direction /= np.linalg.norm(direction)
+        self.cache.put_candidate(bob + 0.55 * direction, 1, self.cache.generation)
+
+        probe = bob + 0.63 * direction  # 0.08 from the remembered encoding, but past the tolerance
+        with mock.patch.object(views, 'get_recognition_cache', return_value=self.cache), \
+                mock.patch.object(views, 'get_gallery', return_value=gallery), \
+                mock.patch.object(gallery, 'search_batch', wraps=gallery.search_batch) as search_batch:
+            close, = views.match_encodings([bob + 0.5 * direction])
+            far, = views.match_encodings([probe])
+
+        self.assertEqual(close[:2], (1, 'Bob'))
+        self.assertAlmostEqual(close[2], 0.5, places=3)
+        # The close probe was scored without a gallery search; the far one fell back to one
+        self.assertEqual(search_batch.call_count, 1)
+        self.assertAlmostEqual(far[2], 0.63, places=3)
+        self.assertIsNone(views.match_result(far)['name'])
+
+    def test_invalidate_drops_results_and_late_writes(self):
+        key = self.cache.frame_key(self.frame, ('face', 'client'))
+        generation = self.cache.generation
+        self.cache.put_result(key, {'name': 'Bob'})
+        self.cache.invalidate()
+        self.assertIsNone(self.cache.get_result(key))
+        # Results computed before the invalidation are not stored afterwards
+        self.cache.put_result(key, {'name': 'Bob'})
+        self.cache.put_candidate(np.zeros(128), 1, generation)
+        self.assertIsNone(self.cache.get_result(self.cache.frame_key(self.frame, ('face', 'client'))))
+        self.assertEqual(self.cache.get_candidates(np.zeros((1, 128), dtype=np.float32)), [None])
+
+    def test_profile_changes_invalidate_the_cache(self):
+        cache = get_recognition_cache()
+        generation = cache.generation
+        with self.captureOnCommitCallbacks(execute=True):
+            FaceProfile.objects.create(name='Bob', encoding_data=b'')
+        self.assertGreater(cache.generation, generation)
+
+    def test_anonymous_clients_skip_the_frame_cache(self):
+        self.assertEqual(asyncio.run(views.cached_frame(self.frame, 'face', None)), (None, None))
+        key, cached = asyncio.run(views.cached_frame(self.frame, 'face', 'client'))
+        self.assertEqual(key.scope, ('face', 'client'))
+
+
+def baseline_pose_checks(landmarks):
+    """
+    The per-pose checks registration used before face_app.pose, on a 400 px wide capture.
+    """
+    left_eye = np.mean(landmarks['left_eye'], axis=0)
+    right_eye = np.mean(landmarks['right_eye'], axis=0)
+    nose_tip = landmarks['nose_tip'][0]
+    mouth = np.mean(landmarks['top_lip'], axis=0)
+    eye_angle = math.degrees(math.atan2(right_eye[1] - left_eye[1], right_eye[0] - left_eye[0]))
+    left_ratio = (nose_tip[0] - left_eye[0]) / (right_eye[0] - left_eye[0])
+    right_ratio = (right_eye[0] - nose_tip[0]) / (right_eye[0] - left_eye[0])
+    eye_mouth_distance = np.linalg.norm(np.mean([left_eye, right_eye], axis=0) - mouth)
+    return {
+        'front': abs(eye_angle) < 15,
+        'left': left_ratio > 0.30 and right_ratio < 0.70,
+        'right': left_ratio < 0.30 and right_ratio > 0.70,
+        'up': eye_mouth_distance < 55,
+        'down': 50 < eye_mouth_distance < 62,
+    }
+
+
+def random_landmarks(rng):
+    """
+    A landmark dict with eyes, nose and lip points spread around a face of random size, roll and yaw.
+    """
+    scale = rng.uniform(20, 50)
+    angle = np.radians(rng.uniform(-30, 30))
+    rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    centres = {'left_eye': (-1, 0), 'right_eye': (1, 0), 'nose_tip': (rng.uniform(-1.2, 1.2), 1),
+               'top_lip': (0, rng.uniform(1.2, 2.2))}
+    counts = {'left_eye': 6, 'right_eye': 6, 'nose_tip': 5, 'top_lip': 12}
+    return {part: [tuple(rotation @ (np.array(centres[part]) + rng.normal(0, 0.05, 2)) * scale + 200)
+                   for _ in range(counts[part])] for part in LANDMARK_PARTS}
+
+
+class PoseTests(SimpleTestCase):
+    def test_matches_the_baseline_checks_on_400px_frames(self):
+        rng = np.random.default_rng(0)
+        faces = [random_landmarks(rng) for _ in range(500)]
+        poses = classify_poses(pose_features(np.stack([landmarks_array(face) for face in faces]), 400))
+        for face, matches in zip(faces, poses):
+            self.assertEqual(dict(zip(POSES, matches.tolist())), baseline_pose_checks(face))
+        # Every pose occurs, so each threshold was exercised
+        self.assertTrue(poses.any(axis=0).all())
+
+    def test_frame_size_does_not_change_the_pose(self):
+        rng = np.random.default_rng(1)
+        for _ in range(100):
+            face = random_landmarks(rng)
+            half = {part: [(x / 2, y / 2) for x, y in points] for part, points in face.items()}
+            for pose in POSES:
+                self.assertEqual(pose_matches(half, pose, 200), pose_matches(face, pose, 400))
+
+
+def brute_force(encodings, labels, queries, k):
+    """
+    Top-k labels of each query, each label scored by its nearest row.
+    """
+    results = []
+    for query in queries:
+        distances = np.linalg.norm(encodings - query, axis=1)
+        best = {}
+        for label, distance in zip(labels.tolist(), distances.tolist()):
+            best[label] = min(distance, best.get(label, np.inf))
+        results.append(sorted(best.items(), key=lambda item: item[1])[:k])
+    return results
+
+
+class SearchBackendTests:
+    """
+    Checks a backend against brute force. Mixed into a TestCase per backend.
+    """
+
+    k = 3
+
+    def make_backend(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.encodings, self.labels, centres = synthetic_gallery(300, samples_per_profile=4, seed=0)
+        self.queries, _ = synthetic_queries(centres, 40, seed=1)
+        self.backend = self.make_backend()
+        self.backend.build(self.encodings, self.labels)
+
+    def assertMatchesBruteForce(self, encodings, labels):
+        expected = brute_force(encodings, labels, self.queries, self.k)
+        found = self.backend.search_batch(self.queries, k=self.k)
+        self.assertEqual([[label for label, _ in matches] for matches in found],
+                         [[label for label, _ in matches] for matches in expected])
+        for matches, expected_matches in zip(found, expected):
+            np.testing.assert_allclose([d for _, d in matches], [d for _, d in expected_matches], atol=1e-4)
+        for query, matches in zip(self.queries[:5], found):
+            single = self.backend.search(query, k=self.k)
+            self.assertEqual([label for label, _ in single], [label for label, _ in matches])
+
+    def test_search_matches_brute_force(self):
+        self.assertMatchesBruteForce(self.encodings, self.labels)
+        self.assertEqual(len(self.backend), len(self.labels))
+
+    def test_add_and_remove(self):
+        removed = int(brute_force(self.encodings, self.labels, self.queries[:1], 1)[0][0][0])
+        self.backend.remove(removed)
+        added = self.queries[:2] + 0.001
+        self.backend.add(added, 1000)
+        self.backend.add(self.encodings[self.labels == 5][:1], 5)  # Replaces the profile's samples
+
+        keep = (self.labels != removed) & (self.labels != 5)
+        encodings = np.concatenate([self.encodings[keep], added, self.encodings[self.labels == 5][:1]])
+        labels = np.concatenate([self.labels[keep], [1000, 1000], [5]])
+        self.assertMatchesBruteForce(encodings, labels)
+        self.assertEqual(len(self.backend), len(labels))
+        self.assertEqual(self.backend.search(self.queries[0], k=1)[0][0], 1000)
+
+    def test_label_distances(self):
+        self.backend.remove(7)
+        self.backend.add(self.queries[:1] + 0.001, 1000)
+        labels = [3, 7, 1000, 12345]
+        found = self.backend.label_distances(self.queries[:4], labels)
+        expected = np.linalg.norm(self.encodings[self.labels == 3] - self.queries[0], axis=1).min()
+        self.assertAlmostEqual(found[0], expected, places=4)
+        self.assertIsNone(found[1])
+        self.assertAlmostEqual(found[2], np.linalg.norm(self.queries[0] + 0.001 - self.queries[2]), places=4)
+        self.assertIsNone(found[3])
+
+
+class ExactSearchTests(SearchBackendTests, SimpleTestCase):
+    def make_backend(self):
+        return ExactSearch()
+
+
+class IVFSearchTests(SearchBackendTests, SimpleTestCase):
+    def make_backend(self):
+        # Probing every list makes the approximate search exact
+        return IVFSearch(nlist=8, nprobe=8)
+
+    def test_is_trained(self):
+        self.assertTrue(self.backend.is_trained)
+
+    def test_untrained_index_is_exact(self):
+        self.backend = IVFSearch(nlist=64)
+        self.backend.build(self.encodings, self.labels)
+        self.assertFalse(self.backend.is_trained)
+        self.assertMatchesBruteForce(self.encodings, self.labels)
+
+
+class ShardedSearchTests(SearchBackendTests, SimpleTestCase):
+    processes = False
+
+    def make_backend(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        backend = ShardedSearch(shards=3, directory=directory.name, processes=self.processes)
+        self.addCleanup(backend.close)
+        return backend
+
+    def test_profiles_live_in_one_shard(self):
+        shard_labels = [set(np.load(f'{self.backend.shard_path(shard)}.labels.npy').tolist())
+                        for shard in range(3)]
+        self.assertEqual(sum(len(labels) for labels in shard_labels), len(set(self.labels.tolist())))
+        for shard, labels in enumerate(shard_labels):
+            self.assertTrue(all(self.backend.shard_for(label) == shard for label in labels))
+
+    def test_rebuild_reloads_the_shards(self):
+        keep = self.labels < 100
+        self.backend.build(self.encodings[keep], self.labels[keep])
+        self.assertMatchesBruteForce(self.encodings[keep], self.labels[keep])
+
+
+class ShardWorkerTests(ShardedSearchTests):
+    processes = True
+
+
+class ShardIndexTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'gallery')
+        self.encodings, self.labels, centres = synthetic_gallery(50, samples_per_profile=3)
+        self.queries, _ = synthetic_queries(centres, 10)
+        save_array(f'{self.path}.encodings.npy', self.encodings)
+        save_array(f'{self.path}.labels.npy', self.labels)
+
+    def test_rows_stay_mapped_and_removals_are_masked(self):
+        index = ShardIndex(self.path)
+        self.assertIsInstance(index._base.arrays[0].base, np.memmap)  # A view, not a copy
+        nearest = index.search(self.queries[0])[0][0]
+        index.remove(nearest)
+        self.assertEqual(len(index), len(self.labels) - 3)
+        self.assertNotIn(nearest, [label for label, _ in index.search(self.queries[0], k=5)])
+        # The file itself is untouched
+        self.assertIn(nearest, np.load(f'{self.path}.labels.npy').tolist())
+
+        index.add(self.queries[0][None, :], nearest)
+        (label, distance), = index.search(self.queries[0])
+        self.assertEqual(label, nearest)
+        self.assertAlmostEqual(distance, 0.0, places=2)
+        self.assertEqual(len(index), len(self.labels) - 2)
+
+    def test_stored_norms_are_used(self):
+        save_array(f'{self.path}.norms.npy', np.einsum('ij,ij->i', self.encodings, self.encodings))
+        index = ShardIndex(self.path)
+        self.assertIsInstance(index._base.arrays[2], np.memmap)
+        expected = brute_force(self.encodings, self.labels, self.queries, 2)
+        self.assertEqual([[label for label, _ in matches] for matches in index.search_batch(self.queries, k=2)],
+                         [[label for label, _ in matches] for matches in expected])
+
+
+class SharedNamesTests(SimpleTestCase):
+    def write_names(self, names):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'gallery')
+        SharedGalleryIndex._write_names(path, *encode_names(names))
+        return MappedNames(path)
+
+    def test_merge_names_matches_a_fresh_encoding(self):
+        names = {5: 'Eve', 1: 'Ann', 3: 'Chloé', 9: ''}
+        changes = {3: None, 2: 'Björn', 9: 'Ida', 1: 'Anne', 4: None}
+        merged = merge_names(*encode_names(names), changes)
+        updated = {**names, **changes}
+        expected = encode_names({label: name for label, name in updated.items() if name is not None})
+        for array, expected_array in zip(merged, expected):
+            np.testing.assert_array_equal(array, expected_array)
+
+    def test_mapped_names_lookup_and_overlay(self):
+        names = self.write_names({1: 'Ann', 3: 'Chloé', 5: 'Eve'})
+        self.assertEqual(names[3], 'Chloé')
+        self.assertNotIn(2, names)
+        names.overlay.update({2: 'Ben', 3: None, 5: 'Eva'})
+        self.assertEqual(dict(names), {1: 'Ann', 2: 'Ben', 5: 'Eva'})
+        self.assertEqual(len(names), 3)
+        with self.assertRaises(KeyError):
+            names[3]
+
+
+class EncodingStorageTests(SimpleTestCase):
+    def test_packed_encodings_decode_without_a_copy(self):
+        encodings = np.random.default_rng(0).normal(size=(3, 128))
+        data = pack_encodings(encodings)
+        self.assertEqual(len(data), 3 * 128 * 4)
+        decoded = unpack_encodings(data)
+        np.testing.assert_array_equal(decoded, encodings.astype(np.float32))
+        self.assertFalse(decoded.flags.writeable)
+        self.assertFalse(decoded.flags.owndata)
+
+    def test_legacy_json_is_read_as_a_fallback(self):
+        profile = FaceProfile(face_encodings=json.dumps([[0.5] * 128]))
+        np.testing.assert_array_equal(profile.get_encodings(), np.full((1, 128), 0.5, dtype=np.float32))
+        self.assertEqual(FaceProfile().get_encodings().shape, (0, 128))
+
+
+class EncodingMigrationTests(TransactionTestCase):
+    before = [('face_app', '0002_remove_faceprofile_face_encoding_and_more')]
+    after = [('face_app', '0003_faceprofile_encoding_data')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes('face_app'))
+
+    def test_backfill_and_reverse(self):
+        encodings = np.random.default_rng(0).normal(size=(2, 128)).astype(np.float32)
+        old_apps = self.migrate(self.before)
+        OldProfile = old_apps.get_model('face_app', 'FaceProfile')
+        legacy = OldProfile.objects.create(name='Legacy', face_encodings=json.dumps(encodings.tolist()))
+
+        new_apps = self.migrate(self.after)
+        migrated = new_apps.get_model('face_app', 'FaceProfile').objects.get(pk=legacy.pk)
+        self.assertEqual(migrated.face_encodings, '')
+        np.testing.assert_array_equal(np.frombuffer(migrated.encoding_data, dtype='<f4').reshape(-1, 128), encodings)
+
+        old_apps = self.migrate(self.before)
+        restored = old_apps.get_model('face_app', 'FaceProfile').objects.get(pk=legacy.pk)
+        np.testing.assert_array_equal(np.array(json.loads(restored.face_encodings), dtype=np.float32), encodings)
+
+
+class GalleryIndexTests(TestCase):
+    def setUp(self):
+        self.encodings, labels, centres = synthetic_gallery(10, samples_per_profile=3)
+        self.queries, self.query_labels = synthetic_queries(centres, 20)
+        self.profiles = []
+        for label in range(10):
+            profile = FaceProfile(name=f'Person {label}')
+            profile.set_encodings(self.encodings[labels == label])
+            profile.save()
+            self.profiles.append(profile)
+        FaceProfile.objects.create(name='No samples', encoding_data=b'')
+        self.gallery = GalleryIndex({'BACKEND': 'face_app.search.ExactSearch', 'OPTIONS': {}, 'INDEX_PATH': None})
+        patcher = mock.patch('face_app.signals.get_gallery', return_value=self.gallery)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_builds_from_the_database_on_first_search(self):
+        self.assertFalse(self.gallery.is_built)
+        matches = self.gallery.search_batch(self.queries, k=2)
+        self.assertTrue(self.gallery.is_built)
+        self.assertEqual(len(self.gallery), 10)
+        self.assertEqual([found[0][1] for found in matches], [f'Person {label}' for label in self.query_labels])
+        # Each profile is scored by its nearest sample, so the runner-up is another profile
+        self.assertTrue(all(found[0][0] != found[1][0] for found in matches))
+        profile = self.profiles[self.query_labels[0]]
+        expected = np.linalg.norm(profile.get_encodings() - self.queries[0], axis=1).min()
+        self.assertAlmostEqual(self.gallery.search(self.queries[0])[0][2], expected, places=4)
+
+    def test_profile_changes_are_applied_on_commit(self):
+        self.gallery.ensure_built()
+        added = FaceProfile(name='Newcomer')
+        added.set_encodings(self.queries[:1])
+        with self.captureOnCommitCallbacks(execute=True):
+            added.save()
+            self.profiles[self.query_labels[1]].delete()
+        self.assertEqual(self.gallery.search(self.queries[0])[0][:2], (added.pk, 'Newcomer'))
+        self.assertNotEqual(self.gallery.search(self.queries[1])[0][1], f'Person {self.query_labels[1]}')
+        self.assertEqual(len(self.gallery), 10)
+
+
+class SharedGalleryTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.config = {**DEFAULT_SHARED_GALLERY, 'DIRECTORY': directory.name, 'POLL_INTERVAL': 0.0,
+                       'EXPORT_DELAY': 60.0, 'COPY_CHUNK_ROWS': 4}
+        self.encodings, labels, centres = synthetic_gallery(20, samples_per_profile=3)
+        self.queries, _ = synthetic_queries(centres, 10)
+        self.profiles = []
+        for label in range(20):
+            profile = FaceProfile(name=f'Person {label}')
+            profile.set_encodings(self.encodings[labels == label])
+            profile.save()
+            self.profiles.append(profile)
+
+    def make_gallery(self):
+        gallery = SharedGalleryIndex(self.config)
+        self.addCleanup(gallery.flush)
+        return gallery
+
+    def test_workers_share_one_exported_version(self):
+        first, second = self.make_gallery(), self.make_gallery()
+        first.ensure_built()
+        second.ensure_built()
+        self.assertEqual(first.version, second.version)
+        self.assertEqual(len(first), 20)
+        match = second.search(self.queries[0])[0]
+        self.assertEqual(match[1], FaceProfile.objects.get(pk=match[0]).name)
+
+    def test_changes_are_exported_and_picked_up(self):
+        first, second = self.make_gallery(), self.make_gallery()
+        first.ensure_built()
+        second.ensure_built()
+        removed, renamed = self.profiles[0], self.profiles[1]
+        renamed.name = 'Renamed'
+        first.remove_profile(removed.pk)
+        first.add_profile(renamed)
+        # Applied at once in the worker that made the change
+        self.assertNotIn(removed.pk, first.names)
+        self.assertEqual(first.names[renamed.pk], 'Renamed')
+
+        first.flush()
+        self.assertNotEqual(first.version, second.version)
+        self.assertFalse(first.names.overlay)
+        second.ensure_built()
+        self.assertEqual(second.version, first.version)
+        self.assertEqual(second.names[renamed.pk], 'Renamed')
+        self.assertNotIn(removed.pk, second.names)
+        self.assertEqual(len(second), 19)
+        self.assertEqual(len(second.backend), 57)
+        results = second.search_batch(self.encodings, k=1)
+        self.assertNotIn(removed.pk, [matches[0][0] for matches in results])
+
+    def test_old_versions_are_pruned(self):
+        gallery = self.make_gallery()
+        gallery.ensure_built()
+        for profile in self.profiles[:3]:
+            gallery.remove_profile(profile.pk)
+            gallery.flush()
+        versions = sorted(name for name in os.listdir(self.config['DIRECTORY']) if name.startswith('v'))
+        self.assertEqual(versions, ['v000003', 'v000004'])
+        self.assertEqual(gallery.version, 'v000004')
+
+    def test_pending_changes_are_exported_at_exit(self):
+        with mock.patch('face_app.gallery.atexit.register') as register:
+            gallery = self.make_gallery()
+        gallery.ensure_built()
+        gallery.remove_profile(self.profiles[0].pk)
+        version = gallery.version
+
+        flush_at_exit, gallery_ref = register.call_args.args
+        flush_at_exit(gallery_ref)
+        self.assertIsNone(gallery._export_timer)
+        self.assertNotEqual(gallery.current_version(), version)
+        other = self.make_gallery()
+        other.ensure_built()
+        self.assertNotIn(self.profiles[0].pk, other.names)
+
+    def test_a_new_version_is_swapped_in_as_one_snapshot(self):
+        gallery = self.make_gallery()
+        gallery.ensure_built()
+        before = gallery.snapshot
+        renamed = self.profiles[1]
+        renamed.name = 'Renamed'
+        gallery.add_profile(renamed)
+        gallery.flush()
+        # A search that started on the old snapshot keeps its rows and names together
+        self.assertIsNot(gallery.snapshot, before)
+        self.assertEqual(before.names[renamed.pk], 'Renamed')
+        self.assertEqual(gallery.snapshot.names[renamed.pk], 'Renamed')
+        self.assertFalse(gallery.snapshot.names.overlay)
+        self.assertEqual(len(gallery.snapshot.backend), len(before.backend))
+
+
+class LazyModelTests(SimpleTestCase):
+    def test_loaded_on_first_attribute_access(self):
+        module = mock.Mock(face_locations=mock.sentinel.face_locations)
+        lazy = LazyModule('face_recognition')
+        with mock.patch('face_app.utils.importlib.import_module', return_value=module) as import_module:
+            self.assertFalse(lazy.is_loaded)
+            self.assertIs(lazy.face_locations, mock.sentinel.face_locations)
+            self.assertIs(lazy.face_locations, mock.sentinel.face_locations)
+        import_module.assert_called_once_with('face_recognition')
+        self.assertTrue(lazy.is_loaded)
+
+    def test_load_models_only_loads_once(self):
+        lazy = mock.Mock(is_loaded=True)
+        with mock.patch.object(utils, 'face_recognition', lazy):
+            self.assertEqual(load_models(), 0.0)
+        lazy.load.assert_not_called()
+
+    def test_startup_does_not_import_face_recognition(self):
+        code = (
+            'import sys, django; django.setup(); '
+            'from django.urls import resolve; resolve("/"); '
+            'import face_app.admin, face_app.views, face_app.jobs, face_app.signals; '
+            'print("face_recognition" in sys.modules)'
+        )
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                                cwd=settings.BASE_DIR)
+        self.assertEqual(result.stdout.strip(), 'False')
+
+
+class ImageSizeTests(SimpleTestCase):
+    def test_reads_the_size_from_the_header(self):
+        image = textured_frame(width=320, height=240)
+        self.assertEqual(image_size(encode_jpeg(image)), (240, 320))
+        self.assertEqual(image_size(cv2.imencode('.png', image)[1].tobytes()), (240, 320))
+        progressive = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_PROGRESSIVE, 1])[1].tobytes()
+        self.assertEqual(image_size(progressive), (240, 320))
+        self.assertEqual(image_size(read_testdata('astronaut.jpg')), (320, 320))
+
+    def test_other_or_truncated_data(self):
+        jpeg = encode_jpeg(textured_frame())
+        self.assertIsNone(image_size(jpeg[:20]))
+        self.assertIsNone(image_size(b'GIF89a' + bytes(20)))
+        self.assertIsNone(image_size(b''))
+
+    def test_reduced_decode(self):
+        jpeg = encode_jpeg(textured_frame(width=320, height=240))
+        self.assertEqual(decode_image(jpeg, 4).shape, (60, 80, 3))
+        self.assertIsNone(decode_image(b'not an image'))
+
+
+class EnrollmentStoreTests:
+    """
+    Behaviour shared by every enrollment store. Mixed into a TestCase per store.
+    """
+
+    def make_store(self, **options):
+        raise NotImplementedError
+
+    def test_samples_round_trip(self):
+        store = self.make_store()
+        token = store.create()
+        samples = np.random.default_rng(0).normal(size=(3, 128)).astype(np.float32)
+        self.assertEqual([store.add(token, sample) for sample in samples], [1, 2, 3])
+        np.testing.assert_array_equal(store.pop(token), samples)
+        self.assertIsNone(store.pop(token))
+
+    def test_tokens_are_separate_and_unknown_tokens_rejected(self):
+        store = self.make_store()
+        first, second = store.create(), store.create()
+        self.assertNotEqual(first, second)
+        store.add(first, np.ones(128))
+        self.assertEqual(len(store.pop(second)), 0)
+        self.assertIsNone(store.add('unknown', np.ones(128)))
+        self.assertFalse(store.reset('unknown'))
+
+    def test_reset_discards_samples(self):
+        store = self.make_store()
+        token = store.create()
+        store.add(token, np.ones(128))
+        self.assertTrue(store.reset(token))
+        self.assertEqual(store.add(token, np.zeros(128)), 1)
+
+    def test_sample_limit(self):
+        store = self.make_store(max_samples=2)
+        token = store.create()
+        self.assertEqual([store.add(token, np.ones(128)) for _ in range(3)], [1, 2, None])
+
+    def test_expiry(self):
+        store = self.make_store(ttl=0)
+        token = store.create()
+        self.assertIsNone(store.add(token, np.ones(128)))
+        self.assertIsNone(store.pop(token))
+
+
+class LocalEnrollmentStoreTests(EnrollmentStoreTests, SimpleTestCase):
+    def make_store(self, **options):
+        return LocalEnrollmentStore(**options)
+
+    def test_least_recently_used_enrollments_are_evicted(self):
+        store = LocalEnrollmentStore(max_enrollments=2)
+        first, second = store.create(), store.create()
+        store.add(first, np.ones(128))
+        store.create()
+        self.assertIsNone(store.pop(second))
+        self.assertEqual(len(store.pop(first)), 1)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                       'LOCATION': 'enrollment-tests'}})
+class CacheEnrollmentStoreTests(EnrollmentStoreTests, SimpleTestCase):
+    def make_store(self, **options):
+        return CacheEnrollmentStore(**options)
+
+
+@override_settings(FACE_INFERENCE={**settings.FACE_INFERENCE, 'WORKERS': 0})
+class ViewTests(TransactionTestCase):
+    """
+    The recognition and registration views through the test client, with
+    inference inline (WORKERS=0) and HOG detection. The views read the
+    database from worker threads, so the test data has to be committed.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.face = read_testdata('astronaut.jpg')
+        cls.encoding = encode_face_job(cls.face, default_detection_mode('hog'))['encoding']
+
+    def setUp(self):
+        profile = FaceProfile(name='Astronaut')
+        profile.set_encodings(self.encoding[None, :])
+        profile.save()
+
+        config = get_inference_config()
+        pool = InferencePool(config['WORKERS'], config['MAX_PENDING'], config['TIMEOUT'])
+        policy = DetectionPolicy({**get_detection_config(), 'MODEL': 'hog'})
+        for name, value in (('get_inference_pool', pool), ('get_detection_policy', policy),
+                            ('get_gallery', GalleryIndex()), ('get_frame_gate', FrameGate())):
+            patcher = mock.patch.object(views, name, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        get_recognition_cache().invalidate()
+        get_tracker_registry().invalidate()
+
+    def post_frame(self, image_bytes, **data):
+        return self.client.post('/test_face/', {'image': SimpleUploadedFile('frame.jpg', image_bytes), **data}).json()
+
+    def test_recognizes_an_enrolled_face(self):
+        result = self.post_frame(self.face)
+        self.assertTrue(result['success'])
+        self.assertEqual(result['name'], 'Astronaut')
+        self.assertEqual(result['detection']['model'], 'hog')
+
+    def test_accepts_base64_frames(self):
+        image_data = 'data:image/jpeg;base64,' + base64.b64encode(self.face).decode('ascii')
+        result = self.client.post('/test_face/', {'image': image_data}).json()
+        self.assertEqual(result['name'], 'Astronaut')
+
+    def test_multi_face(self):
+        result = self.post_frame(self.face, multi_face='1')
+        self.assertEqual([face['name'] for face in result['faces']], ['Astronaut'])
+
+    def test_tracked_session_reuses_the_identity(self):
+        self.client.session.save()
+        first = self.post_frame(self.face)
+        # A different frame of the same scene, so neither the gate nor the frame cache answers it
+        shifted = encode_jpeg(np.roll(decode_image(self.face), 4, axis=1))
+        second = self.post_frame(shifted)
+        self.assertEqual((first['name'], first['reused']), ('Astronaut', False))
+        self.assertEqual((second['name'], second['track_id'], second['reused']), ('Astronaut', first['track_id'], True))
+
+    def test_rejects_frames_without_a_face(self):
+        result = self.post_frame(encode_jpeg(textured_frame()))
+        self.assertFalse(result['success'])
+        self.assertEqual(result['gated'], 'face_probe')
+        self.assertEqual(self.client.post('/test_face/').json()['error'], 'No image data received.')
+
+    def test_recognize_batch(self):
+        response = self.client.post('/recognize_batch/', {'images': [SimpleUploadedFile('a.jpg', self.face),
+                                                                     SimpleUploadedFile('b.jpg', b'not an image')]})
+        results = response.json()['results']
+        self.assertEqual(results[0]['name'], 'Astronaut')
+        self.assertEqual(results[0]['detection']['model'], 'hog')
+        self.assertEqual(results[1]['error'], 'Could not decode image.')
+        self.assertNotIn('detection', results[1])
+
+        images = [base64.b64encode(self.face).decode('ascii')] * (views.MAX_BATCH_IMAGES + 1)
+        response = self.client.post('/recognize_batch/', json.dumps({'images': images}), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_registration(self):
+        token = self.client.get('/register_face/').context['enrollment_token']
+        result = self.client.post('/register_face/', {'image': SimpleUploadedFile('frame.jpg', self.face),
+                                                      'token': token, 'sample_count': 0}).json()
+        self.assertTrue(result['success'])
+        self.assertEqual((result['sample_count'], result['attempt_count']), (1, 0))
+
+        result = self.client.post('/save_face_profile/', {'name': 'Eileen', 'token': token}).json()
+        self.assertTrue(result['success'])
+        np.testing.assert_allclose(FaceProfile.objects.get(name='Eileen').get_encodings(), self.encoding[None, :],
+                                   atol=1e-6)
+        # The enrollment is used up
+        self.assertFalse(self.client.post('/save_face_profile/', {'name': 'Eileen', 'token': token}).json()['success'])
+
+    def test_next_pose_resets_after_max_attempts(self):
+        result = self.client.get('/get_next_pose/', {'sample_count': 1, 'attempt_count': views.MAX_ATTEMPTS}).json()
+        self.assertTrue(result['reset'])
+        result = self.client.get('/get_next_pose/', {'sample_count': 1}).json()
+        self.assertEqual(result['instruction'], views.POSES[1]['instruction'])
+
+    def test_metrics(self):
+        self.post_frame(self.face)
+        body = self.client.get('/metrics/').content.decode()
+        self.assertIn('face_stage_seconds', body)
+        self.assertIn('face_recognition_cache_entries', body)
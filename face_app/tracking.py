@@ -0,0 +1,190 @@
+import threading
+import time
+from collections import OrderedDict
+from itertools import count
+
+import numpy as np
+from django.conf import settings
+
+DEFAULT_TRACKING_CONFIG = {
+    'ENABLED': True,
+    'IOU_THRESHOLD': 0.3,  # Minimum box overlap to continue a track
+    'REENCODE_INTERVAL': 30,  # Re-encode a track at least every N frames
+    'CONFIDENCE_DECAY': 0.95,  # Per-frame decay of a track's identity confidence
+    'MIN_CONFIDENCE': 0.1,  # Re-encode once the decayed confidence drops below this
+    'MAX_MISSED': 3,  # Frames a track may go undetected before it is dropped
+    'MAX_TRACKERS': 1000,
+    'IDLE_TIMEOUT': 60,  # Seconds before an unused tracker is evicted
+}
+
+
+def get_tracking_config():
+    return {**DEFAULT_TRACKING_CONFIG, **getattr(settings, 'FACE_TRACKING', {})}
+
+
+def box_iou(box, boxes):
+    """
+    Intersection over union of one (top, right, bottom, left) box with each of `boxes`.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    top, right, bottom, left = box
+    inter_h = np.clip(np.minimum(bottom, boxes[:, 2]) - np.maximum(top, boxes[:, 0]), 0, None)
+    inter_w = np.clip(np.minimum(right, boxes[:, 1]) - np.maximum(left, boxes[:, 3]), 0, None)
+    intersection = inter_h * inter_w
+    area = (bottom - top) * (right - left)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 1] - boxes[:, 3])
+    return intersection / np.maximum(area + areas - intersection, 1e-9)
+
+
+class Track:
+    """
+    One face followed across frames, with the identity from its last encoding.
+    """
+
+    _ids = count(1)
+
+    def __init__(self, box):
+        self.id = next(self._ids)
+        self.box = tuple(box)
+        self.match = None  # (profile_id, name, distance) from the last gallery search
+        self.confidence = 0.0
+        self.frames_since_encoding = None  # None until the first encoding
+        self.missed = 0
+
+    @property
+    def area(self):
+        top, right, bottom, left = self.box
+        return (bottom - top) * (right - left)
+
+
+class FaceTracker:
+    """
+    Associates cheap per-frame detections across frames by IoU, so the
+    expensive encoding and gallery match only run when a track is new, its
+    identity confidence has decayed, or it is due for a periodic refresh.
+    """
+
+    def __init__(self, config=None):
+        config = config or get_tracking_config()
+        self.iou_threshold = config['IOU_THRESHOLD']
+        self.reencode_interval = config['REENCODE_INTERVAL']
+        self.confidence_decay = config['CONFIDENCE_DECAY']
+        self.min_confidence = config['MIN_CONFIDENCE']
+        self.max_missed = config['MAX_MISSED']
+        self.tracks = []
+        self.last_used = time.monotonic()
+
+    def update(self, boxes):
+        """
+        Feeds one frame's detections. Returns the track for each box, in order.
+        """
+        self.last_used = time.monotonic()
+        assigned = [None] * len(boxes)
+        unmatched_tracks = list(self.tracks)
+
+        if boxes and unmatched_tracks:
+            overlaps = np.array([box_iou(track.box, boxes) for track in unmatched_tracks])
+            # Greedy association, best overlap first
+            for flat_index in np.argsort(overlaps, axis=None)[::-1]:
+                track_index, box_index = np.unravel_index(flat_index, overlaps.shape)
+                if overlaps[track_index, box_index] < self.iou_threshold:
+                    break
+                track = unmatched_tracks[track_index]
+                if track is None or assigned[box_index] is not None:
+                    continue
+                assigned[box_index] = track
+                unmatched_tracks[track_index] = None
+
+        for track in unmatched_tracks:
+            if track is not None:
+                track.missed += 1
+        self.tracks = [track for track in self.tracks if track.missed <= self.max_missed]
+
+        for box_index, box in enumerate(boxes):
+            track = assigned[box_index]
+            if track is None:
+                track = Track(box)
+                self.tracks.append(track)
+                assigned[box_index] = track
+            else:
+                track.box = tuple(box)
+                track.missed = 0
+                track.confidence *= self.confidence_decay
+                if track.frames_since_encoding is not None:
+                    track.frames_since_encoding += 1
+        return assigned
+
+    def needs_encoding(self, track):
+        return (track.frames_since_encoding is None
+                or track.frames_since_encoding >= self.reencode_interval
+                or track.confidence < self.min_confidence)
+
+    def record_match(self, track, match, threshold):
+        """
+        Stores a fresh gallery match on `track`. Confidence is the relative
+        margin between the match distance and the decision threshold, so both
+        clear matches and clear strangers are trusted for a while.
+        """
+        track.match = match
+        track.confidence = min(abs(threshold - match[2]) / threshold, 1.0)
+        track.frames_since_encoding = 0
+
+    def invalidate(self):
+        """
+        Forces every track to be re-encoded on its next frame.
+        """
+        for track in self.tracks:
+            track.frames_since_encoding = None
+
+
+class TrackerRegistry:
+    """
+    Per-client trackers keyed by session or connection, evicted LRU-first
+    and after a period of inactivity.
+    """
+
+    def __init__(self, max_trackers=1000, idle_timeout=60):
+        self.max_trackers = max_trackers
+        self.idle_timeout = idle_timeout
+        self._trackers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            self._evict_idle()
+            tracker = self._trackers.pop(key, None) or FaceTracker()
+            self._trackers[key] = tracker
+            while len(self._trackers) > self.max_trackers:
+                self._trackers.popitem(last=False)
+            return tracker
+
+    def discard(self, key):
+        with self._lock:
+            self._trackers.pop(key, None)
+
+    def invalidate(self):
+        with self._lock:
+            for tracker in self._trackers.values():
+                tracker.invalidate()
+
+    def _evict_idle(self):
+        deadline = time.monotonic() - self.idle_timeout
+        while self._trackers:
+            key, tracker = next(iter(self._trackers.items()))
+            if tracker.last_used >= deadline:
+                break
+            del self._trackers[key]
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_tracker_registry():
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                config = get_tracking_config()
+                _registry = TrackerRegistry(config['MAX_TRACKERS'], config['IDLE_TIMEOUT'])
+    return _registry
@@ -5,6 +5,9 @@ urlpatterns = [
     path('', views.home, name='home'),
     path('register_face/', views.register_face, name='register_face'),
     path('test_face/', views.test_face, name='test_face'),
+    path('metrics/', views.metrics, name='metrics'),
+    path('gate_stats/', views.gate_stats, name='gate_stats'),
+    path('recognize_batch/', views.recognize_batch, name='recognize_batch'),
     path('get_next_pose/', views.get_next_pose, name='get_next_pose'),
     path('save_face_profile/', views.save_face_profile, name='save_face_profile'),
 ]
\ No newline at end of file
@@ -1,16 +1,130 @@
-import face_recognition
+import base64
+import importlib
+import struct
+import threading
+import time
 import cv2
 import numpy as np
-from PIL import Image
 
+from .metrics import timed
 
-def detect_and_encode_face(image, use_cnn=True):
+
+class LazyModule:
+    """
+    Stands in for a module that is only imported on first attribute access.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return self._module
+
+    @property
+    def is_loaded(self):
+        return self._module is not None
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+
+# Importing face_recognition loads every dlib model (seconds and over 100 MB),
+# so it waits until a face is actually processed or load_models() is called
+face_recognition = LazyModule('face_recognition')
+
+
+def load_models():
+    """
+    Imports face_recognition, loading the dlib models. Returns the seconds
+    it took (0 if they were already loaded).
+    """
+    if face_recognition.is_loaded:
+        return 0.0
+    start = time.perf_counter()
+    face_recognition.load()
+    return time.perf_counter() - start
+
+
+REDUCED_COLOR_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+@timed('decode')
+def decode_image(image_bytes, reduction=1):
+    """
+    Decodes encoded image bytes (JPEG, PNG, ...) into a BGR image.
+    A `reduction` of 2, 4 or 8 decodes straight to that fraction of the
+    size, which for JPEG skips most of the decoding work.
+    Returns None if the bytes cannot be decoded.
+    """
+    return cv2.imdecode(np.frombuffer(image_bytes, np.uint8), REDUCED_COLOR_FLAGS[reduction])
+
+
+def image_size(image_bytes):
+    """
+    Returns the (height, width) of a JPEG or PNG from its header, without
+    decoding it, or None for other or truncated data.
+    """
+    if image_bytes[:8] == b'\x89PNG\r\n\x1a\n' and len(image_bytes) >= 24:
+        width, height = struct.unpack('>II', image_bytes[16:24])
+        return height, width
+    if image_bytes[:2] != b'\xff\xd8':
+        return None
+
+    # Walk the JPEG segments up to the start-of-frame, which holds the size
+    offset = 2
+    while offset + 9 <= len(image_bytes):
+        if image_bytes[offset] != 0xFF:
+            return None
+        marker = image_bytes[offset + 1]
+        if marker == 0xFF:
+            offset += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            offset += 2
+            continue
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack('>HH', image_bytes[offset + 5:offset + 9])
+            return height, width
+        offset += 2 + struct.unpack('>H', image_bytes[offset + 2:offset + 4])[0]
+    return None
+
+
+def base64_payload(image_data):
+    """
+    Returns the encoded image bytes of a base64 string, with or without a
+    `data:image/...;base64,` prefix.
+    """
+    if ';base64,' in image_data:
+        image_data = image_data.split(';base64,', 1)[1]
+    return base64.b64decode(image_data)
+
+
+def decode_base64_image(image_data):
+    """
+    Decodes a base64 image, with or without a `data:image/...;base64,` prefix.
+    """
+    return decode_image(base64_payload(image_data))
+
+
+@timed('detect_and_encode')
+def detect_and_encode_face(image, use_cnn=True, scale=0.25):
     """
     Detects a face in the image and returns the face encoding.
     If `use_cnn` is True, it uses the CNN model for detection.
     """
-    # Resize image to 1/4 size for faster face detection
-    small_image = cv2.resize(image, (0, 0), fx=0.25, fy=0.25)
+    # Resize image (to 1/4 size by default) for faster face detection
+    small_image = cv2.resize(image, (0, 0), fx=scale, fy=scale)
 
     # Convert the image from BGR color (OpenCV default) to RGB color
     rgb_small_image = cv2.cvtColor(small_image, cv2.COLOR_BGR2RGB)
@@ -27,16 +141,160 @@ def detect_and_encode_face(image, use_cnn=True):
         return False, None
 
 
+def _scale_location(location, scale, shape):
+    """
+    Maps a (top, right, bottom, left) box found on a resized image back to
+    the full-resolution image, clipped to its bounds.
+    """
+    h, w = shape[:2]
+    top, right, bottom, left = (int(round(v / scale)) for v in location)
+    return max(top, 0), min(right, w - 1), min(bottom, h - 1), max(left, 0)
+
+
+@timed('detect')
+def detect_faces_batch(images, use_cnn=True, scale=0.25):
+    """
+    Detects faces in several BGR images. Returns one list of full-resolution
+    (top, right, bottom, left) boxes per image. When the CNN model is used and
+    every image has the same size, detection runs as a single dlib batch.
+    """
+    rgb_small_images = [
+        cv2.cvtColor(cv2.resize(image, (0, 0), fx=scale, fy=scale), cv2.COLOR_BGR2RGB)
+        for image in images
+    ]
+    if not rgb_small_images:
+        return []
+
+    same_size = len({rgb_image.shape for rgb_image in rgb_small_images}) == 1
+    if use_cnn and same_size:
+        batch_locations = face_recognition.batch_face_locations(rgb_small_images, number_of_times_to_upsample=1,
+                                                                batch_size=len(rgb_small_images))
+    else:
+        model = "cnn" if use_cnn else "hog"
+        batch_locations = [face_recognition.face_locations(rgb_image, model=model) for rgb_image in rgb_small_images]
+
+    return [[_scale_location(location, scale, image.shape) for location in locations]
+            for image, locations in zip(images, batch_locations)]
+
+
+@timed('encode')
+def encode_faces(image, locations):
+    """
+    Encodes every face of a BGR image whose (top, right, bottom, left) box is
+    known, in a single face_encodings call. dlib aligns each face from its
+    landmarks while extracting the face chip. Returns an (n, 128) array.
+    """
+    if not locations:
+        return np.empty((0, 128))
+    rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    return np.array(face_recognition.face_encodings(rgb_image, [tuple(location) for location in locations]))
+
+
+class FaceAnalysis:
+    """
+    Single-pass analysis of the first face in a BGR image.
+
+    The face is detected once (on a downscaled copy), its landmarks are
+    computed once from that box, and the eye line gives the alignment
+    transform. The box is mapped through the same transform and reused for
+    the encoding, so no stage runs a detector again.
+    """
+
+    def __init__(self, image, location=None):
+        self.image = image
+        self.rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        self.location = location
+        self._landmarks = None
+        self._alignment = None
+        self._encoding = None
+
+    @classmethod
+    def detect(cls, image, use_cnn=True, scale=0.25):
+        """
+        Returns a FaceAnalysis for the first face found in `image`, or None.
+        """
+        analysis = cls(image)
+        small_image = cv2.resize(analysis.rgb_image, (0, 0), fx=scale, fy=scale)
+        model = "cnn" if use_cnn else "hog"
+        with timed('detect'):
+            face_locations = face_recognition.face_locations(small_image, model=model)
+        if not face_locations:
+            return None
+        analysis.location = _scale_location(face_locations[0], scale, image.shape)
+        return analysis
+
+    @property
+    def landmarks(self):
+        """
+        The 68-point landmark dict of the face, computed from the known box.
+        """
+        if self._landmarks is None:
+            with timed('landmarks'):
+                self._landmarks = face_recognition.face_landmarks(self.rgb_image, face_locations=[self.location])[0]
+        return self._landmarks
+
+    @property
+    def alignment(self):
+        """
+        The 2x3 affine matrix that rotates the eyes onto a horizontal line.
+        """
+        if self._alignment is None:
+            left_eye = np.mean(self.landmarks['left_eye'], axis=0)
+            right_eye = np.mean(self.landmarks['right_eye'], axis=0)
+            angle = np.degrees(np.arctan2(right_eye[1] - left_eye[1], right_eye[0] - left_eye[0]))
+            eyes_center = tuple(float(v) for v in (left_eye + right_eye) / 2)
+            self._alignment = cv2.getRotationMatrix2D(eyes_center, angle, 1.0)
+        return self._alignment
+
+    def aligned(self, margin=0.5):
+        """
+        Returns an aligned RGB crop around the face and the face box mapped
+        into it. Only the crop (the box plus `margin` on every side) is
+        warped, not the whole frame.
+        """
+        h, w = self.rgb_image.shape[:2]
+        top, right, bottom, left = self.location
+        pad_x, pad_y = int((right - left) * margin), int((bottom - top) * margin)
+        x0, y0 = max(left - pad_x, 0), max(top - pad_y, 0)
+        x1, y1 = min(right + pad_x, w - 1), min(bottom + pad_y, h - 1)
+
+        # Same rotation, expressed in crop coordinates
+        matrix = self.alignment.copy()
+        matrix[:, 2] += matrix[:, :2] @ np.array([x0, y0]) - np.array([x0, y0])
+        crop = self.rgb_image[y0:y1 + 1, x0:x1 + 1]
+        aligned_crop = cv2.warpAffine(crop, matrix, (crop.shape[1], crop.shape[0]), flags=cv2.INTER_CUBIC)
+
+        # Rotation keeps the face size, so only the box centre needs mapping
+        cx, cy = matrix @ np.array([(left + right) / 2 - x0, (top + bottom) / 2 - y0, 1.0])
+        half_w, half_h = (right - left) / 2, (bottom - top) / 2
+        aligned_location = _scale_location((cy - half_h, cx + half_w, cy + half_h, cx - half_w), 1.0, aligned_crop.shape)
+        return aligned_crop, aligned_location
+
+    @property
+    def encoding(self):
+        """
+        The 128-d encoding of the aligned face.
+        """
+        if self._encoding is None:
+            with timed('align'):
+                aligned_image, aligned_location = self.aligned()
+            with timed('encode'):
+                self._encoding = face_recognition.face_encodings(aligned_image, [aligned_location])[0]
+        return self._encoding
+
+
+@timed('blur_check')
 def is_blurry(image, threshold=100.0):
     """
     Detect if an image is blurry using the Laplacian variance method.
-    A lower variance indicates a blurrier image.
+    A lower variance indicates a blurrier image. Accepts BGR or grayscale images.
     """
-    gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    gray_image = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
     laplacian_var = cv2.Laplacian(gray_image, cv2.CV_64F).var()
     return laplacian_var < threshold
 
 
+@timed('align')
 def align_face(image):
     """
     Aligns the face in the image using facial landmarks.
@@ -1,34 +1,74 @@
 import logging
+import json
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.shortcuts import render
-from django.http import JsonResponse
-from .models import FaceProfile
-from face_app.utils import detect_and_encode_face, compare_faces, is_blurry, align_face, face_distance
+from django.http import HttpResponse, JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from .models import ENCODING_SIZE, FaceProfile
+from .detection import get_detection_config, get_detection_policy
+from .enrollment import get_enrollment_store
+from .gallery import get_gallery
+from .gating import get_frame_gate, get_gating_config
+from .metrics import count_outcome, record_timings, render_metrics, timed, timed_endpoint
+from .recognition_cache import get_recognition_cache
+from .jobs import (detect_faces_job, encode_all_faces_job, encode_face_job, encode_faces_batch_job,
+                   encode_location_job, encode_locations_job, register_face_job)
+from .tracking import get_tracker_registry, get_tracking_config
+from .workers import InferenceTimeout, QueueFull, get_inference_config, get_inference_pool
+from face_app.utils import base64_payload
 import base64
 import numpy as np
-import cv2
-import face_recognition
-import math
+import time
 
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 THRESHOLD = 0.6
 REQUIRED_SAMPLES = 5
 MAX_ATTEMPTS = 3  # Maximum number of attempts for each pose
+MAX_BATCH_IMAGES = 16  # Maximum number of images accepted by recognize_batch
+BUSY_MESSAGE = 'Server is busy. Please try again shortly.'
+TIMEOUT_MESSAGE = 'Face processing timed out. Please try again.'
+
+# Frames clients should send: binary, at this width and encoder quality
+DEFAULT_FRAME_FORMAT = {
+    'WIDTH': 320,
+    'QUALITY': 0.7,
+    'TYPE': 'image/jpeg',
+}
 
 POSES = [
-    {'instruction': 'Look straight at the camera', 'validation': 'validate_front_face'},
-    {'instruction': 'Turn your head slightly to the left', 'validation': 'validate_left_face'},
-    {'instruction': 'Turn your head slightly to the right', 'validation': 'validate_right_face'},
-    {'instruction': 'Tilt your head up slightly', 'validation': 'validate_up_face'},
-    {'instruction': 'Tilt your head down slightly', 'validation': 'validate_down_face'}
+    {'instruction': 'Look straight at the camera', 'pose': 'front'},
+    {'instruction': 'Turn your head slightly to the left', 'pose': 'left'},
+    {'instruction': 'Turn your head slightly to the right', 'pose': 'right'},
+    {'instruction': 'Tilt your head up slightly', 'pose': 'up'},
+    {'instruction': 'Tilt your head down slightly', 'pose': 'down'}
 ]
 
 
+def get_frame_format():
+    """
+    The frame format announced to clients, configured by settings.FACE_FRAME_FORMAT.
+    """
+    config = {**DEFAULT_FRAME_FORMAT, **getattr(settings, 'FACE_FRAME_FORMAT', {})}
+    return {'width': config['WIDTH'], 'quality': config['QUALITY'], 'type': config['TYPE']}
+
+def read_frame(request):
+    """
+    Returns the encoded image bytes of a frame POST: a binary `image` file
+    upload, or the older base64 `image` field. None if neither was sent.
+    """
+    upload = request.FILES.get('image')
+    if upload is not None:
+        return upload.read()
+    image_data = request.POST.get('image')
+    return base64_payload(image_data) if image_data else None
+
 def home(request):
     return render(request, 'home.html')
 
-def get_next_pose(request):
+async def get_next_pose(request):
     sample_count = int(request.GET.get('sample_count', 0))
     attempt_count = int(request.GET.get('attempt_count', 0))
 
@@ -40,125 +80,212 @@ def get_next_pose(request):
     else:
         return JsonResponse({'complete': True})
 
-def validate_face_angle(image, landmarks, validation_func):
-    result = globals()[validation_func](landmarks)
-    logger.debug(f"Validation result for {validation_func}: {result}")
+def busy_response(extra=None):
+    """
+    503 response telling the client to back off while the inference queue is full.
+    """
+    retry_after = get_inference_config()['RETRY_AFTER']
+    response = JsonResponse({'success': False, 'error': BUSY_MESSAGE, **(extra or {})},
+                            status=503)
+    response['Retry-After'] = str(retry_after)
+    return response
+
+def timeout_response(extra=None):
+    return JsonResponse({'success': False, 'error': TIMEOUT_MESSAGE, **(extra or {})},
+                        status=504)
+
+GATE_ERRORS = {
+    'invalid_image': 'Could not decode the image.',
+    'sharpness': 'Image is too blurry for recognition.',
+    'exposure': 'Image is too dark or overexposed.',
+    'face_probe': 'No face detected in the image.',
+}
+
+async def run_job(job, *args):
+    """
+    Runs an inference job on the pool and records the stage timings it reports.
+    """
+    result = await get_inference_pool().arun(job, *args)
+    record_timings(result.pop('timings', ()))
+    return result
+
+async def run_detection_job(job, *args, model=None, group=False):
+    """
+    Runs a job that detects faces, in the mode the detection policy picks
+    for the current load, and feeds the job latency back to the policy.
+    """
+    pool = get_inference_pool()
+    policy = get_detection_policy()
+    mode = policy.choose(pool, model, group)
+    start = time.perf_counter()
+    result = await run_job(job, *args, mode)
+    if 'detection' in result:
+        policy.record_latency(mode.model, time.perf_counter() - start)
     return result
 
-def validate_front_face(landmarks):
-    left_eye = np.mean(landmarks['left_eye'], axis=0)
-    right_eye = np.mean(landmarks['right_eye'], axis=0)
-    eye_angle = math.degrees(math.atan2(right_eye[1] - left_eye[1], right_eye[0] - left_eye[0]))
-    logger.debug(f"Front face eye angle: {eye_angle}")
-    return abs(eye_angle) < 15  # Increased tolerance
-
-def calculate_face_ratio(landmarks):
-    left_eye = np.mean(landmarks['left_eye'], axis=0)
-    right_eye = np.mean(landmarks['right_eye'], axis=0)
-    nose_tip = landmarks['nose_tip'][0]
-    left_ratio = (nose_tip[0] - left_eye[0]) / (right_eye[0] - left_eye[0])
-    right_ratio = (right_eye[0] - nose_tip[0]) / (right_eye[0] - left_eye[0])
-    logger.debug(f"Left eye: {left_eye}, Right eye: {right_eye}, Nose tip: {nose_tip}")
-    logger.debug(f"Left ratio: {left_ratio}, Right ratio: {right_ratio}")
-    return left_ratio, right_ratio
-
-def validate_left_face(landmarks):
-    left_ratio, right_ratio = calculate_face_ratio(landmarks)
-    is_valid = left_ratio > 0.30 and right_ratio < 0.70  # Adjusted thresholds
-    logger.debug(f"Left face validation result: {is_valid}")
-    return is_valid
-
-def validate_right_face(landmarks):
-    left_ratio, right_ratio = calculate_face_ratio(landmarks)
-    is_valid = left_ratio < 0.30 and right_ratio > 0.70  # Adjusted thresholds
-    logger.debug(f"Right face validation result: {is_valid}")
-    return is_valid
-
-def validate_up_face(landmarks):
-    left_eye = np.mean(landmarks['left_eye'], axis=0)
-    right_eye = np.mean(landmarks['right_eye'], axis=0)
-    mouth = np.mean(landmarks['top_lip'], axis=0)
-    eye_mouth_distance = np.linalg.norm(np.mean([left_eye, right_eye], axis=0) - mouth)
-    logger.debug(f"Up face eye-mouth distance: {eye_mouth_distance}")
-    return eye_mouth_distance < 55  # Increased threshold
-
-def validate_down_face(landmarks):
-    left_eye = np.mean(landmarks['left_eye'], axis=0)
-    right_eye = np.mean(landmarks['right_eye'], axis=0)
-    mouth = np.mean(landmarks['top_lip'], axis=0)
-    eye_mouth_distance = np.linalg.norm(np.mean([left_eye, right_eye], axis=0) - mouth)
-    logger.debug(f"Down face eye-mouth distance: {eye_mouth_distance}")
-    return eye_mouth_distance > 50 and eye_mouth_distance < 62  # Adjusted range
-
-def register_face(request):
+async def gate_frame(image_bytes, stages, client_key=None, group=False):
+    """
+    Runs the cheap pre-filter cascade on a frame before any inference job.
+    Returns None if the frame may proceed, otherwise the response fields.
+    `group` sizes the face probe for the smaller faces of multi-face frames.
+    """
+    config = get_gating_config()
+    if not config['ENABLED']:
+        return None
+
+    detection_config = get_detection_config()
+    face_fraction = detection_config['GROUP_FACE_FRACTION'] if group else detection_config['FACE_FRACTION']
+    gate = get_frame_gate()
+    with timed('gate'):
+        rejected = await sync_to_async(gate.check, thread_sensitive=False)(image_bytes, config[stages], client_key,
+                                                                           face_fraction)
+    if rejected is None:
+        return None
+    if rejected == 'motion':
+        # Nothing moved since the last processed frame, so its result still holds
+        previous = gate.previous_result(client_key)
+        if previous is None:
+            # Expired or invalidated since the check; the frame is processed after all
+            return None
+        return {**previous, 'unchanged': True}
+    return {'success': False, 'error': GATE_ERRORS[rejected], 'gated': rejected}
+
+async def cached_frame(image_bytes, variant, client_key):
+    """
+    Looks up the recognition cache for a near-identical recent frame of the
+    same client. Returns the frame's cache key (None with the cache
+    disabled or an anonymous client) and the cached result, if any.
+    """
+    cache = get_recognition_cache()
+    # Without a client key, frames from different people would share one scope
+    if not cache.enabled or client_key is None:
+        return None, None
+    with timed('frame_hash'):
+        key = await sync_to_async(cache.frame_key, thread_sensitive=False)(image_bytes, (variant, client_key))
+    return key, cache.get_result(key)
+
+def cached_response(result, client_key):
+    count_outcome('recognize', 'cached')
+    get_frame_gate().remember_result(client_key, result)
+    return {**result, 'cached': True}
+
+def match_encodings(encodings):
+    """
+    Returns the best (profile_id, name, distance) gallery match of each
+    encoding, or None if the gallery is empty. Encodings close to a recently
+    matched one are scored against that profile only and kept if they match
+    it; the rest are searched in one batch.
+    """
+    encodings = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+    cache = get_recognition_cache()
+    generation = cache.generation
+    gallery = get_gallery()
+    matches = [None] * len(encodings)
+    if cache.enabled:
+        candidates = cache.get_candidates(encodings)
+        hits = [index for index, candidate in enumerate(candidates) if candidate is not None]
+        if hits:
+            scored = gallery.distances_to(encodings[hits], [candidates[index] for index in hits])
+            for index, match in zip(hits, scored):
+                # A candidate that no longer matches may have lost to another profile, so search again
+                if match is not None and match[2] <= THRESHOLD:
+                    matches[index] = match
+    missing = [index for index, match in enumerate(matches) if match is None]
+    if missing:
+        for index, found in zip(missing, gallery.search_batch(encodings[missing], k=1)):
+            if found:
+                matches[index] = found[0]
+                if cache.enabled:
+                    cache.put_candidate(encodings[index], found[0][0], generation)
+    return matches
+
+async def register_frame(token, image_bytes, sample_count, attempt_count=0):
+    """
+    Runs the registration pipeline for pose `sample_count` on one encoded
+    frame and returns the response fields. The encoding is added to
+    enrollment `token` on success. Raises QueueFull or InferenceTimeout.
+    """
+    rejected = await gate_frame(image_bytes, 'REGISTRATION_STAGES')
+    if rejected is not None:
+        count_outcome('register', f"gated_{rejected['gated']}")
+        return {**rejected, 'error': f"{rejected['error']} Please try again.", 'attempt_count': attempt_count + 1}
+
+    # Decode, check blur, validate the pose, align and encode in an inference worker
+    result = await run_detection_job(register_face_job, image_bytes, POSES[sample_count]['pose'])
+    status = result['status']
+    count_outcome('register', status)
+
+    if status == 'invalid_image':
+        return {'success': False, 'error': 'Could not decode the image. Please try again.', 'attempt_count': attempt_count + 1}
+    if status == 'blurry':
+        return {'success': False, 'error': 'Image is too blurry. Please try again.', 'attempt_count': attempt_count + 1}
+    if status == 'no_face':
+        return {'success': False, 'error': 'No face detected in the image. Please try again.', 'attempt_count': attempt_count + 1,
+                'detection': result['detection']}
+    if status == 'bad_pose':
+        instruction = POSES[sample_count]["instruction"].lower()
+        error_message = f'Face not in correct position. Please {instruction}.'
+        return {'success': False, 'error': error_message, 'attempt_count': attempt_count + 1, 'detection': result['detection']}
+
+    if status == 'ok':
+        # Store the encoding with the enrollment
+        sample_count = await sync_to_async(get_enrollment_store().add, thread_sensitive=False)(token, result['encoding'])
+        if sample_count is None:
+            return {'success': False, 'error': 'Registration expired. Please start over.', 'reset': True}
+
+        if sample_count >= REQUIRED_SAMPLES:
+            return {'success': True, 'message': 'Face samples collected. Please enter your name.', 'complete': True,
+                    'detection': result['detection']}
+        else:
+            return {'success': True, 'message': f'Sample {sample_count} of {REQUIRED_SAMPLES} captured.', 'complete': False, 'sample_count': sample_count, 'attempt_count': 0,
+                    'detection': result['detection']}
+    else:
+        return {'success': False, 'error': 'Failed to encode face. Please try again.', 'attempt_count': attempt_count + 1}
+
+@timed_endpoint('register_face')
+async def register_face(request):
     if request.method == 'POST':
-        image_data = request.POST.get('image')
+        image_bytes = read_frame(request)
+        token = request.POST.get('token', '')
         sample_count = int(request.POST.get('sample_count', 0))
         attempt_count = int(request.POST.get('attempt_count', 0))
 
-        if not image_data:
+        if not image_bytes:
             return JsonResponse({'success': False, 'error': 'Image is required.'})
 
         try:
-            # Decode the base64 image
-            format, imgstr = image_data.split(';base64,')
-            image = base64.b64decode(imgstr)
-            image = cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_COLOR)
-
-            # Pre-check if the image is too blurry
-            if is_blurry(image):
-                return JsonResponse({'success': False, 'error': 'Image is too blurry. Please try again.', 'attempt_count': attempt_count + 1})
-
-            # Detect face landmarks
-            face_landmarks_list = face_recognition.face_landmarks(image)
-            if not face_landmarks_list:
-                return JsonResponse({'success': False, 'error': 'No face detected in the image. Please try again.', 'attempt_count': attempt_count + 1})
-
-            # Validate face angle
-            validation_result = validate_face_angle(image, face_landmarks_list[0], POSES[sample_count]['validation'])
-            if not validation_result:
-                instruction = POSES[sample_count]["instruction"].lower()
-                error_message = f'Face not in correct position. Please {instruction}.'
-                return JsonResponse({'success': False, 'error': error_message, 'attempt_count': attempt_count + 1})
-
-            # Align the face for more accurate encoding
-            image = align_face(image)
-
-            # Detect and encode face using CNN model
-            success, face_encoding = detect_and_encode_face(image, use_cnn=True)
-            if success:
-                # Store the encoding in the session
-                request.session.setdefault('face_encodings', []).append(face_encoding.tolist())
-
-                sample_count += 1
-                if sample_count >= REQUIRED_SAMPLES:
-                    return JsonResponse({'success': True, 'message': 'Face samples collected. Please enter your name.', 'complete': True})
-                else:
-                    return JsonResponse({'success': True, 'message': f'Sample {sample_count} of {REQUIRED_SAMPLES} captured.', 'complete': False, 'sample_count': sample_count, 'attempt_count': 0})
-            else:
-                return JsonResponse({'success': False, 'error': 'Failed to encode face. Please try again.', 'attempt_count': attempt_count + 1})
-
+            return JsonResponse(await register_frame(token, image_bytes, sample_count, attempt_count))
+        except QueueFull:
+            count_outcome('register', 'busy')
+            return busy_response({'attempt_count': attempt_count})
+        except InferenceTimeout:
+            count_outcome('register', 'timeout')
+            return timeout_response({'attempt_count': attempt_count + 1})
         except Exception as e:
+            count_outcome('register', 'error')
             logger.exception("An error occurred during face registration")
             return JsonResponse({'success': False, 'error': f'An error occurred: {str(e)}', 'attempt_count': attempt_count + 1})
 
-    return render(request, 'register_face.html')
+    # Every visit starts a fresh enrollment; the token travels with the page
+    token = await sync_to_async(get_enrollment_store().create, thread_sensitive=False)()
+    return render(request, 'register_face.html', {'enrollment_token': token, 'frame_format': get_frame_format()})
 
+@timed_endpoint('save_face_profile')
 def save_face_profile(request):
     if request.method == 'POST':
         name = request.POST.get('name')
-        face_encodings = request.session.get('face_encodings', [])
+        if not name:
+            return JsonResponse({'success': False, 'error': 'Name and face encodings are required.'})
 
-        if not name or not face_encodings:
+        face_encodings = get_enrollment_store().pop(request.POST.get('token', ''))
+        if face_encodings is None or not len(face_encodings):
             return JsonResponse({'success': False, 'error': 'Name and face encodings are required.'})
 
         try:
             face_profile = FaceProfile(name=name)
-            face_profile.set_encodings(np.array(face_encodings))
-            face_profile.save()
-
-            # Clear the session data
-            del request.session['face_encodings']
+            face_profile.set_encodings(face_encodings)
+            with timed('db_save'):
+                face_profile.save()
 
             return JsonResponse({'success': True, 'message': 'Face profile saved successfully.'})
         except Exception as e:
@@ -166,54 +293,280 @@ def save_face_profile(request):
 
     return JsonResponse({'success': False, 'error': 'Invalid request method.'})
 
-def test_face(request):
-    if request.method == 'POST':
-        try:
-            image_data = request.POST.get('image')
-            if not image_data:
-                return JsonResponse({'success': False, 'error': 'No image data received.'})
-
-            # Decode the base64 image
-            format, imgstr = image_data.split(';base64,')
-            image = base64.b64decode(imgstr)
-            image = cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_COLOR)
-
-            # Pre-check if the image is too blurry
-            if is_blurry(image):
-                return JsonResponse({'success': False, 'error': 'Image is too blurry for recognition.'})
-
-            # Align the face before encoding
-            image = align_face(image)
-
-            # Detect and encode face using CNN model
-            success, face_encoding = detect_and_encode_face(image, use_cnn=True)
-            if not success:
-                return JsonResponse({'success': False, 'error': 'No face detected in the image.'})
-
-            # Fetch known faces from the database
-            known_faces = FaceProfile.objects.all()
-            if not known_faces:
-                return JsonResponse({'success': False, 'error': 'No faces registered in the database.'})
-
-            best_match = None
-            best_match_distance = float('inf')
+def match_result(match):
+    """
+    Turns a (profile_id, name, distance) gallery match into response fields.
+    """
+    _, name, distance = match
+    if distance <= THRESHOLD:
+        confidence = (1 - distance) * 100
+        return {'name': name, 'confidence': f"{confidence:.2f}%"}
+    return {'name': None, 'message': 'No close match found.'}
+
+async def recognize_frame(image_bytes, client_key=None):
+    """
+    Runs the recognition pipeline on one encoded frame and returns the
+    response fields. Raises QueueFull or InferenceTimeout.
+    """
+    rejected = await gate_frame(image_bytes, 'RECOGNITION_STAGES', client_key)
+    if rejected is not None:
+        count_outcome('recognize', 'unchanged' if rejected.get('unchanged') else f"gated_{rejected['gated']}")
+        return rejected
+
+    key, cached = await cached_frame(image_bytes, 'face', client_key)
+    if cached is not None:
+        return cached_response(cached, client_key)
+
+    # Decode, check blur, align and encode in an inference worker
+    result = await run_detection_job(encode_face_job, image_bytes)
+    if result['status'] != 'ok':
+        count_outcome('recognize', result['status'])
+    if result['status'] == 'invalid_image':
+        return {'success': False, 'error': 'Could not decode the image.'}
+    if result['status'] == 'blurry':
+        return {'success': False, 'error': 'Image is too blurry for recognition.'}
+    if result['status'] != 'ok':
+        return {'success': False, 'error': 'No face detected in the image.', 'detection': result['detection']}
+
+    # Match against the in-memory gallery index
+    match, = await sync_to_async(match_encodings, thread_sensitive=False)([result['encoding']])
+    if match is None:
+        count_outcome('recognize', 'empty_gallery')
+        return {'success': False, 'error': 'No faces registered in the database.'}
+
+    result = {'success': True, **match_result(match), 'detection': result['detection']}
+    count_outcome('recognize', 'match' if result['name'] else 'no_match')
+    get_frame_gate().remember_result(client_key, result)
+    get_recognition_cache().put_result(key, result)
+    return result
 
-            for face in known_faces:
-                known_encodings = face.get_encodings()
-                distances = face_distance(known_encodings, face_encoding)
-                min_distance = np.min(distances)
+async def recognize_tracked_frame(tracker, image_bytes, client_key=None):
+    """
+    Tracked variant of `recognize_frame`: runs only cheap detection on every
+    frame, and encodes and matches the largest face only when its track
+    needs a fresh identity. Raises QueueFull or InferenceTimeout.
+    """
+    rejected = await gate_frame(image_bytes, 'RECOGNITION_STAGES', client_key)
+    if rejected is not None:
+        count_outcome('recognize', 'unchanged' if rejected.get('unchanged') else f"gated_{rejected['gated']}")
+        return rejected
+
+    key, cached = await cached_frame(image_bytes, 'face', client_key)
+    if cached is not None:
+        return cached_response(cached, client_key)
+
+    # Tracking only needs boxes, so it stays on HOG and lets the policy adjust the scale
+    result = await run_detection_job(detect_faces_job, image_bytes, model='hog')
+    if result['status'] != 'ok':
+        count_outcome('recognize', result['status'])
+    if result['status'] == 'invalid_image':
+        return {'success': False, 'error': 'Could not decode the image.'}
+    if result['status'] == 'blurry':
+        return {'success': False, 'error': 'Image is too blurry for recognition.'}
+
+    tracks = tracker.update(result['boxes'])
+    if not tracks:
+        count_outcome('recognize', 'no_face')
+        return {'success': False, 'error': 'No face detected in the image.', 'detection': result['detection']}
+
+    track = max(tracks, key=lambda t: t.area)
+    reused = not tracker.needs_encoding(track)
+    if not reused:
+        encoded = await run_job(encode_location_job, image_bytes, track.box)
+        match, = await sync_to_async(match_encodings, thread_sensitive=False)([encoded['encoding']])
+        if match is None:
+            count_outcome('recognize', 'empty_gallery')
+            return {'success': False, 'error': 'No faces registered in the database.'}
+        tracker.record_match(track, match, THRESHOLD)
+
+    result = {'success': True, **match_result(track.match), 'track_id': track.id, 'reused': reused,
+              'detection': result['detection']}
+    count_outcome('recognize', 'match' if result['name'] else 'no_match')
+    get_frame_gate().remember_result(client_key, result)
+    get_recognition_cache().put_result(key, result)
+    return result
 
-                if min_distance < best_match_distance:
-                    best_match_distance = min_distance
-                    best_match = face
+def face_result(box, match, **extra):
+    """
+    Response fields for one face of a multi-face result.
+    """
+    top, right, bottom, left = (int(round(v)) for v in box)
+    return {'box': {'top': top, 'right': right, 'bottom': bottom, 'left': left}, **match_result(match), **extra}
+
+async def recognize_faces_frame(image_bytes, tracker=None, client_key=None):
+    """
+    Multi-face variant of `recognize_frame`: every face in the frame is
+    encoded in one job and all of them are matched in one matrix-matrix
+    gallery search. With a tracker, only faces whose track needs a fresh
+    identity are encoded. Raises QueueFull or InferenceTimeout.
+    """
+    rejected = await gate_frame(image_bytes, 'RECOGNITION_STAGES', client_key, group=True)
+    if rejected is not None:
+        count_outcome('recognize', 'unchanged' if rejected.get('unchanged') else f"gated_{rejected['gated']}")
+        return rejected
+
+    key, cached = await cached_frame(image_bytes, 'faces', client_key)
+    if cached is not None:
+        return cached_response(cached, client_key)
+
+    if tracker is None:
+        result = await run_detection_job(encode_all_faces_job, image_bytes, group=True)
+    else:
+        result = await run_detection_job(detect_faces_job, image_bytes, model='hog', group=True)
+    if result['status'] != 'ok':
+        count_outcome('recognize', result['status'])
+    if result['status'] == 'invalid_image':
+        return {'success': False, 'error': 'Could not decode the image.'}
+    if result['status'] == 'blurry':
+        return {'success': False, 'error': 'Image is too blurry for recognition.'}
+    if result['status'] != 'ok':
+        return {'success': False, 'error': 'No face detected in the image.', 'detection': result['detection']}
+
+    if tracker is None:
+        boxes, encodings = result['boxes'], result['encodings']
+    else:
+        tracks = tracker.update(result['boxes'])
+        if not tracks:
+            count_outcome('recognize', 'no_face')
+            return {'success': False, 'error': 'No face detected in the image.', 'detection': result['detection']}
+        stale = [track for track in tracks if tracker.needs_encoding(track)]
+        boxes = [track.box for track in stale]
+        encodings = (await run_job(encode_locations_job, image_bytes, boxes))['encodings'] if stale else []
+
+    # One distance computation for every face that needs an identity
+    matches = await sync_to_async(match_encodings, thread_sensitive=False)(encodings)
+    if any(match is None for match in matches):
+        count_outcome('recognize', 'empty_gallery')
+        return {'success': False, 'error': 'No faces registered in the database.'}
+
+    if tracker is None:
+        faces = [face_result(box, match) for box, match in zip(boxes, matches)]
+    else:
+        for track, match in zip(stale, matches):
+            tracker.record_match(track, match, THRESHOLD)
+        faces = [face_result(track.box, track.match, track_id=track.id, reused=track not in stale)
+                 for track in tracks]
+
+    for face in faces:
+        count_outcome('recognize', 'match' if face['name'] else 'no_match')
+    result = {'success': True, 'faces': faces, 'detection': result['detection']}
+    get_frame_gate().remember_result(client_key, result)
+    get_recognition_cache().put_result(key, result)
+    return result
 
-            if best_match_distance <= THRESHOLD:
-                confidence = (1 - best_match_distance) * 100
-                return JsonResponse({'success': True, 'name': best_match.name, 'confidence': f"{confidence:.2f}%"})
-            else:
-                return JsonResponse({'success': True, 'name': None, 'message': 'No close match found.'})
+@timed_endpoint('test_face')
+async def test_face(request):
+    if request.method == 'POST':
+        try:
+            image_bytes = read_frame(request)
+            if not image_bytes:
+                return JsonResponse({'success': False, 'error': 'No image data received.'})
 
+            # Clients with a session get a tracker, so a person standing still is not re-encoded every frame
+            session_key = request.session.session_key
+            if request.POST.get('multi_face') == '1':
+                tracker = None
+                if session_key and get_tracking_config()['ENABLED']:
+                    tracker = get_tracker_registry().get(session_key)
+                return JsonResponse(await recognize_faces_frame(image_bytes, tracker, session_key))
+
+            if session_key and get_tracking_config()['ENABLED']:
+                tracker = get_tracker_registry().get(session_key)
+                return JsonResponse(await recognize_tracked_frame(tracker, image_bytes, session_key))
+
+            return JsonResponse(await recognize_frame(image_bytes, session_key))
+
+        except QueueFull:
+            count_outcome('recognize', 'busy')
+            return busy_response()
+        except InferenceTimeout:
+            count_outcome('recognize', 'timeout')
+            return timeout_response()
         except Exception as e:
+            count_outcome('recognize', 'error')
             return JsonResponse({'success': False, 'error': f'An error occurred: {str(e)}'})
 
-    return render(request, 'test_face.html')
\ No newline at end of file
+    return render(request, 'test_face.html', {'frame_format': get_frame_format()})
+
+def metrics(request):
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def gate_stats(request):
+    return JsonResponse(get_frame_gate().stats())
+
+def read_batch_images(request):
+    """
+    Returns the raw image payloads of a batch request: either multipart files
+    named `images`, or a JSON body of the form {"images": ["<base64>", ...]}.
+    """
+    if request.content_type == 'application/json':
+        images = json.loads(request.body).get('images', [])
+        return [base64.b64decode(image.split(';base64,', 1)[-1]) for image in images]
+    return [upload.read() for upload in request.FILES.getlist('images')]
+
+@csrf_exempt
+@require_POST
+@timed_endpoint('recognize_batch')
+def recognize_batch(request):
+    try:
+        payloads = read_batch_images(request)
+    except (ValueError, TypeError, AttributeError) as e:
+        return JsonResponse({'success': False, 'error': f'Invalid batch payload: {str(e)}'}, status=400)
+
+    if not payloads:
+        return JsonResponse({'success': False, 'error': 'No images received.'}, status=400)
+    if len(payloads) > MAX_BATCH_IMAGES:
+        return JsonResponse({'success': False, 'error': f'At most {MAX_BATCH_IMAGES} images per request.'}, status=400)
+
+    errors = {
+        'invalid_image': 'Could not decode image.',
+        'blurry': 'Image is too blurry for recognition.',
+        'no_face': 'No face detected in the image.',
+    }
+
+    try:
+        # One job for the whole batch so detection still runs as a single dlib batch
+        pool = get_inference_pool()
+        policy = get_detection_policy()
+        mode = policy.choose(pool)
+        config = get_inference_config()
+        # The job runs every image in turn, so a whole batch gets longer than a single frame
+        timeout = config['TIMEOUT'] and config['TIMEOUT'] + config['BATCH_IMAGE_TIMEOUT'] * len(payloads)
+        start = time.perf_counter()
+        job = pool.run(encode_faces_batch_job, payloads, mode, timeout=timeout)
+        record_timings(job['timings'])
+        job_results = job['results']
+        if any('detection' in result for result in job_results):
+            policy.record_latency(mode.model, (time.perf_counter() - start) / len(payloads))
+
+        results = [None] * len(payloads)
+        encoded, encodings = [], []
+        for index, result in enumerate(job_results):
+            if result['status'] == 'ok':
+                encoded.append(index)
+                encodings.append(result['encoding'])
+            else:
+                count_outcome('recognize_batch', result['status'])
+                results[index] = {'index': index, 'success': False, 'error': errors[result['status']]}
+                if 'detection' in result:
+                    results[index]['detection'] = result['detection']
+
+        # Match every encoding against the gallery in one matrix operation
+        for index, match in zip(encoded, match_encodings(encodings)):
+            if match is not None:
+                results[index] = {'index': index, 'success': True, **match_result(match)}
+                count_outcome('recognize_batch', 'match' if results[index]['name'] else 'no_match')
+            else:
+                results[index] = {'index': index, 'success': False, 'error': 'No faces registered in the database.'}
+            # Frames of different sizes are detected at different scales
+            results[index]['detection'] = job_results[index]['detection']
+
+        return JsonResponse({'success': True, 'results': results})
+
+    except QueueFull:
+        return busy_response()
+    except InferenceTimeout:
+        return timeout_response()
+    except Exception as e:
+        logger.exception("An error occurred during batch recognition")
+        return JsonResponse({'success': False, 'error': f'An error occurred: {str(e)}'})
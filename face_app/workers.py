@@ -0,0 +1,214 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INFERENCE_CONFIG = {
+    'WORKERS': max(1, (os.cpu_count() or 2) - 1),  # 0 runs jobs inline in the request thread
+    'MAX_PENDING': None,  # Defaults to 2 jobs per worker
+    'TIMEOUT': 10.0,  # Seconds a request waits for its job
+    'BATCH_IMAGE_TIMEOUT': 2.0,  # Extra seconds a batch job gets per image
+    'RETRY_AFTER': 1,  # Seconds suggested to clients when the queue is full
+    # 'forkserver' shares preloaded model weights between workers; spawn where it is unavailable
+    'START_METHOD': 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn',
+    'PRELOAD_MODELS': True,  # Load the models once in the forkserver before it forks workers
+    'WARMUP': False,  # Load models / start workers when the server starts, not on the first request
+}
+
+
+class QueueFull(Exception):
+    """
+    Raised when the inference queue has no free slot for another job.
+    """
+
+
+class InferenceTimeout(Exception):
+    """
+    Raised when a job does not finish within the configured timeout.
+    """
+
+
+def get_inference_config():
+    return {**DEFAULT_INFERENCE_CONFIG, **getattr(settings, 'FACE_INFERENCE', {})}
+
+
+def _init_worker():
+    """
+    Runs once in every worker process: sets up Django and loads the dlib
+    models so jobs never pay for it.
+    """
+    import django
+    from django.apps import apps
+
+    if not apps.ready:
+        os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Face_Detect.settings')
+        django.setup()
+
+    import cv2
+    from face_app.utils import load_models
+
+    # Already done when the models were preloaded into the forkserver
+    load_models()
+
+    # One OpenCV thread per process; parallelism comes from the pool itself
+    cv2.setNumThreads(1)
+    logger.info(f"Inference worker {os.getpid()} ready")
+
+
+def _worker_pid():
+    time.sleep(0.05)
+    return os.getpid()
+
+
+class InferencePool:
+    """
+    A bounded pool of inference processes.
+
+    At most `max_pending` jobs may be queued or running at once; `submit`
+    raises QueueFull instead of letting requests pile up behind a busy pool.
+    With `workers=0` jobs run inline, which is handy for development.
+    """
+
+    def __init__(self, workers, max_pending=None, timeout=None, start_method='spawn', preload_models=True):
+        self.workers = workers
+        self.max_pending = max_pending or max(1, workers * 2)
+        self.timeout = timeout
+        self.start_method = start_method
+        self.preload_models = preload_models
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    context = multiprocessing.get_context(self.start_method)
+                    if self.start_method == 'forkserver' and self.preload_models:
+                        # Workers are forked from a server that already holds the
+                        # dlib models, so they share the weights copy-on-write
+                        context.set_forkserver_preload(['face_recognition'])
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context,
+                                                         initializer=_init_worker)
+                    logger.info(f"Started inference pool with {self.workers} workers")
+        return self._executor
+
+    def start(self):
+        """
+        Starts every worker process and waits until each has loaded the
+        models. Returns the worker pids.
+        """
+        executor = self._get_executor()
+        # Concurrent jobs make the executor start all of its processes
+        futures = [executor.submit(_worker_pid) for _ in range(self.workers)]
+        return sorted({future.result() for future in futures})
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queues `fn(*args, **kwargs)` on the pool and returns its future.
+        """
+        if not self._slots.acquire(blocking=False):
+            raise QueueFull()
+        with self._pending_lock:
+            self._pending += 1
+
+        try:
+            future = self._get_executor().submit(fn, *args, **kwargs)
+        except Exception:
+            self._release()
+            raise
+        future.add_done_callback(lambda _: self._release())
+        return future
+
+    def run(self, fn, *args, timeout=None, **kwargs):
+        """
+        Runs a job and waits for its result, raising QueueFull or
+        InferenceTimeout when the pool cannot serve it in time. `timeout`
+        overrides the pool's timeout for longer jobs.
+        """
+        if not self.workers:
+            return fn(*args, **kwargs)
+
+        future = self.submit(fn, *args, **kwargs)
+        try:
+            return future.result(timeout=timeout or self.timeout)
+        except FutureTimeoutError:
+            # Frees the slot straight away if the job has not started yet
+            future.cancel()
+            raise InferenceTimeout()
+
+    async def arun(self, fn, *args):
+        """
+        Awaitable `run`: the event loop is never blocked while the job runs.
+        Inline pools (workers=0) fall back to the loop's thread executor.
+        """
+        loop = asyncio.get_running_loop()
+        if not self.workers:
+            return await loop.run_in_executor(None, fn, *args)
+
+        future = self.submit(fn, *args)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future, loop=loop), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            future.cancel()
+            raise InferenceTimeout()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _release(self):
+        with self._pending_lock:
+            self._pending -= 1
+        self._slots.release()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_inference_pool():
+    """
+    Returns the process-wide inference pool, configured by settings.FACE_INFERENCE.
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                config = get_inference_config()
+                _pool = InferencePool(config['WORKERS'], config['MAX_PENDING'], config['TIMEOUT'],
+                                      config['START_METHOD'], config['PRELOAD_MODELS'])
+    return _pool
+
+
+def warm_up(start_pool=True):
+    """
+    Loads the face models before the server accepts traffic: in this
+    process when inference runs inline, otherwise by starting every pool
+    worker. Pass start_pool=False before forking (e.g. gunicorn --preload),
+    since a pool cannot be carried across a fork.
+    """
+    pool = get_inference_pool()
+    start = time.perf_counter()
+    if not pool.workers:
+        from face_app.utils import load_models
+        load_models()
+    elif start_pool:
+        pool.start()
+    else:
+        return
+    logger.info(f"Face models warmed up in {time.perf_counter() - start:.2f}s")